@@ -8,8 +8,8 @@ from rest_framework.authtoken.models import Token
 from ninja import NinjaAPI
 from ninja.security import HttpBearer
 
-from mediastore.views import router as mediastore_router
-from file_handler.views import upload_router, download_router
+from mediastore.views import router as mediastore_router, async_router as async_mediastore_router
+from file_handler.views import upload_router, download_router, async_upload_router, async_download_router
 
 
 class AuthService:
@@ -39,3 +39,6 @@ api = NinjaAPI(auth=auth)
 api.add_router("/", mediastore_router)
 api.add_router("/upload", upload_router)
 api.add_router("/download", download_router)
+api.add_router("/async", async_mediastore_router)
+api.add_router("/async/upload", async_upload_router)
+api.add_router("/async/download", async_download_router)
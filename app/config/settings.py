@@ -134,3 +134,81 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Media listing pagination (/media/dump, /media/search, /media/read with ?limit= or ?cursor=)
+MEDIA_PAGE_SIZE = int(os.environ.get('MEDIA_PAGE_SIZE', 100))
+MEDIA_PAGE_SIZE_MAX = int(os.environ.get('MEDIA_PAGE_SIZE_MAX', 1000))
+
+# seconds before the in-process IdentifierType registry is reloaded from the database
+IDENTIFIER_REGISTRY_TTL = int(os.environ.get('IDENTIFIER_REGISTRY_TTL', 60))
+
+# Storage backends
+# idle time after which pooled BucketStores and s3 clients are closed
+STORE_POOL_IDLE_SECONDS = int(os.environ.get('STORE_POOL_IDLE_SECONDS', 300))
+
+# Caches
+# "media" holds Media rows by pid for /media/{pid} and /download reads (mediastore.cache).
+# MEDIA_CACHE_BACKEND is locmem (per process), file (shared by the workers of a host) or dummy (off)
+MEDIA_CACHE_BACKENDS = {'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+                        'file': 'django.core.cache.backends.filebased.FileBasedCache',
+                        'dummy': 'django.core.cache.backends.dummy.DummyCache'}
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'media': {
+        'BACKEND': MEDIA_CACHE_BACKENDS[os.environ.get('MEDIA_CACHE_BACKEND', 'locmem')],
+        'LOCATION': os.environ.get('MEDIA_CACHE_DIR', '/tmp/mediastore_cache'),
+        'TIMEOUT': int(os.environ.get('MEDIA_CACHE_TIMEOUT', 300)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('MEDIA_CACHE_MAX_ENTRIES', 10000))},
+    },
+}
+
+# lifetime of presigned GET urls, and the least lifetime a url handed out from the presigned url cache has left
+PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', 3600))
+PRESIGNED_URL_MIN_VALIDITY = int(os.environ.get('PRESIGNED_URL_MIN_VALIDITY', 900))
+
+# /download/archive: store reads running concurrently, and objects held in memory at once
+ARCHIVE_FETCH_WORKERS = int(os.environ.get('ARCHIVE_FETCH_WORKERS', 8))
+ARCHIVE_MAX_IN_FLIGHT = int(os.environ.get('ARCHIVE_MAX_IN_FLIGHT', 16))
+
+# /upload/bulk: store writes running concurrently, and archive members held in memory at once
+UPLOAD_BULK_WORKERS = int(os.environ.get('UPLOAD_BULK_WORKERS', 8))
+UPLOAD_BULK_MAX_IN_FLIGHT = int(os.environ.get('UPLOAD_BULK_MAX_IN_FLIGHT', 32))
+
+# /upload/presigned: media at least this size (bytes) get presigned multipart part urls instead of one PUT url
+PRESIGNED_MULTIPART_THRESHOLD = int(os.environ.get('PRESIGNED_MULTIPART_THRESHOLD', 100*1024*1024))
+
+# /upload/complete and reconcile_pending: concurrent store checks (HEAD requests for s3)
+UPLOAD_COMPLETE_WORKERS = int(os.environ.get('UPLOAD_COMPLETE_WORKERS', 16))
+
+# threads running the blocking store I/O of async views, ie. store reads/writes in progress at once per process
+ASYNC_STORE_THREADS = int(os.environ.get('ASYNC_STORE_THREADS', 64))
+
+# ZipStore: size after which a new segment file is started, and the share of dead (deleted or
+# overwritten) bytes from which compact_zipstores rewrites a segment
+ZIPSTORE_SEGMENT_BYTES = int(os.environ.get('ZIPSTORE_SEGMENT_BYTES', 256*1024*1024))
+ZIPSTORE_COMPACT_RATIO = float(os.environ.get('ZIPSTORE_COMPACT_RATIO', 0.5))
+
+# local disk cache of stored objects, for StoreConfigs with read_cache set (mediastore.readcache).
+# Least recently read objects are evicted past READ_CACHE_MAX_BYTES
+READ_CACHE_DIR = os.environ.get('READ_CACHE_DIR', '/tmp/mediastore_readcache')
+READ_CACHE_MAX_BYTES = int(os.environ.get('READ_CACHE_MAX_BYTES', 10*1024*1024*1024))
+
+# DictStore objects are held in memory, at most RAM_STORE_MAX_BYTES per process, least recently used evicted first,
+# and expire after RAM_STORE_TTL seconds if set. With RAM_STORE_SHARED_LOCATION, a memcached (eg. unix:/run/memcached.sock)
+# or redis (redis://...) address, they are kept there instead and shared by all workers using it (needs pymemcache or redis installed)
+RAM_STORE_MAX_BYTES = int(os.environ.get('RAM_STORE_MAX_BYTES', 512*1024*1024))
+RAM_STORE_TTL = int(os.environ.get('RAM_STORE_TTL', 0))
+if RAM_STORE_SHARED_LOCATION := os.environ.get('RAM_STORE_SHARED_LOCATION'):
+    CACHES['ramstore'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache' if RAM_STORE_SHARED_LOCATION.startswith('redis')
+                   else 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': RAM_STORE_SHARED_LOCATION,
+        'TIMEOUT': RAM_STORE_TTL or None,
+    }
+
+# Tiering (run_tiering): concurrent copies, their combined bytes/s (0 is unthrottled),
+# and how often, at most, a download updates Media.last_accessed (seconds)
+TIERING_WORKERS = int(os.environ.get('TIERING_WORKERS', 4))
+TIERING_BANDWIDTH = int(os.environ.get('TIERING_BANDWIDTH', 50*1024*1024))
+TIERING_ACCESS_RESOLUTION = int(os.environ.get('TIERING_ACCESS_RESOLUTION', 3600))
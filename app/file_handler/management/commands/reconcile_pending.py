@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from file_handler.services import UploadService
+
+class Command(BaseCommand):
+    help = "Marks READY the PENDING media whose object is found in their store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Media checked per batch")
+        parser.add_argument('--workers', type=int, default=None, help="Concurrent store checks. Default is UPLOAD_COMPLETE_WORKERS")
+
+    def handle(self, *args, **options):
+        checked = readied = 0
+        for batch_checked, batch_readied in UploadService.reconcile_pending(options['batch_size'], options['workers']):
+            checked, readied = checked+batch_checked, readied+batch_readied
+            self.stdout.write(f'{readied}/{checked} pending media found stored')
+        self.stdout.write(f'done: {readied} of {checked} pending media marked READY')
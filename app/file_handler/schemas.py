@@ -0,0 +1,37 @@
+from typing import List, Optional, Literal
+from ninja import Schema
+
+from schemas.mediastore import MediaSchemaCreate
+from mediastore.schemas import MediaSearchQuerySchema
+
+
+class ArchiveRequestSchema(Schema):
+    pids: List[str] = []
+    search: Optional[MediaSearchQuerySchema] = None  # media matching this query are archived too
+    format: Literal['zip', 'tar'] = 'zip'
+
+
+class PresignedUploadRequestSchema(Schema):
+    mediadata: MediaSchemaCreate
+    size: Optional[int] = None  # bytes. Above PRESIGNED_MULTIPART_THRESHOLD, part urls are issued instead of one PUT
+
+class PresignedUploadSchema(Schema):
+    pid: str
+    presigned_put: Optional[str] = None
+    upload_id: Optional[str] = None  # multipart uploads
+    part_size: Optional[int] = None
+    presigned_parts: List[str] = []  # PUT urls for parts 1..N, each part_size bytes but the last
+
+class UploadPartSchema(Schema):
+    PartNumber: int
+    ETag: str
+
+class MultipartCompleteSchema(Schema):
+    pid: str
+    upload_id: str
+    parts: List[UploadPartSchema]
+
+class UploadCompleteSchema(Schema):
+    pid: str
+    size: Optional[int] = None  # if given, the stored object must be this many bytes
+    etag: Optional[str] = None  # if given, the stored object must have this ETag, eg. as returned by the PUT
@@ -1,9 +1,33 @@
+import io
+import re
+import time
 import base64
+import json
+import hashlib
+import tarfile
+import zipfile
+from typing import List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from asgiref.sync import sync_to_async
+from simple_history.utils import bulk_update_with_history
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.http import parse_etags
+from ninja.errors import ValidationError
 
 from schemas.mediastore import UploadSchemaInput, UploadSchemaOutput, UploadError, \
-                                 DownloadSchemaInput, DownloadSchemaOutput
-from mediastore.services import MediaService
+                                 DownloadSchemaInput, DownloadSchemaOutput, MediaSchemaCreate, MediaErrorSchema, \
+                                 BulkUpdateResponseSchema
+from mediastore.services import MediaService, StoreService
 from mediastore.models import StoreConfig, S3Config, Media
+from mediastore import stores
+from mediastore.cache import media_cache
+from mediastore.readcache import read_cache
+from mediastore.stores import store_pool
+from file_handler.schemas import ArchiveRequestSchema, PresignedUploadRequestSchema, PresignedUploadSchema, \
+    MultipartCompleteSchema, UploadCompleteSchema
 
 def encode64(content:bytes) -> str:
     encoded = base64.b64encode(content)
@@ -13,6 +37,97 @@ def decode64(content:str) -> bytes:
     content = content.encode("ascii")
     return base64.b64decode(content)
 
+MAX_RANGES = 32
+
+def parse_byte_ranges(header: str, size: int):
+    """
+    Parses a "Range: bytes=..." header into a list of (start, length) tuples.
+    Returns None if the header is malformed (ie. serve the whole object),
+    raises ValueError if none of the ranges are satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    specs = spec.split(',')
+    if unit.strip() != 'bytes' or not spec or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for part in specs:
+        first, dash, last = part.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size-1
+            else:  # suffix range, ie last N bytes
+                start = max(size-int(last), 0)
+                end = size-1 if int(last) else -1
+        except ValueError:
+            return None
+        if start < 0 or (first and last and end < start):
+            return None
+        if start >= size or end < start:
+            continue
+        end = min(end, size-1)
+        ranges.append((start, end-start+1))
+    if not ranges:
+        raise ValueError(f'Range not satisfiable: {header}')
+    return ranges
+
+def none_match(header: str, etag: str) -> bool:
+    """
+    Whether an "If-None-Match" header fails for a present object of etag, ie. the client has it:
+    "*", or any of its comma separated etags equal to etag by weak comparison (W/ ignored).
+    """
+    etags = parse_etags(header or '')
+    if '*' in etags:
+        return True
+    strip_weak = lambda tag: tag.removeprefix('W/')
+    return etag is not None and strip_weak(etag) in map(strip_weak, etags)
+
+
+class ArchiveSink(io.RawIOBase):
+    # unseekable file object that zipfile/tarfile write into and the response generator drains
+    def __init__(self):
+        self.chunks, self.offset = [], 0
+    def writable(self):
+        return True
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.offset += len(b)
+        return len(b)
+    def tell(self):
+        return self.offset
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class PresignedUrlCache:
+    """
+    Presigned GET urls by (store_config, store_key, expiry), kept in the "media" cache.
+    A url is reused for PRESIGNED_URL_EXPIRY - PRESIGNED_URL_MIN_VALIDITY seconds, so it
+    has at least PRESIGNED_URL_MIN_VALIDITY seconds left whenever it is handed out.
+    The store_config part of the key is a fingerprint of its bucket and credentials, and a new
+    store_key is a new cache key, so a changed media or config never gets a stale url.
+    StoreConfig and S3Config edits also clear the media cache.
+    """
+    @staticmethod
+    def key(fingerprint: str, store_key: str, expiry: int) -> str:
+        return 'presigned:' + hashlib.sha256(f'{fingerprint}:{store_key}:{expiry}'.encode()).hexdigest()
+
+    @staticmethod
+    def get_many(store_config: StoreConfig, store_keys: list, expiry: int = None) -> dict:
+        """Returns {store_key: url} for store_keys of one BucketStore config, signing only the uncached ones"""
+        expiry = expiry or settings.PRESIGNED_URL_EXPIRY
+        fingerprint = store_pool.fingerprint(store_config)
+        keys = {store_key: PresignedUrlCache.key(fingerprint, store_key, expiry) for store_key in store_keys}
+        cached = media_cache.cache.get_many(list(keys.values()))
+        unsigned = [store_key for store_key,key in keys.items() if key not in cached]
+        signed = dict(zip(unsigned, stores.presigned_gets(store_config, unsigned, expiry))) if unsigned else {}
+        if signed and (ttl := expiry - settings.PRESIGNED_URL_MIN_VALIDITY) > 0:
+            media_cache.cache.set_many({keys[store_key]: url for store_key,url in signed.items()}, ttl)
+        return {store_key: cached.get(key) or signed[store_key] for store_key,key in keys.items()}
+
 
 class UploadService:
 
@@ -28,28 +143,294 @@ class UploadService:
     @staticmethod
     def upload_with_file(payload: UploadSchemaInput) -> UploadSchemaOutput:
         media = MediaService.create(payload.mediadata, as_schema=False)
-        if media.store_config.storage_is_context_managed:
-            with media.store_config.get_storage_store() as store:
-                store.put(media.store_key, bytearray(decode64(payload.base64)))
-        else:
-            store = media.store_config.get_storage_store()
-            store.put(media.store_key, bytearray(decode64(payload.base64)))
+        content = bytearray(decode64(payload.base64))
+        UploadService.set_stored(media, len(content), hashlib.sha256(content).hexdigest())
+        with stores.open_store(media.store_config) as store:
+            store.put(media.store_key, content)
 
         # set media object successful storage
         #MediaService.update_status(media.pid, status=StoreConfig.READY)
+        UploadService.save_stored([media])
+
+        return UploadSchemaOutput(status=media.store_status)
+
+    @staticmethod
+    def upload_stream(mediadata: MediaSchemaCreate, chunks) -> UploadSchemaOutput:
+        # chunks are written through to the store as they arrive, size and checksum computed on the way
+        media = MediaService.create(mediadata, as_schema=False)
+        UploadService.set_stored(media, *stores.write_chunks(media.store_config, media.store_key, chunks))
+        UploadService.save_stored([media])
+        return UploadSchemaOutput(status=media.store_status)
+
+    @staticmethod
+    def set_stored(media: Media, size: int, checksum: str):
+        # in a content-addressed store, the content's checksum is its store_key
+        media.size, media.checksum = size, checksum
+        if stores.is_content_addressed(media.store_config):
+            media.store_key = stores.content_key(checksum)
         media.store_status = StoreConfig.READY
-        media.save()
 
+    @staticmethod
+    def save_stored(medias: list) -> list:
+        """
+        Saves media after set_stored. A content-addressed object may have been removed since it was
+        written, by the delete of the last media pointing at it: under MediaService.lock_content,
+        those media are put back PENDING and returned, with a KeyError raised if it is the only one.
+        """
+        if not medias: return []
+        with transaction.atomic():
+            contents = sorted({(media.store_config_id, media.store_key) for media in medias
+                               if stores.is_content_addressed(media.store_config)})
+            for store_config_id, store_key in contents:
+                MediaService.lock_content(store_config_id, store_key)
+            if len(medias) == 1:
+                medias[0].save()
+            else:
+                bulk_update_with_history(medias, Media, ['store_status', 'size', 'checksum', 'store_key'])
+            lost = []
+            for media in medias:
+                if (media.store_config_id, media.store_key) in contents:
+                    with stores.open_store(media.store_config) as store:
+                        if not store.exists(media.store_key): lost.append(media)
+            if len(medias) == 1 and lost:
+                raise KeyError(f'{medias[0].pid}: its content was deleted while being stored, upload again')
+            if lost:
+                for media in lost:
+                    media.store_status = StoreConfig.PENDING
+                bulk_update_with_history(lost, Media, ['store_status'])
+        return lost
+
+    @staticmethod
+    async def aupload(payload: UploadSchemaInput) -> UploadSchemaOutput:
+        # async upload(). The ORM work runs in the sync thread, store I/O on the store io pool
+        if not payload.base64:
+            return await sync_to_async(UploadService.upload_sans_file)(payload)
+        return await UploadService.aupload_stream(payload.mediadata, [decode64(payload.base64)])
+
+    @staticmethod
+    async def aupload_stream(mediadata: MediaSchemaCreate, chunks) -> UploadSchemaOutput:
+        media = await sync_to_async(MediaService.create)(mediadata, as_schema=False)
+        UploadService.set_stored(media, *await stores.awrite_chunks(media.store_config, media.store_key, chunks))
+        await sync_to_async(UploadService.save_stored)([media])
         return UploadSchemaOutput(status=media.store_status)
 
+    @staticmethod
+    def parse_manifest(lines) -> tuple:
+        """
+        NDJSON manifest, one MediaSchemaCreate per line plus an optional "file" key naming
+        its archive member (default: the pid, as named by /download/archive). A line naming
+        the member of an earlier line fails. Returns (payloads, {member name: pid}, failures)
+        """
+        payloads, members, failures = [], {}, []
+        for n, line in enumerate(lines, 1):
+            if not line.strip(): continue
+            entry = {}
+            try:
+                entry = json.loads(line)
+                member = entry.pop('file', None)
+                payload = MediaSchemaCreate.model_validate(entry)
+                member = member or ArchiveService.arcname(payload.pid)
+                if member in members:
+                    raise ValueError(f'file "{member}" is already the file of {members[member]}')
+            except Exception as e:
+                pid = entry.get('pid') if isinstance(entry, dict) else None
+                failures.append( MediaErrorSchema(pid=pid or f'manifest line {n}', error=str(type(e)), msg=str(e)) )
+                continue
+            payloads.append(payload)
+            members[member] = payload.pid
+        return payloads, members, failures
+
+    @staticmethod
+    def iter_archive(archive):
+        """Yields (name, content) of the files in a zip or tar file object"""
+        if zipfile.is_zipfile(archive):
+            archive.seek(0)
+            with zipfile.ZipFile(archive) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir(): yield info.filename, zf.read(info)
+        else:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r|*') as tf:
+                for member in tf:
+                    if member.isfile(): yield member.name, tf.extractfile(member).read()
+
+    @staticmethod
+    def upload_bulk(manifest_lines, archive, workers: int = None, max_in_flight: int = None) -> BulkUpdateResponseSchema:
+        """
+        Creates the manifest's media in batches, then reads the archive once, handing each
+        member's bytes to a pool of UPLOAD_BULK_WORKERS threads writing to the stores, at
+        most UPLOAD_BULK_MAX_IN_FLIGHT members held at once. Stored media are marked READY
+        in one bulk update. Media whose file is missing or fails to store stay PENDING.
+        """
+        workers = workers or settings.UPLOAD_BULK_WORKERS
+        max_in_flight = max(max_in_flight or settings.UPLOAD_BULK_MAX_IN_FLIGHT, 1)
+        payloads, members, failures = UploadService.parse_manifest(manifest_lines)
+        created, create_failures = MediaService.bulk_create(payloads, partial=True)
+        failures.extend(create_failures)
+        medias = {media.pid: media for media in created}
+        stores.preload([media.store_config for media in created])
+
+        def store(media, content):
+            return stores.write_chunks(media.store_config, media.store_key, [content])
+
+        stored, in_flight = [], {}
+        def collect(done):
+            for future in done:
+                media = in_flight.pop(future)
+                if future.exception():
+                    failures.append( MediaErrorSchema(pid=media.pid, error=str(type(future.exception())), msg=str(future.exception())) )
+                    continue
+                UploadService.set_stored(media, *future.result())
+                stored.append(media)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+            for name, content in UploadService.iter_archive(archive):
+                media = medias.pop(members.get(name), None)
+                if media is None: continue  # not in manifest, or its media was not created
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[executor.submit(store, media, content)] = media
+            collect(wait(in_flight).done)
+
+        for media in medias.values():
+            failures.append( MediaErrorSchema(pid=media.pid, error=str(KeyError), msg='file not found in archive, media left PENDING') )
+        lost = UploadService.save_stored(stored)
+        for media in lost:
+            failures.append( MediaErrorSchema(pid=media.pid, error=str(KeyError), msg='content deleted while being stored, media left PENDING') )
+        media_cache.invalidate(*[media.pid for media in stored])
+        return BulkUpdateResponseSchema(successes=[media.pid for media in stored if media not in lost], failures=failures)
+
     @staticmethod
     def upload_sans_file(payload: UploadSchemaInput) -> UploadSchemaOutput:
         assert payload.mediadata.store_config.type == StoreConfig.BUCKETSTORE
         media = MediaService.create(payload.mediadata, as_schema=False)  # returns MediaSchema after creating database entry
-        with media.store_config.get_storage_store() as store:
+        with stores.open_store(media.store_config) as store:
             put_url = store.presigned_put(media.store_key)
         return UploadSchemaOutput(status=StoreConfig.PENDING, presigned_put=put_url)
 
+    @staticmethod
+    def upload_presigned(payloads: List[PresignedUploadRequestSchema], expiry: int = None) -> List[PresignedUploadSchema]:
+        """
+        Batch upload_sans_file: creates all media PENDING in one transaction (all or nothing) and
+        signs their PUT urls with one pooled client per StoreConfig. Media of size at least
+        PRESIGNED_MULTIPART_THRESHOLD get a started multipart upload and part urls instead,
+        to be finished with complete_multipart. S3 is only called once the media are committed;
+        if that fails, the started multipart uploads are aborted and the media deleted again.
+        """
+        expiry = expiry or settings.PRESIGNED_URL_EXPIRY
+        if bad := [p.mediadata.pid for p in payloads if p.mediadata.store_config.type != StoreConfig.BUCKETSTORE]:
+            raise ValidationError([dict(error=f'presigned uploads need a {StoreConfig.BUCKETSTORE}: {pid}') for pid in bad])
+        sizes = {p.mediadata.pid: p.size for p in payloads}
+        created, _ = MediaService.bulk_create([p.mediadata for p in payloads], partial=False)
+        started = []  # (media, upload_id), aborted if anything fails
+        try:
+            by_store_config = {}
+            for media in created:
+                by_store_config.setdefault(media.store_config_id, []).append(media)
+            uploads = {}
+            for group in by_store_config.values():
+                store_config = group[0].store_config
+                singles = [m for m in group if (sizes[m.pid] or 0) < settings.PRESIGNED_MULTIPART_THRESHOLD]
+                for media, url in zip(singles, stores.presigned_puts(store_config, [m.store_key for m in singles], expiry)):
+                    uploads[media.pid] = PresignedUploadSchema(pid=media.pid, presigned_put=url)
+                for media in group:
+                    if media.pid in uploads: continue
+                    upload_id, part_size, urls = stores.presigned_multipart(store_config, media.store_key, sizes[media.pid], expiry)
+                    started.append((media, upload_id))
+                    uploads[media.pid] = PresignedUploadSchema(pid=media.pid, upload_id=upload_id,
+                                                               part_size=part_size, presigned_parts=urls)
+        except Exception:
+            for media, upload_id in started:
+                try: media.store_config.get_s3_client().abort_multipart_upload(
+                        Bucket=media.store_config.bucket, Key=media.store_key, UploadId=upload_id)
+                except Exception: pass
+            Media.objects.filter(pk__in=[media.pk for media in created]).delete()
+            raise
+        return [uploads[p.mediadata.pid] for p in payloads]
+
+    @staticmethod
+    def complete_multipart(payloads: List[MultipartCompleteSchema]) -> BulkUpdateResponseSchema:
+        """Completes multipart uploads started by upload_presigned, then marks their media READY"""
+        def complete(media: Media, payload: MultipartCompleteSchema):
+            stores.s3_complete_multipart(media.store_config, media.store_key, payload.upload_id,
+                                         [dict(part) for part in payload.parts])
+            media.size, _ = stores.stat(media.store_config, media.store_key)
+            media.store_status = StoreConfig.READY
+        return MediaService.bulk_update(payloads, complete, ['store_status', 'size'])
+
+
+    @staticmethod
+    def stat_many(medias: list, workers: int = None) -> dict:
+        """stores.stat of many media concurrently (HEAD requests for s3). Returns {pid: (size, etag) or exception}"""
+        workers = workers or settings.UPLOAD_COMPLETE_WORKERS
+        if not medias: return {}
+        stores.preload([media.store_config for media in medias])
+        def stat(media):
+            try: return stores.stat(media.store_config, media.store_key)
+            except Exception as e: return e
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stat') as executor:
+            return dict(zip([media.pid for media in medias], executor.map(stat, medias)))
+
+    @staticmethod
+    def mark_ready(medias: list):
+        bulk_update_with_history(medias, Media, ['store_status', 'size'])
+        media_cache.invalidate(*[media.pid for media in medias])
+
+    @staticmethod
+    def complete(payloads: List[UploadCompleteSchema]) -> BulkUpdateResponseSchema:
+        """
+        Marks presigned uploads done: every stored object is checked concurrently for
+        existence, and size and ETag if given, then all verified media become READY in one
+        bulk update. Media already READY count as successes.
+        """
+        medias = Media.objects.select_related('store_config__s3cfg').in_bulk([p.pid for p in payloads], field_name='pid')
+        pending = [media for media in medias.values() if media.store_status != StoreConfig.READY]
+        stats = UploadService.stat_many(pending)
+
+        successes, failures, ready = [], [], []
+        for payload in payloads:
+            try:
+                if payload.pid not in medias:
+                    raise Media.DoesNotExist('Media matching query does not exist.')
+                media = medias[payload.pid]
+                if media.store_status == StoreConfig.READY:
+                    successes.append(payload.pid)
+                    continue
+                if isinstance(stat := stats[payload.pid], Exception):
+                    raise stat
+                size, etag = stat
+                if payload.size is not None and payload.size != size:
+                    raise ValueError(f'stored object is {size} bytes, expected {payload.size}')
+                if payload.etag and etag and payload.etag.strip('"') != etag.strip('"'):
+                    raise ValueError(f'stored object ETag is {etag}, expected {payload.etag}')
+            except Exception as e:
+                failures.append( MediaErrorSchema(pid=payload.pid, error=str(type(e)), msg=str(e)) )
+                continue
+            media.size, media.store_status = size, StoreConfig.READY
+            ready.append(media)
+            successes.append(payload.pid)
+        UploadService.mark_ready(ready)
+        return BulkUpdateResponseSchema(successes=successes, failures=failures)
+
+    @staticmethod
+    def reconcile_pending(batch_size: int = 500, workers: int = None):
+        """Sweeps PENDING media in batches, marking READY those whose object is in the store. Yields (checked, readied) per batch"""
+        last_pk = 0
+        while True:
+            batch = list(Media.objects.select_related('store_config__s3cfg')
+                         .filter(store_status=StoreConfig.PENDING, pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch: return
+            last_pk = batch[-1].pk
+            stats = UploadService.stat_many(batch, workers)
+            ready = []
+            for media in batch:
+                if not isinstance(stat := stats[media.pid], Exception):
+                    media.size, media.store_status = stat[0], StoreConfig.READY
+                    ready.append(media)
+            UploadService.mark_ready(ready)
+            yield len(batch), len(ready)
+
 
 class DownloadService:
 
@@ -63,22 +444,232 @@ class DownloadService:
 
     @staticmethod
     def download_direct(payload: DownloadSchemaInput) -> DownloadSchemaOutput:
-        media = Media.objects.get(pid=payload.pid)
-        if media.store_config.storage_is_context_managed:
-            with media.store_config.get_storage_store() as store:
-                obj_content = store.get(media.store_key)
-        else:
-            store = media.store_config.get_storage_store()
-            obj_content = store.get(media.store_key)
+        media = media_cache.get(payload.pid)
+        obj_content = read_cache.get(media)
+        MediaService.touch(media)
 
         # converting obj_content bytes to base64
         b64_content = encode64(obj_content)
         return DownloadSchemaOutput(mediadata=MediaService.serialize(media), base64=b64_content)
 
+    @staticmethod
+    def download_stat(pid: str):
+        media = media_cache.get(pid)
+        size, etag = read_cache.stat(media) or stores.stat(media.store_config, media.store_key)
+        MediaService.touch(media)
+        return media, size, DownloadService.etag(media, etag)
+
+    @staticmethod
+    async def adownload_stat(pid: str):
+        media = await media_cache.aget(pid)
+        size, etag = read_cache.stat(media) or await stores.astat(media.store_config, media.store_key)
+        if MediaService.access_stale(media) and await media_cache.amark_accessed(media.pid, settings.TIERING_ACCESS_RESOLUTION):
+            await sync_to_async(MediaService.record_access)(media)
+        return media, size, DownloadService.etag(media, etag)
+
+    @staticmethod
+    def etag(media: Media, store_etag: str):
+        # one validator per object, whether the read cache or the store answered
+        if read_cache.enabled(media): return read_cache.etag(media)
+        if store_etag is None and media.checksum: return f'"{media.checksum}"'
+        return store_etag
+
+    @staticmethod
+    async def adownload(payload: DownloadSchemaInput) -> DownloadSchemaOutput:
+        if not payload.direct:
+            return await sync_to_async(DownloadService.download_link)(payload)
+        media = await media_cache.aget(payload.pid)
+        content = b''.join([chunk async for chunk in read_cache.aiter_chunks(media)])
+        if MediaService.access_stale(media) and await media_cache.amark_accessed(media.pid, settings.TIERING_ACCESS_RESOLUTION):
+            await sync_to_async(MediaService.record_access)(media)
+        return DownloadSchemaOutput(mediadata=MediaService.serialize(media), base64=encode64(content))
+
+    @staticmethod
+    def iter_content(media: Media, start: int = 0, length: int = None, chunk_size: int = stores.CHUNK_SIZE):
+        # raw bytes are never held whole, chunks are read from the store as the response is consumed
+        return read_cache.iter_chunks(media, chunk_size, start=start, length=length)
+
+    @staticmethod
+    async def aiter_content(media: Media, start: int = 0, length: int = None, chunk_size: int = stores.CHUNK_SIZE):
+        async for chunk in read_cache.aiter_chunks(media, chunk_size, start=start, length=length):
+            yield chunk
+
+    @staticmethod
+    def byterange_parts(ranges: list, size: int, boundary: str, content_type: str):
+        # multipart/byteranges framing. Returns (content_length, part headers, closing delimiter)
+        part_headers = [f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                        f'Content-Range: bytes {start}-{start+length-1}/{size}\r\n\r\n'.encode('ascii')
+                        for start,length in ranges]
+        closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        content_length = sum(len(h) for h in part_headers) + sum(l for _,l in ranges) + 2*(len(ranges)-1) + len(closing)
+        return content_length, part_headers, closing
+
+    @staticmethod
+    def iter_byteranges(media: Media, ranges: list, size: int, boundary: str, content_type: str):
+        # multipart/byteranges body for multi-range requests. Returns (content_length, chunks)
+        content_length, part_headers, closing = DownloadService.byterange_parts(ranges, size, boundary, content_type)
+        def chunks():
+            for i, ((start, length), header) in enumerate(zip(ranges, part_headers)):
+                if i: yield b'\r\n'
+                yield header
+                yield from DownloadService.iter_content(media, start, length)
+            yield closing
+        return content_length, chunks()
+
+    @staticmethod
+    def aiter_byteranges(media: Media, ranges: list, size: int, boundary: str, content_type: str):
+        content_length, part_headers, closing = DownloadService.byterange_parts(ranges, size, boundary, content_type)
+        async def chunks():
+            for i, ((start, length), header) in enumerate(zip(ranges, part_headers)):
+                if i: yield b'\r\n'
+                yield header
+                async for chunk in DownloadService.aiter_content(media, start, length):
+                    yield chunk
+            yield closing
+        return content_length, chunks()
+
+    @staticmethod
+    def media_headers(media: Media) -> dict:
+        # mediadata normally carried by DownloadSchemaOutput, for raw responses
+        mediadata = MediaService.serialize(media)
+        return {
+            'X-Media-Pid': mediadata.pid,
+            'X-Media-Pid-Type': mediadata.pid_type,
+            'X-Media-Store-Status': mediadata.store_status,
+            'X-Media-Identifiers': json.dumps(mediadata.identifiers),
+            'X-Media-Metadata': json.dumps(mediadata.metadata),
+            'X-Media-Tags': json.dumps(mediadata.tags),
+        }
+
     @staticmethod
     def download_link(payload: DownloadSchemaInput) -> DownloadSchemaOutput:
-        media = Media.objects.get(pid=payload.pid)
+        media = media_cache.get(payload.pid)
         assert media.store_config.type == StoreConfig.BUCKETSTORE
-        with media.store_config.get_storage_store() as store:
-            get_url = store.presigned_get(media.store_key)
+        get_url = PresignedUrlCache.get_many(media.store_config, [media.store_key])[media.store_key]
         return DownloadSchemaOutput(mediadata=MediaService.serialize(media), presigned_get=get_url)
+
+    @staticmethod
+    def download_links(pids: list) -> list:
+        """
+        download_link for many pids: one query for all media, and per StoreConfig one cache
+        lookup and one signer for the urls not cached. Returns a DownloadSchemaOutput or
+        MediaErrorSchema per pid, in order.
+        """
+        medias = MediaService.queryset().in_bulk(pids, field_name='pid')
+        by_store_config = {}
+        for media in medias.values():
+            by_store_config.setdefault(media.store_config_id, []).append(media)
+
+        urls, errors = {}, {}
+        for group in by_store_config.values():
+            store_config = group[0].store_config
+            try:
+                assert store_config.type == StoreConfig.BUCKETSTORE, f'{store_config.type} has no presigned urls'
+                signed = PresignedUrlCache.get_many(store_config, [media.store_key for media in group])
+                urls.update({media.pid: signed[media.store_key] for media in group})
+            except Exception as e:
+                errors.update({media.pid: e for media in group})
+
+        responses, store_config_schemas = [], {}
+        for pid in pids:
+            if pid not in medias:
+                e = Media.DoesNotExist('Media matching query does not exist.')
+                responses.append( MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e)) )
+            elif pid in errors:
+                responses.append( MediaErrorSchema(pid=pid, error=str(type(errors[pid])), msg=str(errors[pid])) )
+            else:
+                media = medias[pid]
+                if media.store_config_id not in store_config_schemas:
+                    store_config_schemas[media.store_config_id] = StoreService.serialize(media.store_config)
+                mediadata = MediaService.serialize(media, store_config_schemas[media.store_config_id])
+                responses.append( DownloadSchemaOutput(mediadata=mediadata, presigned_get=urls[pid]) )
+        return responses
+
+
+class ArchiveService:
+    """
+    Streams the content of many media as one zip or tar archive. Objects are read
+    from their stores by ARCHIVE_FETCH_WORKERS threads, at most ARCHIVE_MAX_IN_FLIGHT
+    objects fetched or held at once, and each is written to the archive as soon as
+    it arrives. A manifest.json of archived and failed pids closes the archive.
+    """
+    CONTENT_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+
+    @staticmethod
+    def medias(payload: ArchiveRequestSchema) -> list:
+        medias = MediaService.queryset().in_bulk(payload.pids, field_name='pid')
+        if payload.search:
+            medias.update({media.pid: media for media in MediaService.search_queryset(payload.search)})
+        return list(medias.values())
+
+    @staticmethod
+    def arcname(pid: str) -> str:
+        return re.sub(r'[^\w.\-]', '_', pid)
+
+    @staticmethod
+    def arcnames(medias: list) -> dict:
+        """{pid: arcname}, pids whose arcnames collide suffixed with ~1, ~2.. in order, which no arcname contains"""
+        names, taken = {}, {'manifest.json'}
+        for media in medias:
+            name = base = ArchiveService.arcname(media.pid)
+            n = 0
+            while name in taken:
+                n += 1
+                name = f'{base}~{n}'
+            names[media.pid] = name
+            taken.add(name)
+        return names
+
+    @staticmethod
+    def fetch(media: Media) -> bytes:
+        if media.store_status != StoreConfig.READY:
+            raise KeyError(f'{media.pid} is {media.store_status}')
+        return b''.join(read_cache.iter_chunks(media))
+
+    @staticmethod
+    def iter_fetched(medias: list, workers: int = None, max_in_flight: int = None):
+        """Yields (media, content or exception) in completion order"""
+        workers = workers or settings.ARCHIVE_FETCH_WORKERS
+        max_in_flight = max(max_in_flight or settings.ARCHIVE_MAX_IN_FLIGHT, 1)
+        pending, in_flight = iter(medias), {}
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive')
+        try:
+            while True:
+                while len(in_flight) < max_in_flight and (media := next(pending, None)) is not None:
+                    in_flight[executor.submit(ArchiveService.fetch, media)] = media
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    media = in_flight.pop(future)
+                    yield media, future.exception() or future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def stream(medias: list, format: str = 'zip'):
+        """Yields the archive's bytes"""
+        sink = ArchiveSink()
+        archive = zipfile.ZipFile(sink, 'w') if format == 'zip' else tarfile.open(fileobj=sink, mode='w|')
+        manifest = dict(archived={}, failed={})
+        names = ArchiveService.arcnames(medias)
+        def add(name: str, content: bytes):
+            if format == 'zip':
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                archive.writestr(info, content)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime = len(content), time.time()
+                archive.addfile(info, io.BytesIO(content))
+
+        with archive:
+            for media, content in ArchiveService.iter_fetched(medias):
+                if isinstance(content, Exception):
+                    manifest['failed'][media.pid] = f'{type(content)}: {content}'
+                    continue
+                name = names[media.pid]
+                add(name, content)
+                manifest['archived'][media.pid] = name
+                yield from sink.drain()
+            add('manifest.json', json.dumps(manifest, indent=2).encode())
+        yield from sink.drain()
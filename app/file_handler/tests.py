@@ -1,13 +1,17 @@
+import io
 import os
 import base64
+import hashlib
 import uuid
 import json
+import shutil
+import tempfile
 from unittest import skipIf, skipUnless
 
 os.environ["NINJA_SKIP_REGISTRY"] = "yes"
 
-from django.test import TestCase
-from ninja.testing import TestClient
+from django.test import TestCase, Client, override_settings
+from ninja.testing import TestClient, TestAsyncClient
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.authtoken.models import Token
@@ -18,6 +22,7 @@ except ImportError: requests=None
 from config.api import api
 
 from mediastore.models import Media, IdentifierType, StoreConfig, S3Config
+from mediastore.cache import media_cache
 from schemas.mediastore import MediaSchemaCreate, StoreConfigSchemaCreate, S3ConfigSchemaCreate
 from schemas.mediastore import UploadSchemaInput, DownloadSchemaInput
 
@@ -63,6 +68,93 @@ class FileHandlerFilestoreTests(TestCase):
         downloaded_content = decode64( data['base64'] )
         self.assertEqual(downloaded_content, upload_content)
 
+    def test_updown_raw(self):
+        PID = 'test_updown_raw'
+        mediadata = dict(MediaSchemaCreate(
+            pid = PID, pid_type = 'DEMO',
+            store_config = self.storeconfig_dict))
+        upload_content = b'egg salad sand witch'
+        payload = dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content)))
+        resp = self.client.post("/upload", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        # DOWNLOAD RAW
+        resp = self.client.get(f"/download/raw/{PID}")
+        self.assertEqual(resp.status_code, 200, msg=resp.content)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp.content, upload_content)
+        self.assertEqual(int(resp['Content-Length']), len(upload_content))
+        self.assertEqual(resp['X-Media-Pid'], PID)
+        self.assertEqual(resp['X-Media-Store-Status'], StoreConfig.READY)
+        self.assertEqual(json.loads(resp['X-Media-Metadata']), {})
+
+        # CONDITIONAL RE-DOWNLOAD
+        etag = resp['ETag']
+        for if_none_match in [etag, f'"other", {etag}', f'W/{etag}', '*']:
+            resp = self.client.get(f"/download/raw/{PID}", headers={'If-None-Match': if_none_match})
+            self.assertEqual(resp.status_code, 304, msg=if_none_match)
+        resp = self.client.get(f"/download/raw/{PID}", headers={'If-None-Match': '"other", W/"another"'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_download_raw_ranges(self):
+        PID = 'test_download_raw_ranges'
+        mediadata = dict(MediaSchemaCreate(
+            pid = PID, pid_type = 'DEMO',
+            store_config = self.storeconfig_dict))
+        upload_content = b'egg salad sand witch'
+        payload = dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content)))
+        resp = self.client.post("/upload", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=4-8'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.content, b'salad')
+        self.assertEqual(resp['Content-Range'], f'bytes 4-8/{len(upload_content)}')
+
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=-5'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.content, b'witch')
+
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=0-2,15-'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertTrue(resp['Content-Type'].startswith('multipart/byteranges'))
+        self.assertEqual(int(resp['Content-Length']), len(resp.content))
+        self.assertIn(b'egg', resp.content)
+        self.assertIn(b'witch', resp.content)
+
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=100-'})
+        self.assertEqual(resp.status_code, 416)
+
+    def test_upload_stream_multipart(self):
+        PID = 'test_upload_stream_multipart'
+        mediadata = MediaSchemaCreate(pid=PID, pid_type='DEMO', store_config=self.storeconfig_dict)
+        upload_content = b'egg salad sand witch'
+        resp = self.client.post("/upload/stream",
+                                data={'mediadata': mediadata.model_dump_json()},
+                                FILES={'file': SimpleUploadedFile('egg.txt', upload_content)})
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['status'], StoreConfig.READY)
+
+        media = Media.objects.get(pid=PID)
+        self.assertEqual(media.size, len(upload_content))
+        self.assertEqual(media.checksum, hashlib.sha256(upload_content).hexdigest())
+
+        resp = self.client.get(f"/download/raw/{PID}")
+        self.assertEqual(resp.content, upload_content)
+
+    def test_upload_stream_octetstream(self):
+        PID = 'test_upload_stream_octetstream'
+        mediadata = MediaSchemaCreate(pid=PID, pid_type='DEMO', store_config=self.storeconfig_dict)
+        upload_content = b'egg salad sand witch'
+        client = Client(headers=self.auth_headers)
+        resp = client.post("/api/upload/stream", data=upload_content, content_type='application/octet-stream',
+                           headers={'X-Mediadata': mediadata.model_dump_json()})
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        media = Media.objects.get(pid=PID)
+        self.assertEqual(media.store_status, StoreConfig.READY)
+        self.assertEqual(media.size, len(upload_content))
+
 
 @skipUnless(os.environ.get('TESTS_S3_URL'), '"TESTS_S3_URL" env variable set')
 class FileHandlerS3storeTests(TestCase):
@@ -162,6 +254,159 @@ class FileHandlerDictstoreTests(TestCase):
         FileHandlerFilestoreTests.setUp(self)
         self.storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.DICTSTORE, bucket='/demobucket'))
 
+    def test_updown_RAM_raw(self):
+        PID = 'test_updown_RAM_raw'
+        mediadata = dict(MediaSchemaCreate(
+            pid = PID, pid_type = 'DEMO',
+            store_config = self.storeconfig_dict))
+        upload_content = b'egg salad sand witch'
+        payload = dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content)))
+        resp = self.client.post("/upload", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        resp = self.client.get(f"/download/raw/{PID}")
+        self.assertEqual(resp.status_code, 200, msg=resp.content)
+        self.assertEqual(resp.content, upload_content)
+        self.assertEqual(int(resp['Content-Length']), len(upload_content))
+
+    def test_download_archive(self):
+        import io, zipfile, tarfile
+        contents = {f'test_download_archive_{i}': f'egg salad sand witch {i}'.encode()*(i+1) for i in range(4)}
+        for pid, content in contents.items():
+            mediadata = dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict,
+                                               tags=['ARCHIVE'] if pid.endswith(('2','3')) else []))
+            resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(content))))
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        resp = self.client.post("/media", json=dict(MediaSchemaCreate(pid='test_download_archive_pending', pid_type='DEMO',
+                                                                      store_config=self.storeconfig_dict)))
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        payload = dict(pids=['test_download_archive_0', 'test_download_archive_1', 'test_download_archive_pending'],
+                       search=dict(tags=['ARCHIVE']))
+        resp = self.client.post("/download/archive", json=payload)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(resp.content)) as archive:
+            self.assertEqual({pid: archive.read(pid) for pid in contents}, contents)
+            manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual(sorted(manifest['archived']), sorted(contents))
+        self.assertEqual(list(manifest['failed']), ['test_download_archive_pending'])
+
+        resp = self.client.post("/download/archive", json=dict(pids=list(contents), format='tar'))
+        self.assertEqual(resp['Content-Type'], 'application/x-tar')
+        with tarfile.open(fileobj=io.BytesIO(resp.content)) as archive:
+            self.assertEqual({pid: archive.extractfile(pid).read() for pid in contents}, contents)
+
+        # pids with the same arcname get distinct entries
+        colliding = {'test_download_archive/x': b'egg', 'test_download_archive:x': b'ham'}
+        for pid, content in colliding.items():
+            mediadata = dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict))
+            resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(content))))
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        resp = self.client.post("/download/archive", json=dict(pids=list(colliding)))
+        with zipfile.ZipFile(io.BytesIO(resp.content)) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+            self.assertEqual(sorted(manifest['archived'].values()), ['test_download_archive_x', 'test_download_archive_x~1'])
+            self.assertEqual({pid: archive.read(name) for pid, name in manifest['archived'].items()}, colliding)
+            self.assertEqual(len(archive.namelist()), 3)
+
+    def test_upload_bulk(self):
+        import io, zipfile, tarfile
+        contents = {f'test_upload_bulk_{i}': f'egg salad sand witch {i}'.encode() for i in range(3)}
+        manifest = [json.dumps(dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict, tags=['BULK'])))
+                    for pid in contents]
+        manifest[2] = json.dumps(dict(json.loads(manifest[2]), file='renamed/egg.txt'))
+        manifest.append(json.dumps(dict(MediaSchemaCreate(pid='test_upload_bulk_nofile', pid_type='DEMO', store_config=self.storeconfig_dict))))
+        manifest.append(json.dumps(dict(pid='test_upload_bulk_bad', pid_type='NOPE', store_config=self.storeconfig_dict)))
+        manifest.append('{not json')
+        manifest.append(json.dumps(dict(MediaSchemaCreate(pid='test_upload_bulk_dupe', pid_type='DEMO', store_config=self.storeconfig_dict),
+                                        file='renamed/egg.txt')))
+        manifest = '\n'.join(manifest).encode()
+
+        for format in ['zip', 'tar']:
+            buffer = io.BytesIO()
+            names = ['test_upload_bulk_0', 'test_upload_bulk_1', 'renamed/egg.txt', 'stray.txt']
+            if format == 'zip':
+                with zipfile.ZipFile(buffer, 'w') as archive:
+                    for name, content in zip(names, [*contents.values(), b'stray']): archive.writestr(name, content)
+            else:
+                with tarfile.open(fileobj=buffer, mode='w') as archive:
+                    for name, content in zip(names, [*contents.values(), b'stray']):
+                        info = tarfile.TarInfo(name)
+                        info.size = len(content)
+                        archive.addfile(info, io.BytesIO(content))
+            Media.objects.all().delete()
+            resp = self.client.post("/upload/bulk", FILES={'manifest': SimpleUploadedFile('manifest.ndjson', manifest),
+                                                           'archive': SimpleUploadedFile(f'media.{format}', buffer.getvalue())})
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            received = resp.json()
+            self.assertEqual(sorted(received['successes']), sorted(contents))
+            self.assertEqual(sorted(f['pid'] for f in received['failures']),
+                             ['manifest line 6', 'test_upload_bulk_bad', 'test_upload_bulk_dupe', 'test_upload_bulk_nofile'])
+            self.assertFalse(Media.objects.filter(pid='test_upload_bulk_dupe').exists())  # its file is another's
+
+            for pid, content in contents.items():
+                resp = self.client.get(f"/download/raw/{pid}")
+                self.assertEqual(resp.content, content)
+                media = Media.objects.get(pid=pid)
+                self.assertEqual((media.store_status, media.size), (StoreConfig.READY, len(content)))
+            self.assertEqual(Media.objects.get(pid='test_upload_bulk_nofile').store_status, StoreConfig.PENDING)
+
+    def test_upload_complete_and_reconcile(self):
+        from django.core.management import call_command
+        from mediastore.stores import open_store
+        pids = [f'test_upload_complete_{i}' for i in range(4)]
+        resp = self.client.post("/media/create", json=[dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict))
+                                                       for pid in pids])
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        medias = {pid: Media.objects.get(pid=pid) for pid in pids}
+        with open_store(medias[pids[0]].store_config) as store:  # as a client PUT to a presigned url would
+            for pid in pids[:2]:
+                store.put(medias[pid].store_key, b'egg salad sand witch')
+
+        payload = [dict(pid=pids[0], size=20), dict(pid=pids[1], size=21), dict(pid=pids[2]), dict(pid='nope')]
+        resp = self.client.post("/upload/complete", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['successes'], [pids[0]])
+        self.assertEqual([f['pid'] for f in resp.json()['failures']], [pids[1], pids[2], 'nope'])
+        self.assertEqual((Media.objects.get(pid=pids[0]).store_status, Media.objects.get(pid=pids[0]).size), (StoreConfig.READY, 20))
+        resp = self.client.post("/upload/complete", json=[dict(pid=pids[0])])  # idempotent
+        self.assertEqual(resp.json()['successes'], [pids[0]])
+
+        with open_store(medias[pids[0]].store_config) as store:
+            store.put(medias[pids[2]].store_key, b'egg')
+        call_command('reconcile_pending', batch_size=2, stdout=io.StringIO())
+        statuses = dict(Media.objects.filter(pid__in=pids).values_list('pid', 'store_status'))
+        self.assertEqual(statuses, {pids[0]:StoreConfig.READY, pids[1]:StoreConfig.READY, pids[2]:StoreConfig.READY, pids[3]:StoreConfig.PENDING})
+
+    async def test_updown_RAM_async(self):
+        PID = 'test_updown_RAM_async'
+        client = TestAsyncClient(api, headers=self.auth_headers)
+        mediadata = dict(MediaSchemaCreate(pid=PID, pid_type='DEMO', store_config=self.storeconfig_dict))
+        upload_content = b'egg salad sand witch'
+        payload = dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content)))
+        resp = await client.post("/async/upload", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['status'], StoreConfig.READY)
+
+        resp = await client.get(f"/async/download/{PID}")
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(decode64(resp.json()['base64']), upload_content)
+
+        resp = await client.get(f"/async/download/raw/{PID}")
+        self.assertEqual(resp.content, upload_content)
+        self.assertEqual(resp['X-Media-Pid'], PID)
+        resp = await client.get(f"/async/download/raw/{PID}", headers={'Range': 'bytes=0-2,-5'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertIn(b'egg', resp.content)
+        self.assertIn(b'witch', resp.content)
+
+        resp = await client.get(f"/async/media/{PID}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['pid'], PID)
+        resp = await client.get("/async/download/nope")
+        self.assertEqual(resp.status_code, 401)
+
     def test_updown_RAM(self):
         PID = 'test_updown_RAM'
         mediadata = dict(MediaSchemaCreate(
@@ -185,6 +430,256 @@ class FileHandlerDictstoreTests(TestCase):
         downloaded_content = decode64( data['base64'] )
         self.assertEqual(downloaded_content, upload_content)
 
+    def test_RAM_bounded(self):
+        from mediastore.stores import ram_storage
+        storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.DICTSTORE, bucket='/test_RAM_bounded'))
+        with override_settings(RAM_STORE_MAX_BYTES=50):
+            for i in range(3):
+                mediadata = dict(MediaSchemaCreate(pid=f'test_RAM_bounded_{i}', pid_type='DEMO', store_config=storeconfig_dict))
+                payload = dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(f'egg salad sandwich {i}'.encode())))
+                resp = self.client.post("/upload", json=payload)
+                self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            resp = self.client.get("/cache/ram/stats")
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['namespaces']['/test_RAM_bounded'], dict(objects=2, bytes=40))
+        self.assertLessEqual(resp.json()['bytes'], 50)
+        self.assertGreaterEqual(resp.json()['evictions'], 1)
+
+        resp = self.client.get("/download/raw/test_RAM_bounded_2")
+        self.assertEqual(resp.content, b'egg salad sandwich 2')
+        resp = self.client.get("/download/raw/test_RAM_bounded_0")
+        self.assertNotEqual(resp.status_code, 200)  # least recently used, evicted
+        ram_storage.clear('/test_RAM_bounded')
+
+    def test_RAM_shared(self):
+        from unittest import mock
+        from django.conf import settings
+        from mediastore.stores import ram_storage
+        CACHES = dict(settings.CACHES, ramstore={'BACKEND':'django.core.cache.backends.locmem.LocMemCache', 'LOCATION':'test_RAM_shared'})
+        with override_settings(CACHES=CACHES, RAM_STORE_MAX_BYTES=50):
+            ram_storage.put('/a', 'egg', b'salad')
+            ram_storage.put('/b', 'egg', b'sandwich')
+            with self.assertRaises(ValueError):
+                ram_storage.put('/a', 'big', b'x'*51)
+            with mock.patch('django.core.cache.backends.locmem.LocMemCache.set_many', return_value=['refused']):
+                with self.assertRaises(ValueError):
+                    ram_storage.put('/a', 'refused', b'x')
+
+            ram_storage.clear('/a')  # through the shared backend
+            with self.assertRaises(KeyError):
+                ram_storage.get('/a', 'egg')
+            self.assertEqual(ram_storage.get('/b', 'egg'), b'sandwich')
+            ram_storage.put('/a', 'egg', b'again')
+            self.assertEqual(ram_storage.get('/a', 'egg'), b'again')
+            ram_storage.clear()
+
+
+class TempRootMixin:
+    # FileHandlerFilestoreTests fixtures plus a temporary directory self.root, removed after each test.
+    # root_settings are settings overridden with paths under it, eg. dict(READ_CACHE_DIR='cache')
+    root_settings = {}
+
+    def setUp(self):
+        FileHandlerFilestoreTests.setUp(self)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        if self.root_settings:
+            settings_override = override_settings(**{name: os.path.join(self.root, path) for name, path in self.root_settings.items()})
+            settings_override.enable()
+            self.addCleanup(settings_override.disable)
+
+
+class FileHandlerHashdirstoreTests(TempRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.HASHDIRSTORE, bucket=self.root))
+
+    def test_dedupe_refcount(self):
+        from mediastore.services import MediaService
+        upload_content = b'egg salad sand witch'
+        checksum = hashlib.sha256(upload_content).hexdigest()
+        pids = ['test_hashdir_0', 'test_hashdir_1', 'test_hashdir_2']
+        for pid in pids[:2]:
+            mediadata = dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict))
+            resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content))))
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        mediadata = MediaSchemaCreate(pid=pids[2], pid_type='DEMO', store_config=self.storeconfig_dict)
+        resp = self.client.post("/upload/stream", data={'mediadata': mediadata.model_dump_json()},
+                                FILES={'file': SimpleUploadedFile('egg.txt', upload_content)})
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        store_keys = set(Media.objects.filter(pid__in=pids).values_list('store_key', flat=True))
+        self.assertEqual(store_keys, {f'sha256:{checksum}'})
+        path = os.path.join(self.root, checksum[:2], checksum[2:4], checksum)
+        stored_files = [f for _,_,files in os.walk(self.root) for f in files]
+        self.assertEqual(stored_files, [checksum])
+
+        for pid in pids:
+            resp = self.client.get(f"/download/raw/{pid}")
+            self.assertEqual(resp.content, upload_content)
+
+        MediaService.delete(pids[0])
+        MediaService.delete(pids[1])
+        self.assertTrue(os.path.exists(path))
+        resp = self.client.get(f"/download/raw/{pids[2]}")
+        self.assertEqual(resp.content, upload_content)
+        MediaService.delete(pids[2])
+        self.assertFalse(os.path.exists(path))
+
+
+    def test_content_keys_only_in_hashdir(self):
+        upload_content = b'egg salad sand witch'
+        content_key = 'sha256:'+hashlib.sha256(upload_content).hexdigest()
+        mediadata = dict(MediaSchemaCreate(pid='test_hashdir_key', pid_type='DEMO', store_config=self.storeconfig_dict))
+        resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content))))
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        fs_storeconfig = dict(StoreConfigSchemaCreate(type=StoreConfig.FILESYSTEMSTORE, bucket=os.path.join(self.root, 'fs')))
+        mediadata = dict(MediaSchemaCreate(pid='test_fs_key', pid_type='DEMO', store_config=fs_storeconfig))
+        resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content))))
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        resp = self.client.put("/media/update/storekeys", json=[dict(pid='test_fs_key', store_key=content_key),
+                                                                 dict(pid='test_hashdir_key', store_key='not-a-content-key')])
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['successes'], [])
+        self.assertEqual(len(resp.json()['failures']), 2)
+        self.assertEqual(Media.objects.get(pid='test_hashdir_key').store_key, content_key)
+
+
+class FileHandlerZipstoreTests(TempRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.ZIPSTORE, bucket=self.root))
+
+    def test_download_raw_ranges(self):
+        FileHandlerFilestoreTests.test_download_raw_ranges(self)
+
+    def test_updown_compact(self):
+        from django.core.management import call_command
+        from mediastore.services import MediaService
+        contents = {f'test_zipstore_{i}': f'egg salad sand witch {i}'.encode() for i in range(4)}
+        with override_settings(ZIPSTORE_SEGMENT_BYTES=50):  # two objects per segment
+            for pid, content in contents.items():
+                mediadata = dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict))
+                resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(content))))
+                self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'segments'))), ['00000001.seg', '00000002.seg'])
+
+        MediaService.delete('test_zipstore_0')
+        call_command('compact_zipstores', min_dead_ratio=0.5, stdout=io.StringIO())
+        self.assertNotIn('00000001.seg', os.listdir(os.path.join(self.root, 'segments')))
+        for pid, content in list(contents.items())[1:]:
+            resp = self.client.get(f"/download/raw/{pid}")
+            self.assertEqual(resp.content, content)
+
+
+class ReadCacheTests(TempRootMixin, TestCase):
+    root_settings = dict(READ_CACHE_DIR='cache')
+
+    def setUp(self):
+        from mediastore.readcache import read_cache
+        super().setUp()
+        StoreConfig.objects.create(type=StoreConfig.FILESYSTEMSTORE, bucket=os.path.join(self.root, 'store'), read_cache=True)
+        self.storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.FILESYSTEMSTORE, bucket=os.path.join(self.root, 'store')))
+        self.read_cache = read_cache
+        self.read_cache.reset_stats()
+
+    def test_read_cache(self):
+        from mediastore.services import MediaService
+        PID = 'test_read_cache'
+        upload_content = b'egg salad sand witch'
+        mediadata = dict(MediaSchemaCreate(pid=PID, pid_type='DEMO', store_config=self.storeconfig_dict))
+        resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content))))
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=4-8'})
+        self.assertEqual(resp.content, b'salad')  # ranged misses are not cached
+        etags = {resp['ETag']}
+        for _ in range(3):
+            resp = self.client.get(f"/download/raw/{PID}")
+            self.assertEqual(resp.content, upload_content)
+            etags.add(resp['ETag'])
+        stats = self.read_cache.stats()
+        self.assertEqual((stats['misses'], stats['fills'], stats['hits']), (2, 1, 2))
+        self.assertEqual(stats['bytes'], len(upload_content))
+        self.assertEqual(etags, {f'"{hashlib.sha256(upload_content).hexdigest()}"'})  # same on misses and hits
+
+        # nothing to verify media without a checksum against, they are not cached
+        mediadata = dict(MediaSchemaCreate(pid=f'{PID}_nochecksum', pid_type='DEMO', store_config=self.storeconfig_dict))
+        self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(upload_content))))
+        Media.objects.filter(pid=f'{PID}_nochecksum').update(checksum='')
+        media_cache.invalidate(f'{PID}_nochecksum')
+        for _ in range(2):
+            resp = self.client.get(f"/download/raw/{PID}_nochecksum")
+            self.assertEqual(resp.content, upload_content)
+        self.assertEqual(self.read_cache.stats()['fills'], 1)
+
+        # served from the cache alone
+        media = Media.objects.get(pid=PID)
+        os.remove(os.path.join(self.root, 'store', media.store_key))
+        resp = self.client.get(f"/download/raw/{PID}", headers={'Range': 'bytes=4-8'})
+        self.assertEqual(resp.content, b'salad')
+
+        MediaService.delete(PID)
+        self.assertEqual(self.read_cache.stats()['bytes'], 0)
+
+
+class TieringTests(TempRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storeconfig_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.FILESYSTEMSTORE, bucket=os.path.join(self.root, 'fast')))
+        self.target = StoreConfig.objects.create(type=StoreConfig.HASHDIRSTORE, bucket=os.path.join(self.root, 'cheap'))
+
+    def test_run_tiering(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from django.core.management import call_command
+        from mediastore.models import TieringPolicy
+        contents = {'test_tiering_old': b'egg salad sand witch', 'test_tiering_new': b'ham sand witch'}
+        for pid, content in contents.items():
+            mediadata = dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.storeconfig_dict))
+            resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(content))))
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        old = Media.objects.get(pid='test_tiering_old')
+        # stored before checksums were kept
+        Media.objects.filter(pk=old.pk).update(created=timezone.now()-timedelta(days=40), checksum='')
+        history_count = old.history.count()
+        TieringPolicy.objects.create(name='fast to cheap', source=old.store_config, target=self.target, min_age_days=30)
+
+        resp = self.client.get("/download/raw/test_tiering_new")
+        self.assertIsNotNone(Media.objects.get(pid='test_tiering_new').last_accessed)
+        media_cache.reset_stats()  # recording the access kept the cached media
+        resp = self.client.get("/download/raw/test_tiering_new")
+        self.assertEqual((media_cache.stats()['hits'], media_cache.stats()['misses']), (1, 0))
+
+        call_command('run_tiering', stdout=io.StringIO())
+        moved, kept = Media.objects.get(pid='test_tiering_old'), Media.objects.get(pid='test_tiering_new')
+        self.assertEqual(moved.store_config, self.target)
+        self.assertEqual(moved.store_key, 'sha256:'+hashlib.sha256(contents['test_tiering_old']).hexdigest())
+        self.assertEqual(moved.checksum, hashlib.sha256(contents['test_tiering_old']).hexdigest())
+        self.assertEqual(moved.history.count(), history_count+1)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'fast', old.store_key)))
+        self.assertEqual(kept.store_config, old.store_config)
+        for pid, content in contents.items():
+            resp = self.client.get(f"/download/raw/{pid}")
+            self.assertEqual(resp.content, content)
+
+    def test_backfill_created(self):
+        from datetime import timedelta
+        from django.apps import apps
+        from django.utils import timezone
+        from mediastore.signals import backfill_media_created
+        mediadata = dict(MediaSchemaCreate(pid='test_backfill_created', pid_type='DEMO', store_config=self.storeconfig_dict))
+        resp = self.client.post("/upload", json=dict(UploadSchemaInput(mediadata=mediadata, base64=encode64(b'egg'))))
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        media = Media.objects.get(pid='test_backfill_created')
+        first_recorded = media.history.earliest('history_date').history_date
+        self.assertLessEqual(media.created, first_recorded)
+        # as if created was added by a later migration
+        Media.objects.filter(pk=media.pk).update(created=timezone.now()+timedelta(days=1))
+        backfill_media_created(sender=apps.get_app_config('mediastore'), using='default')
+        self.assertEqual(Media.objects.get(pk=media.pk).created, first_recorded)
+
 
 class FileHandlerSqlitestoreTests(TestCase):
     def setUp(self):
@@ -214,3 +709,68 @@ class FileHandlerSqlitestoreTests(TestCase):
 
         downloaded_content = decode64( data['base64'] )
         self.assertEqual(downloaded_content, upload_content)
+
+
+class PresignedUrlTests(TestCase):
+    # presigning is offline, no bucket needed
+    def setUp(self):
+        FileHandlerFilestoreTests.setUp(self)
+        S3Config.objects.create(url='https://my.endpoint.s3', access_key='bingus', secret_key='secretbingus')
+        self.s3store_dict = s3store_dict = dict(StoreConfigSchemaCreate(type=StoreConfig.BUCKETSTORE, bucket='demobucket', s3_url='https://my.endpoint.s3'))
+        self.PIDS = [f'test_presigned_{i}' for i in range(3)]
+        payload = [dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=s3store_dict)) for pid in self.PIDS]
+        payload.append(dict(MediaSchemaCreate(pid='test_presigned_fs', pid_type='DEMO', store_config=self.storeconfig_dict)))
+        resp = self.client.post("/media/create", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+    def test_download_urls_batched(self):
+        resp = self.client.post("/download/urls", json=[*self.PIDS, 'test_presigned_fs', 'nope'])
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        received = resp.json()
+        self.assertEqual([r.get('mediadata',{}).get('pid') for r in received[:3]], self.PIDS)
+        for r in received[:3]:
+            self.assertIn(r['mediadata']['store_key'], r['presigned_get'])
+            self.assertIn('X-Amz-Expires=', r['presigned_get'])
+        self.assertEqual([r.get('pid') for r in received[3:]], ['test_presigned_fs', 'nope'])
+        self.assertIn('DoesNotExist', received[4]['error'])
+
+        # reused from cache, single and batched paths alike
+        resp = self.client.post("/download/urls", json=self.PIDS[::-1])
+        self.assertEqual([r['presigned_get'] for r in resp.json()], [r['presigned_get'] for r in received[2::-1]])
+        resp = self.client.get(f"/download/url/{self.PIDS[0]}")
+        self.assertEqual(resp.json()['presigned_get'], received[0]['presigned_get'])
+
+        # a new store_key gets a new url
+        resp = self.client.put('/media/update/storekeys', json=[dict(pid=self.PIDS[0], store_key='moved')])
+        self.assertEqual(resp.json()['successes'], [self.PIDS[0]])
+        resp = self.client.get(f"/download/url/{self.PIDS[0]}")
+        self.assertIn('/moved?', resp.json()['presigned_get'])
+
+    def test_upload_presigned_batch(self):
+        pids = [f'test_upload_presigned_{i}' for i in range(3)]
+        payload = [dict(mediadata=dict(MediaSchemaCreate(pid=pid, pid_type='DEMO', store_config=self.s3store_dict)), size=10)
+                   for pid in pids]
+        resp = self.client.post("/upload/presigned", json=payload)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        received = resp.json()
+        self.assertEqual([r['pid'] for r in received], pids)
+        for r in received:
+            media = Media.objects.get(pid=r['pid'])
+            self.assertEqual(media.store_status, StoreConfig.PENDING)
+            self.assertIn(media.store_key, r['presigned_put'])
+            self.assertIsNone(r['upload_id'])
+
+        # all or nothing
+        payload = [dict(mediadata=dict(MediaSchemaCreate(pid='test_upload_presigned_s3', pid_type='DEMO', store_config=self.s3store_dict))),
+                   dict(mediadata=dict(MediaSchemaCreate(pid='test_upload_presigned_fs', pid_type='DEMO', store_config=self.storeconfig_dict)))]
+        resp = self.client.post("/upload/presigned", json=payload)
+        self.assertEqual(resp.status_code, 422)
+        self.assertFalse(Media.objects.filter(pid__in=['test_upload_presigned_s3', 'test_upload_presigned_fs']).exists())
+
+        # signing happens after the commit, a failure there deletes the media again
+        from unittest import mock
+        payload = [dict(mediadata=dict(MediaSchemaCreate(pid='test_upload_presigned_fail', pid_type='DEMO', store_config=self.s3store_dict)))]
+        with mock.patch('mediastore.stores.presigned_puts', side_effect=RuntimeError('s3 down')):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/upload/presigned", json=payload)
+        self.assertFalse(Media.objects.filter(pid='test_upload_presigned_fail').exists())
@@ -1,13 +1,21 @@
+import uuid
+
+from asgiref.sync import sync_to_async
 from ninja import Router
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseNotModified
+from django.utils.http import content_disposition_header
 
 upload_router = Router()
 download_router = Router()
 
 from typing import Union, List
-from schemas.mediastore import MediaErrorSchema
+from schemas.mediastore import MediaErrorSchema, MediaSchemaCreate, BulkUpdateResponseSchema
 from schemas.mediastore import UploadSchemaInput, UploadSchemaOutput, UploadError, \
                                  DownloadSchemaInput, DownloadSchemaOutput
-from file_handler.services import UploadService, DownloadService
+from file_handler.services import UploadService, DownloadService, ArchiveService, parse_byte_ranges, none_match
+from file_handler.schemas import ArchiveRequestSchema, PresignedUploadRequestSchema, PresignedUploadSchema, \
+    MultipartCompleteSchema, UploadCompleteSchema
+from mediastore.stores import CHUNK_SIZE
 
 
 @upload_router.post('', response={200:UploadSchemaOutput, 401:UploadError})
@@ -19,13 +27,54 @@ def upload_media(request, payload:UploadSchemaInput):
         return 401, UploadError(error=f'{type(e)}: {e}')
 
 
-@download_router.post('/urls', response=Union[DownloadSchemaOutput,MediaErrorSchema])
+@upload_router.post('/stream', response={200:UploadSchemaOutput, 401:UploadError})
+def upload_media_stream(request):
+    # multipart/form-data: "mediadata" json field + "file" part
+    # application/octet-stream: raw bytes body + "X-Mediadata" json header
+    try:
+        if 'file' in request.FILES:
+            mediadata = MediaSchemaCreate.model_validate_json(request.POST['mediadata'])
+            chunks = request.FILES['file'].chunks(CHUNK_SIZE)
+        else:
+            mediadata = MediaSchemaCreate.model_validate_json(request.headers['X-Mediadata'])
+            chunks = iter(lambda: request.read(CHUNK_SIZE), b'')
+        return 200, UploadService.upload_stream(mediadata, chunks)
+    except Exception as e:
+        return 401, UploadError(error=f'{type(e)}: {e}')
+
+@upload_router.post('/bulk', response={200:BulkUpdateResponseSchema, 401:UploadError})
+def upload_media_bulk(request):
+    # multipart/form-data: "manifest" NDJSON file + "archive" zip or tar file
+    try:
+        manifest_lines = (line.decode() for line in request.FILES['manifest'])
+        return 200, UploadService.upload_bulk(manifest_lines, request.FILES['archive'])
+    except Exception as e:
+        return 401, UploadError(error=f'{type(e)}: {e}')
+
+@upload_router.post('/presigned', response=List[PresignedUploadSchema])
+def upload_media_presigned(request, payload:List[PresignedUploadRequestSchema]):
+    # all or nothing, any invalid media is a 422
+    return UploadService.upload_presigned(payload)
+
+@upload_router.post('/complete', response=BulkUpdateResponseSchema)
+def upload_media_complete(request, payload:List[UploadCompleteSchema]):
+    return UploadService.complete(payload)
+
+@upload_router.post('/multipart/complete', response=BulkUpdateResponseSchema)
+def upload_media_multipart_complete(request, payload:List[MultipartCompleteSchema]):
+    return UploadService.complete_multipart(payload)
+
+@download_router.post("/urls", response=List[Union[DownloadSchemaOutput,MediaErrorSchema]])
 def download_media_urls(request, pids:List[str]):
-    responses = []
-    for pid in pids:
-        _, response = download_media_url(request, pid=pid)
-        responses.append(response)
-    return responses
+    return DownloadService.download_links(pids)
+
+@download_router.post('/archive')
+def download_media_archive(request, payload:ArchiveRequestSchema):
+    medias = ArchiveService.medias(payload)
+    response = StreamingHttpResponse(ArchiveService.stream(medias, payload.format),
+                                     content_type=ArchiveService.CONTENT_TYPES[payload.format])
+    response['Content-Disposition'] = content_disposition_header(as_attachment=True, filename=f'media.{payload.format}')
+    return response
 
 @download_router.get('/url/{pid}', response={200:DownloadSchemaOutput, 401:MediaErrorSchema})
 def download_media_url(request, pid:str):
@@ -36,6 +85,53 @@ def download_media_url(request, pid:str):
     except Exception as e:
         return 401, MediaErrorSchema( pid=pid, error=str(type(e)), msg=str(e) )
 
+def raw_response(request, pid: str, media, size: int, etag: str, iter_content, iter_byteranges):
+    # response of /download/raw, iter_content and iter_byteranges being the sync or async DownloadService ones
+    if none_match(request.headers.get('If-None-Match'), etag):
+        response = HttpResponseNotModified()
+        if etag: response['ETag'] = etag
+        return response
+
+    ranges = None
+    content_type = 'application/octet-stream'
+    if (range_header := request.headers.get('Range')) and request.headers.get('If-Range', etag) == etag:
+        try:
+            ranges = parse_byte_ranges(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if not ranges:
+        response = StreamingHttpResponse(iter_content(media), content_type=content_type)
+        response['Content-Length'] = size
+    elif len(ranges) == 1:
+        start, length = ranges[0]
+        response = StreamingHttpResponse(iter_content(media, start, length),
+                                         status=206, content_type=content_type)
+        response['Content-Length'] = length
+        response['Content-Range'] = f'bytes {start}-{start+length-1}/{size}'
+    else:
+        boundary = uuid.uuid4().hex
+        content_length, chunks = iter_byteranges(media, ranges, size, boundary, content_type)
+        response = StreamingHttpResponse(chunks, status=206, content_type=f'multipart/byteranges; boundary={boundary}')
+        response['Content-Length'] = content_length
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(as_attachment=True, filename=pid)
+    if etag: response['ETag'] = etag
+    for header, value in DownloadService.media_headers(media).items():
+        response[header] = value
+    return response
+
+@download_router.get('/raw/{pid}', response={401:MediaErrorSchema})
+def download_media_raw(request, pid:str):
+    try:
+        media, size, etag = DownloadService.download_stat(pid)
+    except Exception as e:
+        return 401, MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e))
+    return raw_response(request, pid, media, size, etag, DownloadService.iter_content, DownloadService.iter_byteranges)
+
 @download_router.get('/{pid}', response={200:DownloadSchemaOutput, 401:MediaErrorSchema})
 def download_media(request, pid:str):
     #return 200, DownloadService.download(DownloadSchemaInput(pid=pid, direct=True))
@@ -43,4 +139,57 @@ def download_media(request, pid:str):
         payload = DownloadSchemaInput(pid=pid, direct=True)
         return 200, DownloadService.download(payload)
     except Exception as e:
-        return 401, MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e))
\ No newline at end of file
+        return 401, MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e))
+
+## ASYNC ##
+# async counterparts of the routes above, for ASGI deployments (config.asgi). Store I/O runs on
+# the store io thread pool and ORM work through sync_to_async, so slow transfers don't hold a worker
+
+async_upload_router = Router()
+async_download_router = Router()
+
+@async_upload_router.post('', response={200:UploadSchemaOutput, 401:UploadError})
+async def aupload_media(request, payload:UploadSchemaInput):
+    try:
+        return 200, await UploadService.aupload(payload)
+    except Exception as e:
+        return 401, UploadError(error=f'{type(e)}: {e}')
+
+@async_upload_router.post('/stream', response={200:UploadSchemaOutput, 401:UploadError})
+async def aupload_media_stream(request):
+    try:
+        if 'file' in request.FILES:
+            mediadata = MediaSchemaCreate.model_validate_json(request.POST['mediadata'])
+            chunks = request.FILES['file'].chunks(CHUNK_SIZE)
+        else:
+            mediadata = MediaSchemaCreate.model_validate_json(request.headers['X-Mediadata'])
+            chunks = iter(lambda: request.read(CHUNK_SIZE), b'')
+        return 200, await UploadService.aupload_stream(mediadata, chunks)
+    except Exception as e:
+        return 401, UploadError(error=f'{type(e)}: {e}')
+
+@async_download_router.post("/urls", response=List[Union[DownloadSchemaOutput,MediaErrorSchema]])
+async def adownload_media_urls(request, pids:List[str]):
+    return await sync_to_async(DownloadService.download_links)(pids)
+
+@async_download_router.get('/url/{pid}', response={200:DownloadSchemaOutput, 401:MediaErrorSchema})
+async def adownload_media_url(request, pid:str):
+    try:
+        return 200, await DownloadService.adownload(DownloadSchemaInput(pid=pid, direct=False))
+    except Exception as e:
+        return 401, MediaErrorSchema( pid=pid, error=str(type(e)), msg=str(e) )
+
+@async_download_router.get('/raw/{pid}', response={401:MediaErrorSchema})
+async def adownload_media_raw(request, pid:str):
+    try:
+        media, size, etag = await DownloadService.adownload_stat(pid)
+    except Exception as e:
+        return 401, MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e))
+    return raw_response(request, pid, media, size, etag, DownloadService.aiter_content, DownloadService.aiter_byteranges)
+
+@async_download_router.get('/{pid}', response={200:DownloadSchemaOutput, 401:MediaErrorSchema})
+async def adownload_media(request, pid:str):
+    try:
+        return 200, await DownloadService.adownload(DownloadSchemaInput(pid=pid, direct=True))
+    except Exception as e:
+        return 401, MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e))
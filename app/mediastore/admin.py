@@ -1,9 +1,9 @@
 from django.contrib import admin
 
-from .models import StoreConfig, S3Config, IdentifierType
+from .models import StoreConfig, S3Config, IdentifierType, TieringPolicy
 
 class StoreConfigAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'type', 'bucket', 's3cfg__url', 's3cfg__pk')
+    list_display = ('pk', 'type', 'bucket', 's3cfg__url', 's3cfg__pk', 'read_cache')
     def s3cfg__url(self, obj):
         return obj.s3cfg.url if obj.s3cfg else ''
     def s3cfg__pk(self, obj):
@@ -15,6 +15,10 @@ class S3ConfigAdmin(admin.ModelAdmin):
 class IdentityTypeAdmin(admin.ModelAdmin):
     list_display = ('name',)
 
+class TieringPolicyAdmin(admin.ModelAdmin):
+    list_display = ('name', 'source', 'target', 'min_age_days', 'min_idle_days', 'enabled')
+
 admin.site.register(StoreConfig,StoreConfigAdmin)
 admin.site.register(S3Config,S3ConfigAdmin)
 admin.site.register(IdentifierType, IdentityTypeAdmin)
+admin.site.register(TieringPolicy, TieringPolicyAdmin)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MediaStoreConfig(AppConfig):
     name = 'mediastore'
+
+    def ready(self):
+        import mediastore.signals
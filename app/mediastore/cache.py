@@ -0,0 +1,94 @@
+"""
+Read-through cache of Media rows by pid, in front of MediaService.read and
+DownloadService. Media rarely change after ingest while viewers read the same
+pids over and over.
+"""
+import hashlib
+import threading
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import transaction
+
+from mediastore.models import Media
+
+
+class MediaCache:
+    """
+    Caches Media instances, with their store_config, s3cfg and tags loaded, in
+    the MEDIA_CACHE_ALIAS Django cache. Writers call invalidate(pid); Media
+    save/delete and store config changes are also caught by signals.
+    Hit/miss counters are per process.
+    """
+    def __init__(self, alias: str = 'media'):
+        self.alias = alias
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(pid: str) -> str:
+        # pids can be long or hold characters memcached-style backends refuse
+        return 'media:' + hashlib.sha256(pid.encode()).hexdigest()
+
+    @staticmethod
+    def load(pid: str) -> Media:
+        media = Media.objects.select_related('store_config__s3cfg').prefetch_related('tags').get(pid=pid)
+        list(media.tags.all())
+        return media
+
+    def get(self, pid: str) -> Media:
+        """Returns the Media of pid, raising Media.DoesNotExist as Media.objects.get would. Misses are not cached"""
+        media = self.cache.get(self.key(pid))
+        with self._lock:
+            if media is None: self.misses += 1
+            else: self.hits += 1
+        if media is None:
+            media = self.load(pid)
+            self.cache.set(self.key(pid), media)
+        return media
+
+    async def aget(self, pid: str) -> Media:
+        media = await self.cache.aget(self.key(pid))
+        with self._lock:
+            if media is None: self.misses += 1
+            else: self.hits += 1
+        if media is None:
+            media = await sync_to_async(self.load)(pid)
+            await self.cache.aset(self.key(pid), media)
+        return media
+
+    def invalidate(self, *pids: str):
+        # again on commit, in case a concurrent read cached the pre-commit row
+        keys = [self.key(pid) for pid in pids]
+        if not keys: return
+        self.cache.delete_many(keys)
+        transaction.on_commit(lambda: self.cache.delete_many(keys))
+        with self._lock:
+            self.invalidations += len(keys)
+
+    def mark_accessed(self, pid: str, window: int) -> bool:
+        """True at most once per window seconds per pid, for the caller to record that access"""
+        return self.cache.add('accessed:' + self.key(pid), True, window)
+
+    async def amark_accessed(self, pid: str, window: int) -> bool:
+        return await self.cache.aadd('accessed:' + self.key(pid), True, window)
+
+    def clear(self):
+        self.cache.clear()
+        transaction.on_commit(self.cache.clear)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(backend=self.cache.__class__.__name__, hits=self.hits, misses=self.misses,
+                        invalidations=self.invalidations, hit_ratio=self.hits/lookups if lookups else 0.0)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.invalidations = 0
+
+media_cache = MediaCache()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from mediastore.models import StoreConfig
+from mediastore.stores import open_store
+
+class Command(BaseCommand):
+    help = "Rewrites ZipStore segments holding mostly deleted or overwritten objects, reclaiming their space"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-dead-ratio', type=float, default=None,
+                            help="Share of dead bytes from which a segment is rewritten. Default is ZIPSTORE_COMPACT_RATIO")
+        parser.add_argument('--store-config', type=int, nargs='*', help="StoreConfig ids. Default is every ZipStore")
+
+    def handle(self, *args, **options):
+        store_configs = StoreConfig.objects.filter(type=StoreConfig.ZIPSTORE)
+        if options['store_config']:
+            store_configs = store_configs.filter(pk__in=options['store_config'])
+        for store_config in store_configs:
+            with open_store(store_config) as store:
+                removed, reclaimed = store.compact(options['min_dead_ratio'])
+                stats = store.stats()
+            self.stdout.write(f'StoreConfig {store_config.pk} ({store_config.bucket}): {removed} segments rewritten, {reclaimed} bytes reclaimed. '
+                              f'{stats["objects"]} objects in {stats["segments"]} segments, {stats["dead_bytes"]}/{stats["bytes"]} bytes dead')
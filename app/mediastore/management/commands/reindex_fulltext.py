@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from mediastore.services import FullTextService
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search documents of all media"
+
+    def handle(self, *args, **options):
+        FullTextService.reindex_all()
+        self.stdout.write('reindexed full-text documents')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from mediastore.services import IdentifierIndexService
+
+class Command(BaseCommand):
+    help = "Rebuilds the pid and identifier search index of all media"
+
+    def handle(self, *args, **options):
+        IdentifierIndexService.reindex_all()
+        self.stdout.write('reindexed identifiers')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from mediastore.services import MetadataIndexService
+
+class Command(BaseCommand):
+    help = "Rebuilds the search index entries of indexed metadata keys"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Indexed metadata key paths, eg ctd.depth. Default is all")
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or sorted(MetadataIndexService.indexed_paths())
+        for path in paths:
+            MetadataIndexService.reindex_key(path)
+            self.stdout.write(f'reindexed {path}')
@@ -0,0 +1,36 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from mediastore.models import TieringPolicy
+from mediastore.services import TieringService
+
+class Command(BaseCommand):
+    help = "Moves media due by the enabled TieringPolicies to their target store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--policy', nargs='*', help="Policy names. Default is every enabled policy")
+        parser.add_argument('--batch-size', type=int, default=100, help="Media moved per batch")
+        parser.add_argument('--workers', type=int, default=None, help="Concurrent copies. Default is TIERING_WORKERS")
+        parser.add_argument('--bandwidth', type=int, default=None, help="Bytes/s of all copies together, 0 is unthrottled. Default is TIERING_BANDWIDTH")
+        parser.add_argument('--limit', type=int, default=None, help="Media moved at most, per policy")
+        parser.add_argument('--nice', type=int, default=0,
+                            help="Added to the process' niceness, so that copies yield the cpu to requests. "
+                                 "It cannot be undone, only give it when the command runs in its own process (eg. cron)")
+
+    def handle(self, *args, **options):
+        if options['nice']:
+            os.nice(options['nice'])
+        policies = None
+        if options['policy']:
+            policies = TieringPolicy.objects.filter(name__in=options['policy']).select_related('target__s3cfg')
+        totals = {}
+        for policy, moved, failures in TieringService.run(policies, options['batch_size'], options['workers'],
+                                                          options['bandwidth'], options['limit']):
+            total = totals.setdefault(policy.name, [0, 0])
+            total[0], total[1] = total[0]+moved, total[1]+len(failures)
+            for failure in failures:
+                self.stderr.write(f'{policy.name}: {failure.pid}: {failure.msg}')
+            self.stdout.write(f'{policy.name}: {total[0]} moved, {total[1]} failed')
+        for name, (moved, failed) in totals.items():
+            self.stdout.write(f'done {name}: {moved} media moved to target, {failed} failed')
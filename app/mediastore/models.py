@@ -1,28 +1,17 @@
 import os
 
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 from taggit.managers import TaggableManager
 from simple_history.models import HistoricalRecords
+import boto3
+import botocore.config
 
-import storage.fs, storage.s3, storage.db, storage.object
+import storage.fs, storage.s3, storage.db
 
-
-class DictStoreSingleton(storage.object.DictStore):
-    """
-    Singleton version of storage.object.DictStore
-    for use in repeat queries to RAMSTORE
-    """
-    _instance = None
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super(cls, cls).__new__(cls, *args, **kwargs)
-        return cls._instance
-    def __init__(self):
-        # Initialize objects only if not already initialized
-        if not hasattr(self, 'objects'):
-            self.objects = {}
+from mediastore.stores import store_pool, HashdirStore, ZipStore, RamStore, CONTENT_KEY_PREFIX
 
 
 class IdentifierType(models.Model):
@@ -58,6 +47,7 @@ class StoreConfig(models.Model):
     s3cfg = models.ForeignKey(S3Config, on_delete=models.RESTRICT, null=True, default=None)
     bucket = models.CharField(max_length=255)
     # bucket used as local_root path if used for FilesystemStore HashdirStore ZipStore SqliteStore, ie if s3_params = null
+    read_cache = models.BooleanField(default=False)  # serve reads through the local disk read cache, see mediastore.readcache
 
     def is_s3_type(self):
         return self.type == self.BUCKETSTORE
@@ -71,12 +61,12 @@ class StoreConfig(models.Model):
     @property
     def storage_Store_kwargs(self):
         match self.type:
-            case self.FILESYSTEMSTORE:
+            case self.FILESYSTEMSTORE | self.HASHDIRSTORE | self.ZIPSTORE:
                 return dict(root_path=self.bucket)
             case self.SQLITESTORE:
                 return dict(db_path=self.bucket)
             case self.DICTSTORE:
-                return dict()
+                return dict(namespace=self.bucket)
             case self.BUCKETSTORE:
                 kwargs = dict(
                     s3_url = self.s3cfg.url,
@@ -91,11 +81,14 @@ class StoreConfig(models.Model):
         match self.type:
             case self.FILESYSTEMSTORE:
                 return storage.fs.FilesystemStore
+            case self.HASHDIRSTORE:
+                return HashdirStore
+            case self.ZIPSTORE:
+                return ZipStore
             case self.SQLITESTORE:
                 return storage.db.SqliteStore
             case self.DICTSTORE:
-                return DictStoreSingleton
-                #return storage.object.DictStore
+                return RamStore
             case self.BUCKETSTORE:
                 return storage.s3.BucketStore
 
@@ -103,6 +96,19 @@ class StoreConfig(models.Model):
         Store = self.get_storage_Store()
         return Store(**self.storage_Store_kwargs)
 
+    def get_s3_client(self):
+        # plain boto3 client for the s3 calls BucketStore doesn't expose (streaming, ranges, multipart)
+        return store_pool.s3_client(self)
+
+    def make_s3_client(self):
+        assert self.is_s3_type()
+        kwargs = self.storage_Store_kwargs
+        return boto3.client('s3',
+            endpoint_url = kwargs['s3_url'],
+            aws_access_key_id = kwargs['s3_access_key'],
+            aws_secret_access_key = kwargs['s3_secret_key'],
+            config = botocore.config.Config(signature_version='s3v4', **kwargs.get('botocore_config_kwargs', {})))
+
 
 class Media(models.Model):
     pid = models.CharField(max_length=255, unique=True)
@@ -110,8 +116,12 @@ class Media(models.Model):
     store_config = models.ForeignKey(StoreConfig, on_delete=models.RESTRICT)
     store_key = models.CharField(max_length=255, blank=True, null=False)
     store_status = models.CharField(max_length=12, choices=StoreConfig.STATUSES, default=StoreConfig.PENDING)
+    size = models.BigIntegerField(null=True, default=None)  # bytes, once stored
+    checksum = models.CharField(max_length=64, blank=True, default='')  # sha256 hexdigest, once stored
     identifiers = models.JSONField(default=dict)
     metadata = models.JSONField(default=dict)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    last_accessed = models.DateTimeField(null=True, default=None, db_index=True)  # last download, to TIERING_ACCESS_RESOLUTION
     tags = TaggableManager()
     history = HistoricalRecords()
     # TODO lifecycle, other relationships
@@ -124,5 +134,65 @@ class Media(models.Model):
             models.UniqueConstraint(
                 fields=["store_key", "store_config"],
                 name="unique_storeKey_per_storeConfig",
+                condition=~models.Q(store_key__startswith=CONTENT_KEY_PREFIX),  # content-addressed keys are shared
             ),
-        ]
\ No newline at end of file
+        ]
+
+class TieringPolicy(models.Model):
+    """
+    Moves READY media of source to target once created more than min_age_days ago,
+    or not downloaded for min_idle_days. Applied by the run_tiering command.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    source = models.ForeignKey(StoreConfig, on_delete=models.RESTRICT, related_name='tiering_from')
+    target = models.ForeignKey(StoreConfig, on_delete=models.RESTRICT, related_name='tiering_to')
+    min_age_days = models.PositiveIntegerField(null=True, blank=True, default=None)
+    min_idle_days = models.PositiveIntegerField(null=True, blank=True, default=None)
+    enabled = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        if self.source_id == self.target_id:
+            raise ValidationError(_('source and target must differ'))
+        if self.min_age_days is None and self.min_idle_days is None:
+            raise ValidationError(_('set min_age_days, min_idle_days or both'))
+
+class IndexedMetadataKey(models.Model):
+    path = models.CharField(max_length=255, unique=True)  # dot-separated keys into Media.metadata, eg "ctd.depth"
+
+    def __str__(self):
+        return self.path
+
+class MetadataIndexEntry(models.Model):
+    # side table of the values found at IndexedMetadataKey paths, kept in sync by MetadataIndexService
+    media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name='metadata_index')
+    key = models.CharField(max_length=255)
+    num = models.FloatField(null=True)  # numbers
+    text = models.CharField(max_length=255, null=True)  # strings and booleans
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['key', 'num']),
+            models.Index(fields=['key', 'text']),
+        ]
+
+class MediaIdentifier(models.Model):
+    # one row per (type, value) of a media, its pid included, kept in sync by IdentifierIndexService
+    media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name='identifier_index')
+    type = models.CharField(max_length=255)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        indexes = [
+            # pattern_ops lets postgres use these for LIKE 'prefix%'; other backends ignore opclasses
+            models.Index(fields=['type', 'value'], name='mediastore_ident_type_value', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+            models.Index(fields=['value'], name='mediastore_ident_value', opclasses=['varchar_pattern_ops']),
+        ]
+
+class MediaSearchDocument(models.Model):
+    # the free text of a media (pid, identifiers, tags, metadata strings), kept in sync by FullTextService.
+    # the search vector over it (FTS5 table or tsvector column) is created by a post_migrate signal
+    media = models.OneToOneField(Media, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    document = models.TextField()
@@ -0,0 +1,196 @@
+"""
+Local disk read cache of stored objects, for StoreConfigs flagged read_cache.
+"""
+import os
+import uuid
+import hashlib
+import threading
+from contextlib import suppress
+
+from django.conf import settings
+
+from mediastore import stores
+from mediastore.models import Media, StoreConfig
+
+
+class ReadCache:
+    """Whole objects of checksummed media as LRU-evicted files under READ_CACHE_DIR, verified on fill"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = {}  # root -> bytes, as of the last scan plus this process' fills and removals since
+        self.hits = self.misses = self.fills = self.rejects = self.evictions = self.invalidations = 0
+
+    @property
+    def root(self) -> str:
+        return settings.READ_CACHE_DIR
+
+    @property
+    def max_bytes(self) -> int:
+        return settings.READ_CACHE_MAX_BYTES
+
+    @staticmethod
+    def entry_key(media: Media) -> str:
+        return hashlib.sha256(f'{media.store_config_id}:{media.store_key}:{media.checksum}'.encode()).hexdigest()
+
+    def path(self, media: Media) -> str:
+        key = self.entry_key(media)
+        return os.path.join(self.root, key[:2], key)
+
+    def enabled(self, media: Media) -> bool:
+        return (media.store_config.read_cache and media.store_status == StoreConfig.READY and bool(media.checksum)
+                and (media.size is None or media.size <= self.max_bytes))
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name)+n)
+
+    def _open(self, media: Media):
+        """Returns the open entry file of media, or None. Entries of the wrong size are dropped"""
+        try: f = open(self.path(media), 'rb')
+        except FileNotFoundError: return None
+        if media.size is not None and os.fstat(f.fileno()).st_size != media.size:
+            f.close()
+            self.invalidate(media)
+            return None
+        with suppress(OSError): os.utime(f.fileno())  # LRU order
+        return f
+
+    def stat(self, media: Media):
+        """Returns (size, etag) of a cached media, else None. Spares a HEAD request to the store"""
+        if not self.enabled(media): return None
+        try: size = os.stat(self.path(media)).st_size
+        except FileNotFoundError: return None
+        return size, self.etag(media)
+
+    @staticmethod
+    def etag(media: Media) -> str:
+        # the validator of cached media, on hits and misses alike
+        return f'"{media.checksum}"'
+
+    def iter_chunks(self, media: Media, chunk_size: int = stores.CHUNK_SIZE, start: int = 0, length: int = None):
+        """stores.iter_chunks of media, read from the cache when possible.
+        A full read that misses fills the cache, a ranged one goes to the store"""
+        if not self.enabled(media):
+            yield from stores.iter_chunks(media.store_config, media.store_key, chunk_size, start=start, length=length)
+            return
+        f = self._open(media)
+        if f is not None:
+            self._count(hits=1)
+            with f:
+                f.seek(start)
+                yield from stores._read_slice(f.read, chunk_size, length)
+            return
+        self._count(misses=1)
+        chunks = stores.iter_chunks(media.store_config, media.store_key, chunk_size, start=start, length=length)
+        if start or length is not None:
+            yield from chunks
+        else:
+            yield from self._fill(media, chunks)
+
+    def _fill(self, media: Media, chunks):
+        tmp_dir = os.path.join(self.root, '.partial')
+        os.makedirs(tmp_dir, exist_ok=True)
+        partial = os.path.join(tmp_dir, uuid.uuid4().hex)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            if sha256.hexdigest() != media.checksum:
+                self._count(rejects=1)  # the store returned other bytes than were uploaded
+                return
+            path = self.path(media)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try: replaced = os.stat(path).st_size  # filled concurrently
+            except FileNotFoundError: replaced = 0
+            os.replace(partial, path)
+            self._count(fills=1)
+            self._add_usage(size - replaced)
+            self.evict()
+        finally:
+            # also when the client stopped reading, a partial read is never cached
+            with suppress(FileNotFoundError): os.remove(partial)
+
+    async def aiter_chunks(self, media: Media, chunk_size: int = stores.CHUNK_SIZE, start: int = 0, length: int = None):
+        chunks = self.iter_chunks(media, chunk_size, start=start, length=length)
+        try:
+            while (chunk := await stores.run_io(next, chunks, None)) is not None:
+                yield chunk
+        finally:
+            await stores.run_io(chunks.close)
+
+    def get(self, media: Media) -> bytes:
+        if not self.enabled(media):
+            with stores.open_store(media.store_config) as store:
+                return store.get(media.store_key)
+        return b''.join(self.iter_chunks(media))
+
+    def invalidate(self, media: Media):
+        path = self.path(media)
+        with suppress(FileNotFoundError):
+            size = os.stat(path).st_size
+            os.remove(path)
+            self._count(invalidations=1)
+            self._add_usage(-size)
+
+    def _add_usage(self, n: int):
+        root = self.root
+        with self._lock:
+            if root in self._usage: self._usage[root] = max(self._usage[root] + n, 0)
+
+    def usage(self) -> int:
+        """Bytes cached, scanning the directory only the first time"""
+        root = self.root
+        with self._lock:
+            if root in self._usage: return self._usage[root]
+        usage = sum(size for _, size, _ in self.entries())
+        with self._lock:
+            return self._usage.setdefault(root, usage)
+
+    def entries(self):
+        """Yields (path, size, mtime) of all entries"""
+        if not os.path.isdir(self.root): return
+        for subdir in os.scandir(self.root):
+            if not subdir.is_dir() or subdir.name == '.partial': continue
+            for entry in os.scandir(subdir.path):
+                with suppress(FileNotFoundError):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def evict(self):
+        """Removes least recently used entries until the cache is 90% of READ_CACHE_MAX_BYTES"""
+        root = self.root
+        with self._lock:
+            if root in self._usage and self._usage[root] <= self.max_bytes: return
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        usage = sum(size for _, size, _ in entries)
+        evicted = 0
+        if usage > self.max_bytes:
+            for path, size, _ in entries:
+                if usage <= 0.9*self.max_bytes: break
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                    evicted += 1
+                usage -= size
+        with self._lock:
+            self._usage[root] = usage
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        usage = self.usage()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(bytes=usage, max_bytes=self.max_bytes, hits=self.hits, misses=self.misses,
+                        fills=self.fills, rejects=self.rejects, evictions=self.evictions,
+                        invalidations=self.invalidations, hit_ratio=self.hits/lookups if lookups else 0.0)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.fills = self.rejects = self.evictions = self.invalidations = 0
+
+read_cache = ReadCache()
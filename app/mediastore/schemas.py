@@ -0,0 +1,67 @@
+from typing import List, Dict, Union, Optional, Any, Literal
+from pydantic import ConfigDict
+from ninja import Schema
+
+from schemas.mediastore import MediaSearchSchema
+
+
+class MetadataPredicateSchema(Schema):
+    model_config = ConfigDict(extra='forbid')
+    path: List[str]  # keys into metadata, eg ["ctd","depth"]
+    op: Literal['eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in', 'exists'] = 'eq'
+    value: Any = None
+
+class MetadataQuerySchema(Schema):
+    model_config = ConfigDict(extra='forbid')
+    all: List[Union[MetadataPredicateSchema, 'MetadataQuerySchema']] = []  # AND
+    any: List[Union[MetadataPredicateSchema, 'MetadataQuerySchema']] = []  # OR
+
+MetadataQuerySchema.model_rebuild()
+
+class IdentifierQuerySchema(Schema):
+    model_config = ConfigDict(extra='forbid')
+    value: str  # wildcard match supports * (any run of characters) and ? (any one character)
+    type: Optional[str] = None  # an IdentifierType name, None for any type, pid included
+    match: Literal['exact', 'prefix', 'wildcard'] = 'exact'
+
+class MediaSearchQuerySchema(MediaSearchSchema):
+    metadata: Optional[MetadataQuerySchema] = None
+    identifiers: List[IdentifierQuerySchema] = []  # AND
+    text: Optional[str] = None  # free text, all words must match. unpaginated results are ranked best first
+
+class IndexedMetadataKeySchema(Schema):
+    path: str
+
+class MediaCacheStatsSchema(Schema):
+    backend: str
+    hits: int
+    misses: int
+    invalidations: int
+    hit_ratio: float
+
+class RamStoreUsageSchema(Schema):
+    objects: int
+    bytes: int
+
+class RamStoreStatsSchema(Schema):
+    backend: str  # "local" for the per process store, else the shared cache backend
+    objects: Optional[int]  # totals are unknown of a shared backend
+    bytes: Optional[int]
+    max_bytes: Optional[int]
+    namespaces: Dict[str, RamStoreUsageSchema]
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    hit_ratio: float
+
+class ReadCacheStatsSchema(Schema):
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    fills: int
+    rejects: int  # fills dropped for not matching the media checksum
+    evictions: int
+    invalidations: int
+    hit_ratio: float
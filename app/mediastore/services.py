@@ -1,30 +1,109 @@
+import re
+import hashlib
+import time
 import uuid
+import logging
+import threading
+from contextlib import nullcontext, suppress
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # for search
 from operator import and_,or_
 from functools import reduce
 from typing import Union, List
 
+from django.db import connection
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.conf import settings
+from django.core import signing
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.utils import IntegrityError
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django.utils.text import slugify
+from taggit.models import Tag, TaggedItem
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 from ninja.errors import ValidationError, HttpError
 
-from mediastore.models import Media, IdentifierType, StoreConfig, S3Config, IdentifierType
+from mediastore.models import Media, IdentifierType, StoreConfig, S3Config, IdentifierType, TieringPolicy, \
+    IndexedMetadataKey, MetadataIndexEntry, MediaIdentifier, MediaSearchDocument
+from mediastore.schemas import MediaSearchQuerySchema, MetadataQuerySchema, MetadataPredicateSchema, \
+    IndexedMetadataKeySchema, IdentifierQuerySchema
+from mediastore import stores
+from mediastore.stores import store_pool, open_store, ram_storage
+from mediastore.cache import media_cache
+from mediastore.readcache import read_cache
 from schemas.mediastore import MediaSchema, MediaSchemaCreate, MediaSchemaUpdate, StoreConfigSchema, \
     StoreConfigSchemaCreate, S3ConfigSchemaCreate, S3ConfigSchemaSansKeys, MediaSearchSchema, BulkUpdateResponseSchema, \
     MediaErrorSchema, MediaSchemaUpdateTags, MediaSchemaUpdateStorekey, MediaSchemaUpdateIdentifiers, \
     MediaSchemaUpdateMetadata, IdentifierTypeSchema
 
+logger = logging.getLogger(__name__)
+
+
+class IdentifierTypeRegistry:
+    """
+    In-process IdentifierType name -> compiled pattern lookup, so identifier
+    validation needs no queries. Invalidated by IdentifierType save/delete
+    signals; reloaded after IDENTIFIER_REGISTRY_TTL seconds regardless, to pick
+    up changes made by other worker processes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._patterns = None
+        self._loaded_at = 0
+
+    def patterns(self) -> dict:
+        with self._lock:
+            if self._patterns is None or time.monotonic()-self._loaded_at > settings.IDENTIFIER_REGISTRY_TTL:
+                self._patterns = {name: self._compile(name, pattern)
+                                  for name,pattern in IdentifierType.objects.values_list('name','pattern')}
+                self._loaded_at = time.monotonic()
+            return self._patterns
+
+    @staticmethod
+    def _compile(name: str, pattern: str):
+        """Compiled pattern, None if unset, False if it doesn't compile: such a type matches nothing"""
+        if not pattern: return None
+        try: return re.compile(pattern)
+        except re.error as e:
+            logger.warning(f'IdentifierType {name} has a bad pattern "{pattern}": {e}')
+            return False
+
+    def invalidate(self):
+        with self._lock:
+            self._patterns = None
+
+    def __contains__(self, name: str):
+        return name in self.patterns()
+
+    def matches(self, name: str, value: str) -> bool:
+        pattern = self.patterns()[name]
+        if pattern is None: return True
+        return pattern is not False and pattern.fullmatch(value) is not None
+
+identifier_types = IdentifierTypeRegistry()
+
 
 class IdentifierTypeService:
     @staticmethod
     def serialize(idtype: IdentifierType):
         return IdentifierTypeSchema(name=idtype.name, pattern=idtype.pattern)
 
+    @staticmethod
+    def clean(idtype_schema: IdentifierTypeSchema):
+        try: re.compile(idtype_schema.pattern)
+        except re.error as e:
+            raise ValidationError([dict(error=f'bad pattern "{idtype_schema.pattern}": {e}')])
+        return idtype_schema
+
     @staticmethod
     def create(idtype_schema: IdentifierTypeSchema, as_schema=True):
+        IdentifierTypeService.clean(idtype_schema)
         idtype, idtype_created = IdentifierType.objects.get_or_create(**dict(idtype_schema))
         if as_schema: return IdentifierTypeService.serialize(idtype)
         return idtype, idtype_created
@@ -36,6 +115,7 @@ class IdentifierTypeService:
 
     @staticmethod  # PUT
     def update(idtype_schema: IdentifierTypeSchema):
+        IdentifierTypeService.clean(idtype_schema)
         idtype = IdentifierType.objects.get(name=idtype_schema.name)
         idtype.pattern = idtype_schema.pattern
         idtype.save()
@@ -74,10 +154,12 @@ class S3ConfigService:
         s3cfg.access_key = s3cfg_schema.access_key
         s3cfg.secret_key = s3cfg_schema.secret_key
         s3cfg.save()
+        store_pool.invalidate(*s3cfg.storeconfig_set.values_list('pk', flat=True))
 
     @staticmethod
     def delete(pk: int):
         s3cfg = S3Config.objects.get(pk=pk)
+        store_pool.invalidate(*s3cfg.storeconfig_set.values_list('pk', flat=True))
         s3cfg.delete()
 
     @staticmethod
@@ -134,38 +216,362 @@ class StoreService:
             raise ValidationError([dict(error=f'Only StoreConfigs of type "{StoreConfig.BUCKETSTORE}" may update s3_url field')])
         store_config.bucket = payload.bucket
         store_config.save()
+        store_pool.invalidate(store_config.pk)
 
     @staticmethod
     def delete(pk:int):
         store_config = StoreConfig.objects.get(pk=pk)
         store_config.delete()
+        store_pool.invalidate(pk)
+        if store_config.type == StoreConfig.DICTSTORE:
+            ram_storage.clear(store_config.bucket)
 
     @staticmethod
     def list_stores() -> List[StoreConfigSchema]:
-        store_configs = StoreConfig.objects.all()
+        store_configs = StoreConfig.objects.select_related('s3cfg')
         return [StoreService.serialize(store_config) for store_config in store_configs]
 
 
+class MetadataIndexService:
+    """
+    Declares "indexed metadata keys" and maintains MetadataIndexEntry rows for them,
+    so search predicates on those paths are B-tree lookups on (key,num) or (key,text).
+    Predicates on other paths fall back to JSONField lookups on Media.metadata.
+    """
+    TEXT_MAX = MetadataIndexEntry._meta.get_field('text').max_length
+    RANGE_LOOKUPS = {'lt':'lt', 'lte':'lte', 'gt':'gt', 'gte':'gte'}
+
+    @staticmethod
+    def serialize(key: IndexedMetadataKey):
+        return IndexedMetadataKeySchema(path=key.path)
+
+    @staticmethod
+    def create(payload: IndexedMetadataKeySchema, as_schema=True):
+        key, key_created = IndexedMetadataKey.objects.get_or_create(path=payload.path)
+        if key_created:
+            MetadataIndexService.reindex_key(key.path)
+        if as_schema: return MetadataIndexService.serialize(key)
+        return key, key_created
+
+    @staticmethod
+    def delete(path: str):
+        key = IndexedMetadataKey.objects.get(path=path)
+        MetadataIndexEntry.objects.filter(key=path).delete()
+        key.delete()
+
+    @staticmethod
+    def list() -> List[IndexedMetadataKeySchema]:
+        return [MetadataIndexService.serialize(key) for key in IndexedMetadataKey.objects.all()]
+
+    @staticmethod
+    def indexed_paths() -> set:
+        return set(IndexedMetadataKey.objects.values_list('path', flat=True))
+
+    @staticmethod
+    def index_value(value) -> dict:
+        # MetadataIndexEntry columns for a scalar, None if not indexable
+        if isinstance(value, bool):
+            return dict(text=str(value).lower())
+        if isinstance(value, (int, float)):
+            return dict(num=value)
+        if isinstance(value, str) and len(value) <= MetadataIndexService.TEXT_MAX:
+            return dict(text=value)
+        return None
+
+    @staticmethod
+    def entries(media: Media, paths) -> list:
+        entries = []
+        for path in paths:
+            value = media.metadata or {}
+            for key in path.split('.'):
+                value = value.get(key) if isinstance(value, dict) else None
+            for v in (value if isinstance(value, list) else [value]):
+                if (columns := MetadataIndexService.index_value(v)) is not None:
+                    entries.append(MetadataIndexEntry(media=media, key=path, **columns))
+        return entries
+
+    @staticmethod
+    def reindex(medias: list, paths: set = None):
+        # rebuilds the entries of the given media, to be called from every metadata write path
+        paths = MetadataIndexService.indexed_paths() if paths is None else paths
+        if not paths or not medias: return
+        with transaction.atomic():
+            MetadataIndexEntry.objects.filter(media__in=[media.pk for media in medias]).delete()
+            MetadataIndexEntry.objects.bulk_create(
+                [entry for media in medias for entry in MetadataIndexService.entries(media, paths)])
+
+    @staticmethod
+    def reindex_key(path: str, chunk_size: int = 2000):
+        # (re)builds one key's entries across all media
+        with transaction.atomic():
+            MetadataIndexEntry.objects.filter(key=path).delete()
+            batch = []
+            for media in Media.objects.only('pk','metadata').iterator(chunk_size=chunk_size):
+                batch.extend(MetadataIndexService.entries(media, [path]))
+                if len(batch) >= chunk_size:
+                    MetadataIndexEntry.objects.bulk_create(batch)
+                    batch = []
+            MetadataIndexEntry.objects.bulk_create(batch)
+
+    @staticmethod
+    def query(query: MetadataQuerySchema, indexed_paths: set = None) -> Q:
+        indexed_paths = MetadataIndexService.indexed_paths() if indexed_paths is None else indexed_paths
+        def compile(node):
+            if isinstance(node, MetadataPredicateSchema):
+                return MetadataIndexService.predicate(node, indexed_paths)
+            andQ = reduce(and_, [compile(n) for n in node.all], Q())
+            orQs = [compile(n) for n in node.any]
+            return andQ & reduce(or_, orQs) if orQs else andQ
+        return compile(query)
+
+    @staticmethod
+    def predicate(pred: MetadataPredicateSchema, indexed_paths: set) -> Q:
+        if not pred.path or any('__' in key or '.' in key for key in pred.path):
+            raise ValidationError([dict(error=f'bad metadata path: {pred.path}')])
+        values = pred.value if pred.op == 'in' else [pred.value]
+        if pred.op == 'in' and not isinstance(values, list):
+            raise ValidationError([dict(error=f'"in" predicate value must be a list: {pred.path}')])
+        if not values:
+            return Q(pk__in=[])
+        if pred.op == 'ne':
+            return ~MetadataIndexService.predicate(pred.model_copy(update=dict(op='eq')), indexed_paths)
+
+        path = '.'.join(pred.path)
+        if path in indexed_paths and pred.op != 'exists':
+            columns = [MetadataIndexService.index_value(v) for v in values]
+            if None in columns:
+                raise ValidationError([dict(error=f'value not indexable for {path}: {pred.value}')])
+            entryQs = []
+            for column in columns:
+                (field, value), = column.items()
+                lookup = MetadataIndexService.RANGE_LOOKUPS.get(pred.op, 'exact')
+                entryQs.append(Q(**{f'{field}__{lookup}': value}))
+            entries = MetadataIndexEntry.objects.filter(Q(key=path) & reduce(or_, entryQs))
+            return Q(pk__in=entries.values('media'))
+        if path in indexed_paths:
+            return Q(pk__in=MetadataIndexEntry.objects.filter(key=path).values('media'))
+
+        # unindexed path, JSONField lookups
+        lookup = 'metadata__' + '__'.join(pred.path)
+        if pred.op == 'exists':
+            parent = '__'.join(['metadata', *pred.path[:-1]])
+            return Q(**{f'{parent}__has_key': pred.path[-1]})
+        if pred.op in MetadataIndexService.RANGE_LOOKUPS:
+            return Q(**{f'{lookup}__{pred.op}': pred.value})
+        if connection.vendor == 'postgresql':
+            # containment can use the GIN index on metadata
+            def nested(value):
+                for key in reversed(pred.path): value = {key: value}
+                return value
+            return reduce(or_, [Q(metadata__contains=nested(v)) for v in values])
+        return reduce(or_, [Q(**{lookup: v}) for v in values])
+
+
+class IdentifierIndexService:
+    """
+    Maintains MediaIdentifier rows, one per (type, value) of each media including
+    its pid, so pid and identifier lookups are index scans instead of JSON scans.
+    """
+    @staticmethod
+    def entries(media: Media) -> list:
+        identifiers = {**(media.identifiers or {}), media.pid_type: media.pid}
+        return [MediaIdentifier(media=media, type=type, value=value) for type,value in identifiers.items()]
+
+    @staticmethod
+    def reindex(medias: list):
+        # rebuilds the entries of the given media, to be called wherever pid, pid_type or identifiers change
+        if not medias: return
+        with transaction.atomic():
+            MediaIdentifier.objects.filter(media__in=[media.pk for media in medias]).delete()
+            MediaIdentifier.objects.bulk_create(
+                [entry for media in medias for entry in IdentifierIndexService.entries(media)])
+
+    @staticmethod
+    def reindex_all(chunk_size: int = 2000):
+        with transaction.atomic():
+            MediaIdentifier.objects.all().delete()
+            batch = []
+            for media in Media.objects.only('pk','pid','pid_type','identifiers').iterator(chunk_size=chunk_size):
+                batch.extend(IdentifierIndexService.entries(media))
+                if len(batch) >= chunk_size:
+                    MediaIdentifier.objects.bulk_create(batch)
+                    batch = []
+            MediaIdentifier.objects.bulk_create(batch)
+
+    @staticmethod
+    def predicate(query: IdentifierQuerySchema) -> Q:
+        entryQ = Q(type=query.type) if query.type else Q()
+        match query.match:
+            case 'exact':
+                entryQ &= Q(value=query.value)
+            case 'prefix':
+                entryQ &= Q(value__startswith=query.value)
+            case 'wildcard':
+                # the literal head narrows on the B-tree index, the regex checks the rest
+                # (on postgres the trigram index serves unanchored patterns too)
+                head = re.split(r'[*?]', query.value, maxsplit=1)[0]
+                if head == query.value:
+                    entryQ &= Q(value=head)
+                elif query.value == head+'*':
+                    entryQ &= Q(value__startswith=head)
+                else:
+                    regex = ''.join({'*':'.*', '?':'.'}.get(c, re.escape(c)) for c in query.value)
+                    entryQ &= Q(value__regex=f'^{regex}$')
+                    if head: entryQ &= Q(value__startswith=head)
+        return Q(pk__in=MediaIdentifier.objects.filter(entryQ).values('media'))
+
+
+class FullTextService:
+    """
+    Maintains MediaSearchDocument rows and queries the search vector built over them:
+    an FTS5 table on SQLite, a tsvector column with a GIN index on PostgreSQL
+    (see signals.ensure_fulltext_vector). Other databases get unranked substring matching.
+    """
+    FTS_TABLE = 'mediastore_mediasearchdocument_fts'
+    TS_CONFIG = 'simple'  # no stemming or stopwords, station names and cruise ids are not english
+
+    @staticmethod
+    def strings(value):
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, dict):
+            for v in value.values(): yield from FullTextService.strings(v)
+        elif isinstance(value, list):
+            for v in value: yield from FullTextService.strings(v)
+
+    @staticmethod
+    def document(media: Media, tags) -> str:
+        return '\n'.join([media.pid, *(media.identifiers or {}).values(), *tags,
+                          *FullTextService.strings(media.metadata)])
+
+    @staticmethod
+    def reindex(medias: list):
+        # rebuilds the documents of the given, up to date, media instances,
+        # to be called wherever pid, identifiers, tags or metadata change
+        if not medias: return
+        tags = {}
+        for media_pk, name in TaggedItem.objects.filter(
+                content_type=ContentType.objects.get_for_model(Media),
+                object_id__in=[media.pk for media in medias]).values_list('object_id', 'tag__name'):
+            tags.setdefault(media_pk, []).append(name)
+        MediaSearchDocument.objects.bulk_create(
+            [MediaSearchDocument(media=media, document=FullTextService.document(media, tags.get(media.pk, [])))
+             for media in medias],
+            update_conflicts=True, unique_fields=['media'], update_fields=['document'])
+
+    @staticmethod
+    def reindex_all(chunk_size: int = 2000):
+        with transaction.atomic():
+            MediaSearchDocument.objects.all().delete()
+            medias = Media.objects.prefetch_related('tags').iterator(chunk_size=chunk_size)
+            batch = []
+            for media in medias:
+                batch.append(MediaSearchDocument(media=media, document=FullTextService.document(
+                    media, [tag.name for tag in media.tags.all()])))
+                if len(batch) >= chunk_size:
+                    MediaSearchDocument.objects.bulk_create(batch)
+                    batch = []
+            MediaSearchDocument.objects.bulk_create(batch)
+
+    @staticmethod
+    def words(text: str) -> List[str]:
+        return re.findall(r'\w+', text)
+
+    @staticmethod
+    def search(medias, text: str):
+        """Filters a Media queryset to those matching all words of text, annotated with text_rank (lower is better)"""
+        words = FullTextService.words(text)
+        if not words:
+            return medias.none()
+        match connection.vendor:
+            case 'sqlite':
+                query = ' '.join(f'"{word}"' for word in words)
+                matches = RawSQL(f'SELECT rowid FROM {FullTextService.FTS_TABLE} WHERE {FullTextService.FTS_TABLE} MATCH %s', (query,))
+                rank = RawSQL(f'SELECT bm25({FullTextService.FTS_TABLE}) FROM {FullTextService.FTS_TABLE} '
+                              f'WHERE {FullTextService.FTS_TABLE} MATCH %s AND rowid = mediastore_media.id', (query,))
+            case 'postgresql':
+                tsquery = f"plainto_tsquery('{FullTextService.TS_CONFIG}', %s)"
+                matches = RawSQL(f'SELECT media_id FROM mediastore_mediasearchdocument WHERE vector @@ {tsquery}', (text,))
+                rank = RawSQL(f'SELECT -ts_rank(vector, {tsquery}) FROM mediastore_mediasearchdocument '
+                              f'WHERE media_id = mediastore_media.id', (text,))
+            case _:
+                docs = MediaSearchDocument.objects.filter(
+                    reduce(and_, [Q(document__icontains=word) for word in words]))
+                return medias.filter(pk__in=docs.values('media')).annotate(text_rank=RawSQL('0', ()))
+        return medias.filter(pk__in=matches).annotate(text_rank=rank)
+
+
 class MediaService:
     @staticmethod
-    def serialize(media: Media) -> MediaSchema:
+    def queryset():
+        # everything serialize() touches, fetched in a fixed number of queries
+        return Media.objects.select_related('store_config__s3cfg').prefetch_related('tags')
+
+    @staticmethod
+    def serialize(media: Media, store_config_schema: StoreConfigSchema = None) -> MediaSchema:
         return MediaSchema(
             pk = media.pk,
             pid = media.pid,
             pid_type = media.pid_type,
-            store_config = StoreService.serialize(media.store_config),
+            store_config = store_config_schema or StoreService.serialize(media.store_config),
             store_key = media.store_key,
             store_status = media.store_status,
             identifiers = media.identifiers,
             metadata = media.metadata,
-            tags = media.tags.names()
+            tags = [tag.name for tag in media.tags.all()]  # .all() is served from prefetch cache if present
         )
 
+    @staticmethod
+    def paginate(medias, limit: int = None, cursor: str = None):
+        # keyset pagination on pk, the cursor being the signed pk of the previous page's last media
+        if limit is None and cursor is None:
+            return medias
+        if limit is not None and limit < 1:
+            raise ValidationError([dict(error=f'limit must be positive')])
+        limit = min(settings.MEDIA_PAGE_SIZE if limit is None else limit, settings.MEDIA_PAGE_SIZE_MAX)
+        medias = medias.order_by('pk')
+        if cursor:
+            try: last_pk = signing.loads(cursor, salt='mediastore.cursor')
+            except signing.BadSignature:
+                raise ValidationError([dict(error=f'bad cursor: {cursor}')])
+            medias = medias.filter(pk__gt=last_pk)
+        return medias[:limit]
+
+    @staticmethod
+    def next_cursor(page: List[MediaSchema], limit: int = None) -> Union[str,None]:
+        # a full page may have a successor, a short page is the last one
+        limit = min(settings.MEDIA_PAGE_SIZE if limit is None else limit, settings.MEDIA_PAGE_SIZE_MAX)
+        if not page or len(page) < limit:
+            return None
+        return signing.dumps(page[-1].pk, salt='mediastore.cursor')
+
+    @staticmethod
+    def iter_serialized(medias):
+        # StoreConfigSchema is built once per store_config rather than once per media
+        store_config_schemas = {}
+        for media in medias:
+            if media.store_config_id not in store_config_schemas:
+                store_config_schemas[media.store_config_id] = StoreService.serialize(media.store_config)
+            yield MediaService.serialize(media, store_config_schemas[media.store_config_id])
+
+    @staticmethod
+    def serialize_many(medias) -> List[MediaSchema]:
+        return list(MediaService.iter_serialized(medias))
+
+    @staticmethod
+    def export_ndjson(chunk_size: int = 2000):
+        # one json MediaSchema per line. iterator() streams rows from a server-side cursor,
+        # prefetching tags per chunk, so memory stays constant over the whole catalogue
+        medias = MediaService.queryset().order_by('pk').iterator(chunk_size=chunk_size)
+        for media_schema in MediaService.iter_serialized(medias):
+            yield media_schema.model_dump_json() + '\n'
+
     @staticmethod
     def create(payload: MediaSchemaCreate, as_schema=True) -> MediaSchema:
         MediaService.clean_identifiers(payload)
         store_key = str(uuid.uuid4())  # CREATE STORE KEY #
         store_config,storeconfig_created = StoreService.create(payload.store_config, as_schema=False)
+        MediaService.clean_store_key(store_config, store_key)
         try:
             media = Media.objects.create(
                 pid = payload.pid,
@@ -182,22 +588,121 @@ class MediaService:
             else:
                 raise ValidationError([dict(error=f'{type(e)}:{e}')])
         media.tags.set(payload.tags)
+        MetadataIndexService.reindex([media])
+        IdentifierIndexService.reindex([media])
+        FullTextService.reindex([media])
         if as_schema: return MediaService.serialize(media)
         return media
 
+    @staticmethod
+    def bulk_create(payloads: List[MediaSchemaCreate], partial: bool = True, batch_size: int = 1000):
+        """
+        Creates many media with a fixed number of queries per batch.
+        Returns (created medias, failures as MediaErrorSchema). If not partial,
+        nothing is created when any payload fails validation.
+        """
+        taken_pids = set(Media.objects.filter(pid__in=[p.pid for p in payloads]).values_list('pid', flat=True))
+        store_configs = {}  # (type,bucket,s3_url) -> StoreConfig or the error creating it
+
+        failures, medias, tags = [], [], {}
+        for payload in payloads:
+            try:
+                if payload.pid in taken_pids:
+                    raise ValidationError([dict(error=f'pid "{payload.pid}" is not unique')])
+                MediaService.clean_identifiers(payload)
+                sc_key = (payload.store_config.type, payload.store_config.bucket, payload.store_config.s3_url)
+                if sc_key not in store_configs:
+                    try: store_configs[sc_key],_ = StoreService.create(payload.store_config, as_schema=False)
+                    except Exception as e: store_configs[sc_key] = e
+                if isinstance(store_configs[sc_key], Exception):
+                    raise store_configs[sc_key]
+                store_key = str(uuid.uuid4())  # CREATE STORE KEY #
+                MediaService.clean_store_key(store_configs[sc_key], store_key)
+            except Exception as e:
+                failures.append( MediaErrorSchema(pid=payload.pid, error=str(type(e)), msg=str(e)) )
+                continue
+            taken_pids.add(payload.pid)
+            media = Media(
+                pid = payload.pid,
+                pid_type = payload.pid_type,
+                store_config = store_configs[sc_key],
+                store_key = store_key,
+                store_status = StoreConfig.PENDING,
+                identifiers = payload.identifiers, # already cleaned
+                metadata = payload.metadata,
+            )
+            medias.append(media)
+            tags[media.pid] = payload.tags
+
+        if failures and not partial:
+            raise ValidationError([dict(failure) for failure in failures])
+
+        created = []
+        indexed_paths = MetadataIndexService.indexed_paths()
+        def create_batch(batch):
+            try:
+                with transaction.atomic():
+                    batch = bulk_create_with_history(batch, Media, batch_size=batch_size)
+                    MediaService.bulk_set_tags({media: tags[media.pid] for media in batch})
+                    MetadataIndexService.reindex(batch, indexed_paths)
+                    IdentifierIndexService.reindex(batch)
+                    FullTextService.reindex(batch)
+                return batch
+            except IntegrityError:
+                for media in batch:  # rolled back, the pks bulk_create assigned are void
+                    media.pk, media._state.adding = None, True
+                raise
+
+        with nullcontext() if partial else transaction.atomic():
+            for i in range(0, len(medias), batch_size):
+                batch = medias[i:i+batch_size]
+                try:
+                    created.extend(create_batch(batch))
+                except IntegrityError as e:
+                    if not partial:
+                        raise ValidationError([dict(error=f'{type(e)}:{e}')])
+                    # a conflict only the database caught, eg. a concurrent insert: retry one by one to fail only its rows
+                    for media in batch:
+                        try:
+                            created.extend(create_batch([media]))
+                        except IntegrityError as e:
+                            failures.append( MediaErrorSchema(pid=media.pid, error=str(type(e)), msg=str(e)) )
+        return created, failures
+
+    @staticmethod
+    def bulk_set_tags(tags_by_media: dict, replace: bool = False):
+        # taggit's manager does a few queries per media and tag; this inserts all through-rows at once
+        medias = [media for media in tags_by_media]
+        names = {name for tags in tags_by_media.values() for name in tags}
+        tag_objs = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+        if missing := names - tag_objs.keys():
+            Tag.objects.bulk_create([Tag(name=name, slug=slugify(name)) for name in missing], ignore_conflicts=True)
+            tag_objs.update({tag.name: tag for tag in Tag.objects.filter(name__in=missing)})
+            for name in names - tag_objs.keys():  # slug collisions, let taggit pick a unique slug
+                tag_objs[name] = Tag.objects.create(name=name)
+
+        content_type = ContentType.objects.get_for_model(Media)
+        if replace:
+            TaggedItem.objects.filter(content_type=content_type, object_id__in=[m.pk for m in medias]).delete()
+        TaggedItem.objects.bulk_create([
+            TaggedItem(content_type=content_type, object_id=media.pk, tag=tag_objs[name])
+            for media,tags in tags_by_media.items() for name in set(tags)], ignore_conflicts=True)
+
     @staticmethod
     def read(pid: str) -> MediaSchema:
-        media = Media.objects.get(pid=pid)
+        media = media_cache.get(pid)
         return MediaService.serialize(media)
 
     @staticmethod
-    def bulk_read(pids: List[str]) -> List[MediaSchema]:
-        medias = Media.objects.filter(pid__in=pids)
-        return [MediaService.serialize(media) for media in medias]
+    def bulk_read(pids: List[str], limit: int = None, cursor: str = None) -> List[MediaSchema]:
+        medias = MediaService.queryset().filter(pid__in=pids)
+        medias = MediaService.paginate(medias, limit, cursor)
+        return MediaService.serialize_many(medias)
 
     @staticmethod
     def patch(payload: MediaSchemaUpdate) -> None:
         media = Media.objects.get(pid=payload.pid)
+        media_cache.invalidate(payload.pid)  # saving only invalidates the new pid
         if payload.new_pid:
             media.pid = payload.new_pid
         if payload.pid_type:
@@ -208,9 +713,35 @@ class MediaService:
         elif isinstance(payload.store_config,StoreConfigSchemaCreate):
             store_config, storeconfig_created = StoreService.create(payload.store_config, as_schema=False)
             media.store_config = store_config
+        MediaService.clean_store_key(media.store_config, media.store_key, media.store_status)
         media.save()
+        if payload.new_pid or payload.pid_type:
+            IdentifierIndexService.reindex([media])
+        if payload.new_pid:
+            FullTextService.reindex([media])
         return media
 
+    @staticmethod
+    def access_stale(media: Media) -> bool:
+        resolution = timedelta(seconds=settings.TIERING_ACCESS_RESOLUTION)
+        return media.last_accessed is None or media.last_accessed < timezone.now() - resolution
+
+    @staticmethod
+    def touch(media: Media):
+        """
+        Records a download in last_accessed, at most once per TIERING_ACCESS_RESOLUTION and without a history record.
+        The cached media keeps its older last_accessed, media_cache.mark_accessed spares the repeat updates.
+        """
+        if MediaService.access_stale(media) and media_cache.mark_accessed(media.pid, settings.TIERING_ACCESS_RESOLUTION):
+            MediaService.record_access(media)
+
+    @staticmethod
+    def record_access(media: Media):
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=settings.TIERING_ACCESS_RESOLUTION)
+        Media.objects.filter(Q(last_accessed__isnull=True)|Q(last_accessed__lt=cutoff), pk=media.pk).update(last_accessed=now)
+        media.last_accessed = now
+
     @staticmethod
     def update_status(pid:str, status:str) -> str:
         media = Media.objects.get(pid=pid)
@@ -220,24 +751,48 @@ class MediaService:
 
     @staticmethod
     def delete(pid: str, del_stored=True) -> None:
-        media = Media.objects.get(pid=pid)
-        store_obj_deleted = None
-        try:
-            if del_stored and media.store_status==StoreConfig.READY:
-                if media.store_config.storage_is_context_managed:
-                    with media.store_config.get_storage_store() as store:
-                        store_obj_deleted = store.delete(media.store_key)
-                else:
-                    store = media.store_config.get_storage_store()
-                    store_obj_deleted = store.delete(media.store_key)
-        except KeyError as e:
-            print(type(e),e)
-        return media.delete()
+        with transaction.atomic():
+            media = Media.objects.select_related('store_config').get(pid=pid)
+            content_addressed = stores.is_content_addressed(media.store_config)
+            if content_addressed:
+                MediaService.lock_content(media.store_config, media.store_key)
+            read_cache.invalidate(media)
+            deleted = media.delete()
+            if content_addressed:
+                # content is shared by all media of the same checksum, the last reference deletes it
+                del_stored = del_stored and not Media.objects.filter(store_config=media.store_config, store_key=media.store_key).exists()
+            try:
+                if del_stored and media.store_status==StoreConfig.READY:
+                    with open_store(media.store_config) as store:
+                        store.delete(media.store_key)
+            except KeyError as e:
+                logger.warning('stored object of %s was already gone: %s', pid, e)
+        return deleted
+
+    @staticmethod
+    def lock_content(store_config: StoreConfig, store_key: str):
+        """
+        Locks the media referencing a content-addressed object until the end of the transaction.
+        Deleting a reference and pointing a media at the content both lock, write their row, then
+        check the other side, so the last delete and a new reference never miss each other.
+        """
+        return list(Media.objects.select_for_update().filter(store_config=store_config, store_key=store_key).values_list('pk', flat=True))
 
     @staticmethod
-    def list_media() -> List[MediaSchema]:
-        medias = Media.objects.all()
-        return [MediaService.serialize(media) for media in medias]
+    def clean_store_key(store_config: StoreConfig, store_key: str, store_status: str = StoreConfig.PENDING):
+        # content keys are shared between media, only a content-addressed store may hold them
+        content_key = store_key.startswith(stores.CONTENT_KEY_PREFIX)
+        if content_key and not stores.is_content_addressed(store_config):
+            raise ValidationError([dict(error=f'store_key "{store_key}": only {StoreConfig.HASHDIRSTORE} store_configs take "{stores.CONTENT_KEY_PREFIX}" keys')])
+        if not content_key and stores.is_content_addressed(store_config) and store_status == StoreConfig.READY:
+            raise ValidationError([dict(error=f'store_key "{store_key}": stored media of a {StoreConfig.HASHDIRSTORE} are keyed "{stores.CONTENT_KEY_PREFIX}<sha256>"')])
+        return store_key
+
+    @staticmethod
+    def list_media(limit: int = None, cursor: str = None) -> List[MediaSchema]:
+        medias = MediaService.queryset().all()
+        medias = MediaService.paginate(medias, limit, cursor)
+        return MediaService.serialize_many(medias)
 
     @staticmethod
     def clean_identifiers(payload: Union[MediaSchemaCreate,MediaSchemaUpdateIdentifiers], media_obj: Union[Media,None] = None):
@@ -247,57 +802,131 @@ class MediaService:
         else:
             pid, pid_type = payload.pid, payload.pid_type
 
-        if not IdentifierType.objects.filter(name=pid_type).exists():
+        if pid_type not in identifier_types:
             raise ValidationError([dict(error=f'bad pid_type: {pid_type}')])
-        pid_type_obj = IdentifierType.objects.get(name=pid_type)
-        # TODO validate pid against pid_type_object.pattern
+        if not identifier_types.matches(pid_type, pid):
+            raise ValidationError([dict(error=f'pid "{pid}" does not match pid_type {pid_type} pattern')])
 
         for key, val in payload.identifiers.items():
-            if not IdentifierType.objects.filter(name=key).exists():
+            if key not in identifier_types:
                 raise ValidationError([dict(error=f'bad identifier_type: {key}')])
             if key == pid_type:
                 if not val == pid: raise ValidationError([dict(error=f'duplicate pid_type in identifiers DO NOT MATCH: media[{pid_type}]:{pid} =! identifier[{key}]:{val}')])
                 pop_me = key
-            idtype_obj = IdentifierType.objects.get(name=key)
-            # TODO validate val against idtype_obj.pattern
+            elif not identifier_types.matches(key, val):
+                raise ValidationError([dict(error=f'identifier "{val}" does not match identifier_type {key} pattern')])
 
         if pop_me: payload.identifiers.pop(pop_me)
         return payload.identifiers
 
     @staticmethod
-    def search(payload: MediaSearchSchema) -> List[MediaSchema]:
+    def search(payload: MediaSearchQuerySchema, limit: int = None, cursor: str = None) -> List[MediaSchema]:
+        medias = MediaService.search_queryset(payload)
+        medias = MediaService.paginate(medias, limit, cursor)
+        return MediaService.serialize_many(medias)
+
+    @staticmethod
+    def search_queryset(payload: MediaSearchQuerySchema):
         andQs = []
-        tagsQ = Q(tags__name__in=payload.tags)
-        andQs.append(tagsQ)
+        if payload.tags:
+            tagsQ = Q(tags__name__in=payload.tags)
+            andQs.append(tagsQ)
+        if getattr(payload, 'metadata', None):
+            andQs.append( MetadataIndexService.query(payload.metadata) )
+        for identifier_query in getattr(payload, 'identifiers', None) or []:
+            andQs.append( IdentifierIndexService.predicate(identifier_query) )
         # TODO other search vectors
-        medias = Media.objects.filter( reduce(and_,andQs) )
-        return [MediaService.serialize(media) for media in medias]
+        medias = MediaService.queryset().filter( reduce(and_,andQs,Q()) ).distinct()
+        if getattr(payload, 'text', None):
+            medias = FullTextService.search(medias, payload.text).order_by('text_rank', 'pk')
+        return medias
+
+    @staticmethod
+    def bulk_update(payloads: list, apply=None, fields: List[str] = (), tags: str = None,
+                    chunk_size: int = 1000) -> BulkUpdateResponseSchema:
+        """
+        Set-based counterpart of the update_* functions. Per chunk, all target media are
+        loaded in one query, apply(media, payload) mutates them in memory, and the changed
+        fields are written back with one bulk_update (plus history) in one transaction.
+        tags="add"|"put" applies payload.tags with batched taggit writes instead.
+        """
+        successes, failures = [], []
+        for i in range(0, len(payloads), chunk_size):
+            chunk = payloads[i:i+chunk_size]
+            medias = Media.objects.select_related('store_config__s3cfg').in_bulk([payload.pid for payload in chunk], field_name='pid')
+            changed, tags_by_media, chunk_successes = {}, {}, []
+            for payload in chunk:
+                try:
+                    if payload.pid not in medias:
+                        raise Media.DoesNotExist('Media matching query does not exist.')
+                    media = medias[payload.pid]
+                    if apply: apply(media, payload)
+                    if tags == 'add': tags_by_media.setdefault(media, set()).update(payload.tags)
+                    elif tags == 'put': tags_by_media[media] = set(payload.tags)
+                    changed[media.pk] = media
+                    chunk_successes.append(payload.pid)
+                except Exception as e:
+                    failures.append( MediaErrorSchema(pid=payload.pid, error=str(type(e)), msg=str(e)) )
+            try:
+                with transaction.atomic():
+                    if fields and changed:
+                        bulk_update_with_history(list(changed.values()), Media, list(fields), batch_size=chunk_size)
+                    if tags_by_media:
+                        MediaService.bulk_set_tags(tags_by_media, replace=tags=='put')
+                    if 'metadata' in fields:
+                        MetadataIndexService.reindex(list(changed.values()))
+                    if 'identifiers' in fields:
+                        IdentifierIndexService.reindex(list(changed.values()))
+                    if tags_by_media or {'identifiers','metadata'} & set(fields):
+                        FullTextService.reindex(list(changed.values()))
+            except Exception as e:
+                failures.extend( MediaErrorSchema(pid=pid, error=str(type(e)), msg=str(e)) for pid in chunk_successes )
+                continue
+            successes.extend(chunk_successes)
+            media_cache.invalidate(*chunk_successes)  # bulk writes send no post_save
+        return BulkUpdateResponseSchema(successes=successes, failures=failures)
 
     @staticmethod
     def update_tags_add(payload: MediaSchemaUpdateTags):
         media = Media.objects.get(pid=payload.pid)
+        media_cache.invalidate(media.pid)
         media.tags.add(*payload.tags)
+        FullTextService.reindex([media])
 
     @staticmethod
     def update_tags_put(payload: MediaSchemaUpdateTags):
         media = Media.objects.get(pid=payload.pid)
+        media_cache.invalidate(media.pid)
         media.tags.set(payload.tags)
+        FullTextService.reindex([media])
+
+    @staticmethod
+    def apply_storekey(media: Media, payload: MediaSchemaUpdateStorekey):
+        MediaService.clean_store_key(media.store_config, payload.store_key, media.store_status)
+        if media.store_key != payload.store_key:
+            read_cache.invalidate(media)
+        media.store_key = payload.store_key
 
     @staticmethod
     def update_storekey(payload: MediaSchemaUpdateStorekey):
         media = Media.objects.get(pid=payload.pid)
-        media.store_key = payload.store_key
+        MediaService.apply_storekey(media, payload)
         media.save()
 
+    @staticmethod
+    def apply_identifiers(media: Media, payload: MediaSchemaUpdateIdentifiers):
+        media.identifiers = MediaService.clean_identifiers(payload, media)
+
     @staticmethod
     def update_identifiers(payload: MediaSchemaUpdateIdentifiers):
         media = Media.objects.get(pid=payload.pid)
-        media.identifiers = MediaService.clean_identifiers(payload,media)
+        MediaService.apply_identifiers(media, payload)
         media.save()
+        IdentifierIndexService.reindex([media])
+        FullTextService.reindex([media])
 
     @staticmethod
-    def update_metadata_put(payload: MediaSchemaUpdateMetadata):
-        media = Media.objects.get(pid=payload.pid)
+    def apply_metadata_put(media: Media, payload: MediaSchemaUpdateMetadata):
         if payload.keys:
             dic = media.metadata
             for key in payload.keys[:-1]:
@@ -305,11 +934,17 @@ class MediaService:
             media.metadata[payload.keys[-1]] = payload.data
         else:
             media.metadata = payload.data
-        media.save()
 
     @staticmethod
-    def update_metadata_patch(payload: MediaSchemaUpdateMetadata):
+    def update_metadata_put(payload: MediaSchemaUpdateMetadata):
         media = Media.objects.get(pid=payload.pid)
+        MediaService.apply_metadata_put(media, payload)
+        media.save()
+        MetadataIndexService.reindex([media])
+        FullTextService.reindex([media])
+
+    @staticmethod
+    def apply_metadata_patch(media: Media, payload: MediaSchemaUpdateMetadata):
         if payload.keys:
             dic = media.metadata
             for key in payload.keys[:-1]:
@@ -317,12 +952,17 @@ class MediaService:
             dic[payload.keys[-1]].update(payload.data)
         else:
             media.metadata.update(payload.data)
-        media.save()
 
     @staticmethod
-    def update_metadata_delete(payload: MediaSchemaUpdateMetadata):
+    def update_metadata_patch(payload: MediaSchemaUpdateMetadata):
         media = Media.objects.get(pid=payload.pid)
+        MediaService.apply_metadata_patch(media, payload)
+        media.save()
+        MetadataIndexService.reindex([media])
+        FullTextService.reindex([media])
 
+    @staticmethod
+    def apply_metadata_delete(media: Media, payload: MediaSchemaUpdateMetadata):
         dic = media.metadata
         if payload.keys:
             for key in payload.keys[:-1]:
@@ -330,5 +970,116 @@ class MediaService:
             del dic[payload.keys[-1]]
         else:
             media.metadata = None
+
+    @staticmethod
+    def update_metadata_delete(payload: MediaSchemaUpdateMetadata):
+        media = Media.objects.get(pid=payload.pid)
+        MediaService.apply_metadata_delete(media, payload)
         media.save()
+        MetadataIndexService.reindex([media])
+        FullTextService.reindex([media])
 
+
+class TieringService:
+    @staticmethod
+    def medias(policy: TieringPolicy, now=None):
+        """READY media of policy.source old or idle enough to move"""
+        now = now or timezone.now()
+        due = Q(pk__in=[])
+        if policy.min_age_days is not None:
+            due |= Q(created__lt=now-timedelta(days=policy.min_age_days))
+        if policy.min_idle_days is not None:
+            idle_since = now-timedelta(days=policy.min_idle_days)
+            due |= Q(last_accessed__lt=idle_since) | Q(last_accessed__isnull=True, created__lt=idle_since)
+        return Media.objects.select_related('store_config__s3cfg').filter(
+            due, store_config=policy.source_id, store_status=StoreConfig.READY).order_by('pk')
+
+    @staticmethod
+    def copy(media: Media, target: StoreConfig, throttle: stores.Throttle):
+        """
+        Streams media's object into target, without database access. Returns (key in target, size,
+        sha256 hexdigest of the copy, sha256 hexdigest expected). The expected one is media.checksum,
+        or for media stored before checksums were kept, that of a separate read of the source.
+        """
+        expected = media.checksum
+        if not expected:
+            sha256 = hashlib.sha256()
+            for chunk in throttle.chunks(stores.iter_chunks(media.store_config, media.store_key)):
+                sha256.update(chunk)
+            expected = sha256.hexdigest()
+        key = str(uuid.uuid4())
+        chunks = throttle.chunks(stores.iter_chunks(media.store_config, media.store_key))
+        size, checksum = stores.write_chunks(target, key, chunks)
+        if stores.is_content_addressed(target):
+            key = stores.content_key(checksum)
+        return key, size, checksum, expected
+
+    @staticmethod
+    def discard(store_config: StoreConfig, key: str):
+        with transaction.atomic():
+            # content-addressed objects may still be, or be about to be, another media's content
+            if stores.is_content_addressed(store_config) and MediaService.lock_content(store_config, key):
+                return
+            with suppress(KeyError), open_store(store_config) as store:
+                store.delete(key)
+
+    @staticmethod
+    def swap(media: Media, target: StoreConfig, key: str, size: int, checksum: str):
+        """
+        Points media at its copy in target with one save, one history record, unless it changed
+        while being copied. Then drops the source object
+        """
+        with transaction.atomic():
+            current = Media.objects.select_for_update().get(pk=media.pk)
+            if (current.store_config_id, current.store_key, current.store_status) != (media.store_config_id, media.store_key, StoreConfig.READY):
+                raise ValueError(f'{media.pid} changed while being moved')
+            if stores.is_content_addressed(target):
+                MediaService.lock_content(target, key)
+            read_cache.invalidate(media)
+            current.store_config, current.store_key, current.size, current.checksum = target, key, size, checksum
+            current.save()
+            with open_store(target) as store:
+                if not store.exists(key):
+                    raise KeyError(f'copy of {media.pid} was deleted before it was referenced')
+        TieringService.discard(media.store_config, media.store_key)
+
+    @staticmethod
+    def run(policies=None, batch_size: int = 100, workers: int = None, bandwidth: int = None, limit: int = None):
+        """
+        Moves the due media of each enabled policy (or of the given ones) to its target, at most limit per policy.
+        Copies run on `workers` threads, throttled together to `bandwidth` bytes per second so that
+        foreground requests keep the store and network. The media rows are only touched from
+        this thread. Yields (policy, moved, failures) per batch.
+        """
+        workers = workers or settings.TIERING_WORKERS
+        throttle = stores.Throttle(settings.TIERING_BANDWIDTH if bandwidth is None else bandwidth)
+        if policies is None:
+            policies = TieringPolicy.objects.filter(enabled=True).select_related('target__s3cfg')
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tiering') as executor:
+            for policy in policies:
+                stores.preload([policy.target])
+                last_pk, remaining = 0, limit
+                while remaining is None or remaining > 0:
+                    batch = list(TieringService.medias(policy).filter(pk__gt=last_pk)[:min(batch_size, remaining or batch_size)])
+                    if not batch: break
+                    last_pk = batch[-1].pk
+                    def copy(media):
+                        try: return TieringService.copy(media, policy.target, throttle)
+                        except Exception as e: return e
+                    moved, failures = 0, []
+                    for media, copied in zip(batch, executor.map(copy, batch)):
+                        try:
+                            if isinstance(copied, Exception): raise copied
+                            key, size, checksum, expected = copied
+                            try:
+                                if checksum != expected or (media.size is not None and size != media.size):
+                                    raise ValueError(f'copy of {media.pid} does not match its checksum')
+                                TieringService.swap(media, policy.target, key, size, checksum)
+                            except Exception:
+                                TieringService.discard(policy.target, key)
+                                raise
+                            moved += 1
+                        except Exception as e:
+                            failures.append( MediaErrorSchema(pid=media.pid, error=str(type(e)), msg=str(e)) )
+                    if remaining is not None: remaining -= len(batch)
+                    yield policy, moved, failures
@@ -0,0 +1,96 @@
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Min, OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from mediastore.models import IdentifierType, Media, StoreConfig, S3Config
+from mediastore.cache import media_cache
+from mediastore.services import identifier_types, FullTextService
+
+
+@receiver([post_save, post_delete], sender=IdentifierType)
+def invalidate_identifier_types(sender, **kwargs):
+    identifier_types.invalidate()
+
+
+@receiver(post_migrate)
+def ensure_metadata_gin_index(sender, using, **kwargs):
+    # postgres only: lets unindexed-path metadata equality (jsonb @>) use an index
+    if sender.name != 'mediastore' or connections[using].vendor != 'postgresql':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE INDEX IF NOT EXISTS mediastore_media_metadata_gin '
+                       'ON mediastore_media USING gin (metadata jsonb_path_ops)')
+
+
+@receiver(post_migrate)
+def ensure_identifier_trigram_index(sender, using, **kwargs):
+    # postgres only: lets wildcard identifier searches without a literal prefix use an index.
+    # pg_trgm may not be installable without superuser, the B-tree indexes still serve exact and prefix lookups
+    if sender.name != 'mediastore' or connections[using].vendor != 'postgresql':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'")
+        if cursor.fetchone() is None:
+            try:
+                with transaction.atomic(using=using):
+                    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            except DatabaseError:
+                return
+        cursor.execute('CREATE INDEX IF NOT EXISTS mediastore_ident_value_trgm '
+                       'ON mediastore_mediaidentifier USING gin (value gin_trgm_ops)')
+
+
+@receiver(post_migrate)
+def backfill_media_created(sender, using, **kwargs):
+    # adding Media.created gave all existing media the migration's time, which would hold them back from
+    # min_age_days tiering and then move them all at once. No media is created after its first history
+    # record, so that record's date is the creation date of those. Never accessed media stay NULL in
+    # last_accessed, and idle policies go by created for them
+    if sender.name != 'mediastore':
+        return
+    first_recorded = Media.history.model.objects.using(using).filter(id=OuterRef('pk')).order_by() \
+        .values('id').annotate(first=Min('history_date')).values('first')
+    Media.objects.using(using).filter(created__gt=Subquery(first_recorded)).update(created=Subquery(first_recorded))
+
+
+@receiver(post_migrate)
+def ensure_fulltext_vector(sender, using, **kwargs):
+    # the search vector over MediaSearchDocument, see FullTextService
+    if sender.name != 'mediastore':
+        return
+    conn = connections[using]
+    doc_table, fts_table = 'mediastore_mediasearchdocument', FullTextService.FTS_TABLE
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            # external-content FTS5 table, kept in sync with the documents by triggers
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name=%s", [fts_table])
+            exists = cursor.fetchone()
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+                           f"document, content='{doc_table}', content_rowid='media_id')")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {doc_table} BEGIN "
+                           f"INSERT INTO {fts_table}(rowid, document) VALUES (new.media_id, new.document); END")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {doc_table} BEGIN "
+                           f"INSERT INTO {fts_table}({fts_table}, rowid, document) VALUES ('delete', old.media_id, old.document); END")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE ON {doc_table} BEGIN "
+                           f"INSERT INTO {fts_table}({fts_table}, rowid, document) VALUES ('delete', old.media_id, old.document); "
+                           f"INSERT INTO {fts_table}(rowid, document) VALUES (new.media_id, new.document); END")
+            if not exists:
+                cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+        elif conn.vendor == 'postgresql':
+            cursor.execute(f"ALTER TABLE {doc_table} ADD COLUMN IF NOT EXISTS vector tsvector "
+                           f"GENERATED ALWAYS AS (to_tsvector('{FullTextService.TS_CONFIG}', document)) STORED")
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {doc_table}_vector_gin ON {doc_table} USING gin (vector)')
+
+
+@receiver([post_save, post_delete], sender=Media)
+def invalidate_cached_media(sender, instance, **kwargs):
+    media_cache.invalidate(instance.pid)
+
+
+@receiver([post_save, post_delete], sender=StoreConfig)
+@receiver([post_save, post_delete], sender=S3Config)
+def clear_cached_media(sender, created=False, **kwargs):
+    # cached media carry their store_config and s3cfg. A new config has no media yet
+    if not created:
+        media_cache.clear()
@@ -0,0 +1,737 @@
+"""
+Chunked access to the bytes behind a StoreConfig, so large media stream in constant memory.
+"""
+import os
+import mmap
+import time
+import uuid
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, closing, suppress
+
+from django.conf import settings
+from django.core.cache import caches
+
+CHUNK_SIZE = 1024*1024  # 1 MiB
+S3_PART_SIZE = 8*1024*1024  # multipart parts must be >=5MiB, except the last
+
+
+class StorePool:
+    """Pooled BucketStores, ZipStores and s3 clients per StoreConfig. Idle entries are dropped, never closed"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # (kind,pk) -> [fingerprint, resource, last_used]
+
+    @staticmethod
+    def fingerprint(store_config) -> str:
+        kwargs = store_config.storage_Store_kwargs
+        return hashlib.sha256(repr(sorted(kwargs.items())).encode()).hexdigest()
+
+    def _lookup(self, kind, pk, fingerprint, now):
+        entry = self._entries.get((kind, pk))
+        if entry and entry[0] == fingerprint:
+            entry[2] = now
+            return entry[1]
+        return None
+
+    def _get(self, kind, store_config, factory):
+        if store_config.pk is None:
+            return factory()
+        fingerprint = self.fingerprint(store_config)
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            if (resource := self._lookup(kind, store_config.pk, fingerprint, time.monotonic())) is not None:
+                return resource
+        # built unlocked, a slow endpoint must not stall the lookups of other configs
+        resource = factory()
+        with self._lock:
+            # another thread may have built one meanwhile, keep the first
+            if (pooled := self._lookup(kind, store_config.pk, fingerprint, time.monotonic())) is not None:
+                return pooled
+            self._entries[(kind, store_config.pk)] = [fingerprint, resource, time.monotonic()]
+            return resource
+
+    def _evict_idle(self, now):
+        idle_seconds = getattr(settings, 'STORE_POOL_IDLE_SECONDS', 300)
+        for (kind, pk), (_, resource, last_used) in list(self._entries.items()):
+            if now - last_used > idle_seconds:
+                del self._entries[(kind, pk)]
+
+    def store(self, store_config):
+        def factory():
+            store = store_config.get_storage_store()
+            store.__enter__()
+            return store
+        return self._get('store', store_config, factory)
+
+    def s3_client(self, store_config):
+        return self._get('s3', store_config, store_config.make_s3_client)
+
+    def invalidate(self, *pks):
+        with self._lock:
+            for (kind, pk) in list(self._entries):
+                if pk in pks:
+                    del self._entries[(kind, pk)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+store_pool = StorePool()
+
+
+@contextmanager
+def open_store(store_config):
+    # BucketStores and ZipStores (their segment mmaps) are pooled. SqliteStore commits on __exit__ so it keeps a per-use connection
+    if store_config.type in (store_config.BUCKETSTORE, store_config.ZIPSTORE):
+        yield store_pool.store(store_config)
+    elif store_config.storage_is_context_managed:
+        with store_config.get_storage_store() as store:
+            yield store
+    else:
+        yield store_config.get_storage_store()
+
+
+class HashdirStore:
+    """Content-addressed store: the key of an object is its sha256, so identical content is kept once"""
+    def __init__(self, root_path: str):
+        self.root_path = root_path
+
+    def path(self, key: str) -> str:
+        digest = content_digest(key)
+        return os.path.join(self.root_path, digest[:2], digest[2:4], digest)
+
+    def put(self, key: str, data: bytes):
+        if content_key(hashlib.sha256(data).hexdigest()) != key:
+            raise ValueError(f'{key} is not the content key of the data')
+        write_chunks_hashdir(self.root_path, [data])
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self.path(key), 'rb') as f: return f.read()
+        except FileNotFoundError: raise KeyError(key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def delete(self, key: str):
+        try: os.remove(self.path(key))
+        except FileNotFoundError: raise KeyError(key)
+
+
+class ZipStore:
+    """Append-only segment files with a sqlite index of (segment, offset, size), for many small objects"""
+    INDEX_SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY AUTOINCREMENT, size INTEGER NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0)',
+        'CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, size INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment)',
+    )
+
+    def __init__(self, root_path: str, segment_bytes: int = None):
+        self.root_path = root_path
+        self.segment_bytes = segment_bytes or settings.ZIPSTORE_SEGMENT_BYTES
+        self._maps = {}  # segment id -> mmap
+        self._maps_lock = threading.Lock()
+        os.makedirs(os.path.join(root_path, 'segments'), exist_ok=True)
+        with closing(self._connect()) as conn:
+            for statement in self.INDEX_SCHEMA:
+                conn.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with self._maps_lock:
+            self._maps.clear()
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit, transactions are explicit BEGIN IMMEDIATE so that writers take the lock upfront
+        conn = sqlite3.connect(os.path.join(self.root_path, 'index.sqlite3'), timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    @contextmanager
+    def _write_transaction(self):
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.root_path, 'segments', f'{segment:08d}.seg')
+
+    def locate(self, key: str):
+        """Returns (segment, offset, size) of key"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT segment, offset, size FROM objects WHERE key=?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def _map(self, segment: int, end: int):
+        with self._maps_lock:
+            mm = self._maps.get(segment)
+            if mm is None or len(mm) < end:  # the segment grew since it was mapped
+                # a replaced map is not closed, views handed out may still use it. It is freed with them
+                with open(self.segment_path(segment), 'rb') as f:
+                    mm = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mm
+
+    def _unmap(self, segment: int):
+        with self._maps_lock:
+            self._maps.pop(segment, None)
+
+    def view(self, key: str) -> memoryview:
+        """Zero-copy view of key's bytes in its mmapped segment"""
+        for retry in (True, False):
+            segment, offset, size = self.locate(key)
+            if size == 0:
+                return memoryview(b'')
+            try:
+                return memoryview(self._map(segment, offset+size))[offset:offset+size]
+            except FileNotFoundError:
+                # compaction moved the object and removed its segment between lookup and read
+                if not retry: raise
+
+    def get(self, key: str) -> bytes:
+        return bytes(self.view(key))
+
+    def exists(self, key: str) -> bool:
+        try: self.locate(key)
+        except KeyError: return False
+        return True
+
+    def put(self, key: str, data: bytes):
+        with self._write_transaction() as conn:
+            self._append(conn, [(key, data)])
+
+    def delete(self, key: str):
+        with self._write_transaction() as conn:
+            row = conn.execute('SELECT segment, size FROM objects WHERE key=?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            conn.execute('DELETE FROM objects WHERE key=?', (key,))
+            conn.execute('UPDATE segments SET dead=dead+? WHERE id=?', (row[1], row[0]))
+
+    def _append(self, conn: sqlite3.Connection, items):
+        """Appends (key, data) items to the open segment, within a write transaction.
+        Bytes past a segment's committed size are leftovers of a failed write and are overwritten."""
+        items = list(items)
+        row = conn.execute('SELECT id, size FROM segments ORDER BY id DESC LIMIT 1').fetchone()
+        total = sum(len(data) for _, data in items)
+        if row is None or (row[1] and row[1]+total > self.segment_bytes):
+            row = (conn.execute('INSERT INTO segments DEFAULT VALUES').lastrowid, 0)
+        segment, offset = row
+        path = self.segment_path(segment)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(offset)
+            for key, data in items:
+                f.write(data)
+                old = conn.execute('SELECT segment, size FROM objects WHERE key=?', (key,)).fetchone()
+                if old is not None:
+                    conn.execute('UPDATE segments SET dead=dead+? WHERE id=?', (old[1], old[0]))
+                conn.execute('INSERT OR REPLACE INTO objects (key, segment, offset, size) VALUES (?,?,?,?)',
+                             (key, segment, offset, len(data)))
+                offset += len(data)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        conn.execute('UPDATE segments SET size=? WHERE id=?', (offset, segment))
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as conn:
+            segments, size, dead = conn.execute('SELECT count(*), coalesce(sum(size),0), coalesce(sum(dead),0) FROM segments').fetchone()
+            objects = conn.execute('SELECT count(*) FROM objects').fetchone()[0]
+        return dict(segments=segments, objects=objects, bytes=size, dead_bytes=dead)
+
+    def compact(self, min_dead_ratio: float = None, batch_size: int = 1000):
+        """Rewrites closed segments whose dead bytes are at least min_dead_ratio of their size:
+        their live objects are appended to the open segment and the segment file is removed.
+        Runs alongside readers and writers, each batch is one short write transaction.
+        Returns (segments removed, bytes reclaimed)"""
+        if min_dead_ratio is None:
+            min_dead_ratio = settings.ZIPSTORE_COMPACT_RATIO
+        with closing(self._connect()) as conn:
+            candidates = conn.execute('SELECT id, size FROM segments WHERE id < (SELECT max(id) FROM segments) AND dead >= ?*size',
+                                      (min_dead_ratio,)).fetchall()
+        removed = reclaimed = 0
+        for segment, size in candidates:
+            moved = 0
+            while True:
+                with self._write_transaction() as conn:
+                    rows = conn.execute('SELECT key, offset, size FROM objects WHERE segment=? LIMIT ?', (segment, batch_size)).fetchall()
+                    if not rows:
+                        conn.execute('DELETE FROM segments WHERE id=?', (segment,))
+                        break
+                    mm = self._map(segment, max(offset+length for _, offset, length in rows))
+                    self._append(conn, [(key, mm[offset:offset+length]) for key, offset, length in rows])
+                    moved += sum(length for *_, length in rows)
+            self._unmap(segment)
+            with suppress(FileNotFoundError):
+                os.remove(self.segment_path(segment))
+            removed, reclaimed = removed+1, reclaimed+size-moved
+        return removed, reclaimed
+
+
+class RamStorage:
+    """The objects of all DictStores, LRU-bounded by RAM_STORE_MAX_BYTES, or in the "ramstore" cache if configured"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = OrderedDict()  # (namespace, key) -> (data, expires)
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    @property
+    def shared(self):
+        return caches['ramstore'] if 'ramstore' in settings.CACHES else None
+
+    @staticmethod
+    def version_key(namespace: str) -> str:
+        return 'ramstore-version:' + hashlib.sha256(namespace.encode()).hexdigest()
+
+    def cache_key(self, shared, namespace: str, key: str) -> str:
+        # a new version, never one used before even if the backend evicted the current one, orphans
+        # the namespace's objects, which the backend then expires or evicts
+        version = shared.get(self.version_key(namespace))
+        if version is None:
+            shared.add(self.version_key(namespace), uuid.uuid4().hex, None)
+            version = shared.get(self.version_key(namespace))
+        return 'ramstore:' + hashlib.sha256(f'{namespace}:{version}:{key}'.encode()).hexdigest()
+
+    def put(self, namespace: str, key: str, data: bytes):
+        data = bytes(data)
+        if len(data) > settings.RAM_STORE_MAX_BYTES:
+            raise ValueError(f'{key} is larger than RAM_STORE_MAX_BYTES')
+        if (shared := self.shared) is not None:
+            # set() drops what the backend refuses (eg. past memcached's item size limit) silently, set_many() tells
+            if shared.set_many({self.cache_key(shared, namespace, key): data}, settings.RAM_STORE_TTL or None):
+                raise ValueError(f'the ramstore cache refused {key} ({len(data)} bytes)')
+            return
+        expires = time.monotonic() + settings.RAM_STORE_TTL if settings.RAM_STORE_TTL else None
+        with self._lock:
+            self._pop((namespace, key))
+            self._objects[(namespace, key)] = (data, expires)
+            self._bytes += len(data)
+            while self._bytes > settings.RAM_STORE_MAX_BYTES:
+                self._pop(next(iter(self._objects)))
+                self.evictions += 1
+
+    def _pop(self, item):
+        data, _ = self._objects.pop(item, (b'', None))
+        self._bytes -= len(data)
+
+    def get(self, namespace: str, key: str) -> bytes:
+        if (shared := self.shared) is not None:
+            data = shared.get(self.cache_key(shared, namespace, key))
+        else:
+            with self._lock:
+                data, expires = self._objects.get((namespace, key), (None, None))
+                if expires is not None and expires < time.monotonic():
+                    self._pop((namespace, key))
+                    self.expirations += 1
+                    data = None
+                elif data is not None:
+                    self._objects.move_to_end((namespace, key))
+        with self._lock:
+            if data is None: self.misses += 1
+            else: self.hits += 1
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def exists(self, namespace: str, key: str) -> bool:
+        if (shared := self.shared) is not None:
+            return shared.has_key(self.cache_key(shared, namespace, key))
+        with self._lock:
+            _, expires = self._objects.get((namespace, key), (None, 0))
+        return expires is None or expires >= time.monotonic()
+
+    def delete(self, namespace: str, key: str):
+        if (shared := self.shared) is not None:
+            if not shared.delete(self.cache_key(shared, namespace, key)): raise KeyError(key)
+            return
+        with self._lock:
+            if (namespace, key) not in self._objects: raise KeyError(key)
+            self._pop((namespace, key))
+
+    def clear(self, namespace: str = None):
+        if (shared := self.shared) is not None:
+            if namespace is None: shared.clear()
+            else: shared.set(self.version_key(namespace), uuid.uuid4().hex, None)
+        with self._lock:
+            for item in [item for item in self._objects if namespace in (None, item[0])]:
+                self._pop(item)
+
+    def stats(self) -> dict:
+        """Usage, by namespace and in total. Only counters are known of a shared backend"""
+        shared = self.shared
+        with self._lock:
+            namespaces = {}
+            for (namespace, _), (data, _) in self._objects.items():
+                usage = namespaces.setdefault(namespace, dict(objects=0, bytes=0))
+                usage['objects'] += 1
+                usage['bytes'] += len(data)
+            lookups = self.hits + self.misses
+            return dict(backend=shared.__class__.__name__ if shared is not None else 'local',
+                        objects=None if shared is not None else len(self._objects),
+                        bytes=None if shared is not None else self._bytes,
+                        max_bytes=None if shared is not None else settings.RAM_STORE_MAX_BYTES,
+                        namespaces=namespaces, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, expirations=self.expirations,
+                        hit_ratio=self.hits/lookups if lookups else 0.0)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+ram_storage = RamStorage()
+
+
+class RamStore:
+    """DictStore: in-memory objects under a namespace, one per StoreConfig bucket, held by ram_storage"""
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+
+    def put(self, key: str, data: bytes):
+        ram_storage.put(self.namespace, key, data)
+
+    def get(self, key: str) -> bytes:
+        return ram_storage.get(self.namespace, key)
+
+    def exists(self, key: str) -> bool:
+        return ram_storage.exists(self.namespace, key)
+
+    def delete(self, key: str):
+        ram_storage.delete(self.namespace, key)
+
+
+CONTENT_KEY_PREFIX = 'sha256:'
+
+def content_key(digest: str) -> str:
+    return CONTENT_KEY_PREFIX + digest
+
+def content_digest(key: str) -> str:
+    if not key.startswith(CONTENT_KEY_PREFIX):
+        raise KeyError(f'{key} is not a content key')
+    return key[len(CONTENT_KEY_PREFIX):]
+
+def is_content_addressed(store_config) -> bool:
+    return store_config.type == store_config.HASHDIRSTORE
+
+
+def fs_path(store_config, key: str) -> str:
+    if is_content_addressed(store_config):
+        return HashdirStore(store_config.bucket).path(key)
+    return os.path.join(store_config.bucket, key)
+
+
+def sqlite_connect(store_config) -> sqlite3.Connection:
+    # read-only and used by one reader at a time, but async readers resume it from any io thread
+    return sqlite3.connect(f'file:{store_config.bucket}?mode=ro', uri=True, check_same_thread=False)
+
+
+def sqlite_quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sqlite_layout(conn: sqlite3.Connection):
+    """(table, key column, blob column) of a SqliteStore database, refusing any but exactly one candidate table"""
+    candidates = []
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall()
+    for (table,) in tables:
+        columns = conn.execute(f'PRAGMA table_info({sqlite_quote(table)})').fetchall()
+        key_cols = [col[1] for col in columns if col[5]]
+        blob_cols = [col[1] for col in columns if col[2].upper() == 'BLOB']
+        if len(key_cols) == 1 and len(blob_cols) == 1:
+            candidates.append((table, key_cols[0], blob_cols[0]))
+    if len(candidates) != 1:
+        raise ValueError(f'expected one key/blob table in the SqliteStore database, found {[c[0] for c in candidates]}')
+    return candidates[0]
+
+
+def sqlite_locate(conn: sqlite3.Connection, key: str):
+    table, key_col, blob_col = sqlite_layout(conn)
+    row = conn.execute(f'SELECT rowid, length({sqlite_quote(blob_col)}) FROM {sqlite_quote(table)} WHERE {sqlite_quote(key_col)}=?',
+                       (key,)).fetchone()
+    if row is None:
+        raise KeyError(key)
+    rowid, size = row
+    return table, blob_col, rowid, size
+
+
+def preload(store_configs):
+    # loaded here, store I/O on worker threads should not query
+    for store_config in store_configs:
+        store_config.s3cfg
+
+
+def stat(store_config, key: str):
+    """Returns (size, etag) of a stored object without reading its content. etag may be None."""
+    match store_config.type:
+        case store_config.FILESYSTEMSTORE | store_config.HASHDIRSTORE:
+            try: st = os.stat(fs_path(store_config, key))
+            except FileNotFoundError: raise KeyError(key)
+            return st.st_size, f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        case store_config.BUCKETSTORE:
+            s3 = store_config.get_s3_client()
+            try: head = s3.head_object(Bucket=store_config.bucket, Key=key)
+            except s3.exceptions.ClientError as e:
+                if e.response['Error']['Code'] in ('404','NoSuchKey'): raise KeyError(key)
+                raise
+            return head['ContentLength'], head['ETag']
+        case store_config.SQLITESTORE:
+            with closing(sqlite_connect(store_config)) as conn:
+                _, _, _, size = sqlite_locate(conn, key)
+            return size, None
+        case store_config.ZIPSTORE:
+            with open_store(store_config) as store:
+                segment, offset, size = store.locate(key)
+            return size, f'"{segment:x}-{offset:x}-{size:x}"'
+        case _:
+            with open_store(store_config) as store:
+                content = store.get(key)
+            return len(content), None
+
+
+def iter_chunks(store_config, key: str, chunk_size: int = CHUNK_SIZE, start: int = 0, length: int = None):
+    """Yields the stored object's bytes in chunks of at most chunk_size.
+    If start/length are given, only that slice is read from the store."""
+    match store_config.type:
+        case store_config.FILESYSTEMSTORE | store_config.HASHDIRSTORE:
+            with open(fs_path(store_config, key), 'rb') as f:
+                f.seek(start)
+                yield from _read_slice(f.read, chunk_size, length)
+        case store_config.BUCKETSTORE:
+            s3 = store_config.get_s3_client()
+            kwargs = dict(Bucket=store_config.bucket, Key=key)
+            if start or length is not None:
+                last = '' if length is None else start+length-1
+                kwargs['Range'] = f'bytes={start}-{last}'
+            body = s3.get_object(**kwargs)['Body']
+            try:
+                yield from body.iter_chunks(chunk_size)
+            finally:
+                body.close()
+        case store_config.SQLITESTORE:
+            conn = sqlite_connect(store_config)
+            try:
+                table, blob_col, rowid, size = sqlite_locate(conn, key)
+                with conn.blobopen(table, blob_col, rowid, readonly=True) as blob:
+                    blob.seek(start)
+                    yield from _read_slice(blob.read, chunk_size, length)
+            finally:
+                conn.close()
+        case store_config.ZIPSTORE:
+            with open_store(store_config) as store:
+                view = store.view(key)
+            view = view[start:None if length is None else start+length]
+            for i in range(0, len(view), chunk_size):
+                yield bytes(view[i:i+chunk_size])
+        case _:
+            with open_store(store_config) as store:
+                content = store.get(key)
+            view = memoryview(content)[start:None if length is None else start+length]
+            for i in range(0, len(view), chunk_size):
+                yield bytes(view[i:i+chunk_size])
+
+
+def _read_slice(read, chunk_size: int, length: int = None):
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk: break
+        if remaining is not None: remaining -= len(chunk)
+        yield chunk
+
+
+def presigned_gets(store_config, keys: list, expiry: int) -> list:
+    # signing is local computation, one pooled client signs the whole batch without any request
+    s3 = store_config.get_s3_client()
+    return [s3.generate_presigned_url('get_object', Params=dict(Bucket=store_config.bucket, Key=key), ExpiresIn=expiry)
+            for key in keys]
+
+
+def presigned_puts(store_config, keys: list, expiry: int) -> list:
+    s3 = store_config.get_s3_client()
+    return [s3.generate_presigned_url('put_object', Params=dict(Bucket=store_config.bucket, Key=key), ExpiresIn=expiry)
+            for key in keys]
+
+
+def s3_part_size(size: int) -> int:
+    # s3 allows at most 10000 parts per upload
+    return max(S3_PART_SIZE, -(-size // 10000))
+
+
+def presigned_multipart(store_config, key: str, size: int, expiry: int):
+    """Starts a multipart upload of size bytes. Returns (upload_id, part_size, presigned part urls)"""
+    s3 = store_config.get_s3_client()
+    upload_id = s3.create_multipart_upload(Bucket=store_config.bucket, Key=key)['UploadId']
+    part_size = s3_part_size(size)
+    urls = [s3.generate_presigned_url('upload_part', ExpiresIn=expiry,
+                Params=dict(Bucket=store_config.bucket, Key=key, UploadId=upload_id, PartNumber=n))
+            for n in range(1, max(-(-size // part_size), 1)+1)]
+    return upload_id, part_size, urls
+
+
+def s3_complete_multipart(store_config, key: str, upload_id: str, parts: list):
+    # parts as [{"PartNumber":1, "ETag":...}, ...], the ETags s3 returned for each part PUT
+    s3 = store_config.get_s3_client()
+    s3.complete_multipart_upload(Bucket=store_config.bucket, Key=key, UploadId=upload_id,
+                                 MultipartUpload=dict(Parts=sorted(parts, key=lambda p: p['PartNumber'])))
+
+
+def s3_put_chunks(store_config, key: str, chunks):
+    # objects smaller than one part are a plain PutObject, larger ones a multipart upload
+    s3 = store_config.get_s3_client()
+    bucket = store_config.bucket
+    buffer = bytearray()
+    upload_id, parts = None, []
+    try:
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= S3_PART_SIZE:
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+                part_number = len(parts)+1
+                resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                      PartNumber=part_number, Body=bytes(buffer[:S3_PART_SIZE]))
+                parts.append(dict(PartNumber=part_number, ETag=resp['ETag']))
+                del buffer[:S3_PART_SIZE]
+        if upload_id is None:
+            s3.put_object(Bucket=bucket, Key=key, Body=bytes(buffer))
+            return
+        if buffer:
+            part_number = len(parts)+1
+            resp = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                  PartNumber=part_number, Body=bytes(buffer))
+            parts.append(dict(PartNumber=part_number, ETag=resp['ETag']))
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     MultipartUpload=dict(Parts=parts))
+    except BaseException:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def write_chunks(store_config, key: str, chunks):
+    """Writes an iterable of byte chunks to the store. Returns (size, sha256 hexdigest)"""
+    sha256 = hashlib.sha256()
+    size = 0
+    def hashed(chunks):
+        nonlocal size
+        for chunk in chunks:
+            sha256.update(chunk)
+            size += len(chunk)
+            yield chunk
+
+    match store_config.type:
+        case store_config.HASHDIRSTORE:
+            # the key is known once the content is hashed, see content_key()
+            return write_chunks_hashdir(store_config.bucket, chunks)
+        case store_config.FILESYSTEMSTORE:
+            path = fs_path(store_config, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f'{path}.partial'
+            try:
+                with open(partial, 'wb') as f:
+                    for chunk in hashed(chunks):
+                        f.write(chunk)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial): os.remove(partial)
+        case store_config.BUCKETSTORE:
+            s3_put_chunks(store_config, key, hashed(chunks))
+        case _:
+            content = b''.join(hashed(chunks))
+            with open_store(store_config) as store:
+                store.put(key, content)
+    return size, sha256.hexdigest()
+
+
+def write_chunks_hashdir(root_path: str, chunks):
+    """Writes chunks to a HashdirStore, at most once per content. Returns (size, sha256 hexdigest)"""
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_dir = os.path.join(root_path, '.partial')
+    os.makedirs(tmp_dir, exist_ok=True)
+    partial = os.path.join(tmp_dir, uuid.uuid4().hex)
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in chunks:
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        path = HashdirStore(root_path).path(content_key(sha256.hexdigest()))
+        if not os.path.exists(path):  # else identical content is already stored
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(partial, path)
+    finally:
+        if os.path.exists(partial): os.remove(partial)
+    return size, sha256.hexdigest()
+
+
+class Throttle:
+    """Limits the bytes per second passed through it, by all threads together. rate=0 is unlimited"""
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()  # when the bytes granted so far are paid for
+
+    def wait(self, n: int):
+        if not self.rate: return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n/self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def chunks(self, chunks):
+        for chunk in chunks:
+            self.wait(len(chunk))
+            yield chunk
+
+
+## Async adapter ##
+# storage I/O is blocking (files, sqlite, boto3). Async views run it on a dedicated thread pool,
+# so the event loop never blocks and a transfer holds a thread only while a chunk is read or written
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+def io_executor() -> ThreadPoolExecutor:
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_STORE_THREADS, thread_name_prefix='store-io')
+        return _io_executor
+
+
+async def run_io(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(io_executor(), partial(func, *args, **kwargs))
+
+
+async def astat(store_config, key: str):
+    return await run_io(stat, store_config, key)
+
+
+async def aiter_chunks(store_config, key: str, chunk_size: int = CHUNK_SIZE, start: int = 0, length: int = None):
+    chunks = iter_chunks(store_config, key, chunk_size, start=start, length=length)
+    try:
+        while (chunk := await run_io(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        await run_io(chunks.close)
+
+
+async def awrite_chunks(store_config, key: str, chunks):
+    return await run_io(write_chunks, store_config, key, chunks)
@@ -1,14 +1,20 @@
 import os
+import json
 import uuid
 os.environ["NINJA_SKIP_REGISTRY"] = "yes"
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from ninja.testing import TestClient
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 
-from .models import Media, IdentifierType, StoreConfig
+from .models import Media, IdentifierType, StoreConfig, S3Config
+from .services import S3ConfigService, MediaService
+from .stores import store_pool
+from .cache import media_cache
 from schemas.mediastore import StoreConfigSchema, StoreConfigSchemaCreate, S3ConfigSchemaCreate, S3ConfigSchemaSansKeys, \
     MediaSearchSchema, MediaSchemaUpdateIdentifiers, MediaSchemaUpdateMetadata, MediaSchemaUpdateTags
 
@@ -340,6 +346,208 @@ class MediaApiTest(TestCase):
         received_delete = resp.json()
         self.assertEqual(received_delete, expected)
 
+    def test_BULK_create_partial(self):
+        PID = whoami()
+        payload = [dict(pid=f'{PID}_1', pid_type='DEMO', store_config=self.demostore_dict, tags=['one','two'],
+                        identifiers={'BIN':'bin_1'}),
+                   dict(pid=f'{PID}_2', pid_type='DEMOxxx', store_config=self.demostore_dict),
+                   dict(pid=f'{PID}_1', pid_type='DEMO', store_config=self.demostore_dict),
+                   dict(pid=f'{PID}_3', pid_type='DEMO', store_config=self.demostore_dict, tags=['two'],
+                        identifiers={'DEMO':f'{PID}_3'}),]
+        resp = self.client.post("/media/create/bulk", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        received = resp.json()
+        self.assertEqual(received['successes'], [f'{PID}_1', f'{PID}_3'])
+        self.assertEqual([f['pid'] for f in received['failures']], [f'{PID}_2', f'{PID}_1'])
+        self.assertIn('bad pid_type: DEMOxxx', received['failures'][0]['msg'])
+
+        resp = self.client.post("/media/read", json=[f'{PID}_1', f'{PID}_3'], headers=self.auth_headers)
+        received = sorted(resp.json(), key=lambda m: m['pid'])
+        self.assertEqual(sorted(received[0]['tags']), ['one','two'])
+        self.assertEqual(received[0]['identifiers'], {'BIN':'bin_1'})
+        self.assertEqual(received[1]['tags'], ['two'])
+        self.assertEqual(received[1]['identifiers'], {})
+        self.assertEqual(Media.objects.get(pid=f'{PID}_1').history.count(), 1)
+
+        # all-or-nothing flavour
+        payload = [dict(pid=f'{PID}_4', pid_type='DEMO', store_config=self.demostore_dict),
+                   dict(pid=f'{PID}_5', pid_type='DEMOxxx', store_config=self.demostore_dict)]
+        resp = self.client.post("/media/create", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+        self.assertFalse(Media.objects.filter(pid=f'{PID}_4').exists())
+
+    def test_BULK_create_partial_integrityerror(self):
+        from unittest import mock
+        PID = whoami()
+        payload = [dict(pid=f'{PID}_0', pid_type='DEMO', store_config=self.demostore_dict)]
+        resp = self.client.post("/media/create/bulk", json=payload, headers=self.auth_headers)
+        taken_key = Media.objects.get(pid=f'{PID}_0').store_key
+        # a store_key conflict only the database catches fails its own row, not the batch
+        payload = [dict(pid=f'{PID}_{i}', pid_type='DEMO', store_config=self.demostore_dict) for i in (1,2,3)]
+        keys = [uuid.uuid4(), uuid.UUID(taken_key), uuid.uuid4()]
+        with mock.patch('mediastore.services.uuid', mock.Mock(uuid4=mock.Mock(side_effect=keys))):
+            resp = self.client.post("/media/create/bulk", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['successes'], [f'{PID}_1', f'{PID}_3'])
+        self.assertEqual([f['pid'] for f in resp.json()['failures']], [f'{PID}_2'])
+        self.assertEqual(Media.objects.get(pid=f'{PID}_1').history.count(), 1)
+
+    def test_BULK_update_engine(self):
+        PIDS = [f'{whoami()}_{i}' for i in range(4)]
+        payload = [dict(pid=pid, pid_type='DEMO', store_config=self.demostore_dict, metadata={'n':i}, tags=['a'])
+                   for i,pid in enumerate(PIDS)]
+        resp = self.client.post("/media/create", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        # set-based: as many queries for all media as for the first two. An absolute bound would break
+        # with every index kept in sync on metadata writes (metadata keys, full text)
+        payload = [dict(pid=pid, data={'depth':i*10}) for i,pid in enumerate(PIDS)]
+        with CaptureQueriesContext(connection) as few:
+            resp = self.client.patch('/media/update/metadata', json=payload[:2], headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], PIDS[:2])
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.patch('/media/update/metadata', json=payload+[dict(pid='nope', data={})], headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertEqual(resp.json()['successes'], PIDS)
+        self.assertEqual([f['pid'] for f in resp.json()['failures']], ['nope'])
+        self.assertEqual(len(ctx.captured_queries), len(few.captured_queries))
+
+        payload = [dict(pid=pid, tags=['b','c']) for pid in PIDS]
+        resp = self.client.put('/media/update/tags', json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], PIDS)
+
+        for i,pid in enumerate(PIDS):
+            media = Media.objects.get(pid=pid)
+            self.assertEqual(media.metadata, {'n':i, 'depth':i*10})
+            self.assertEqual(sorted(media.tags.names()), ['b','c'])
+            self.assertEqual(media.history.count(), 3 if i < 2 else 2)
+
+    def test_identifier_patterns(self):
+        resp = self.client.post("/identifier", json=dict(name='SERIAL', pattern=r'D\d{8}T\d{6}'), headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        resp = self.client.post("/identifier", json=dict(name='BAD', pattern=r'D(\d{8}'), headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+
+        payload = dict(pid='D20240101T000000', pid_type='SERIAL', store_config=self.demostore_dict)
+        resp = self.client.post("/media", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        payload = dict(pid='D2024', pid_type='SERIAL', store_config=self.demostore_dict)
+        resp = self.client.post("/media", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+        self.assertIn('does not match', resp.json()['detail'][0]['error'])
+
+        payload = dict(pid=whoami(), pid_type='DEMO', identifiers={'SERIAL':'nope'}, store_config=self.demostore_dict)
+        resp = self.client.post("/media", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+
+        # a bad pattern already stored fails its own identifiers only
+        IdentifierType.objects.create(name='LEGACY', pattern=r'D(\d{8}')
+        payload = dict(pid=whoami(), pid_type='DEMO', identifiers={'LEGACY':'D20240101'}, store_config=self.demostore_dict)
+        resp = self.client.post("/media", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+        payload = dict(pid=whoami(), pid_type='DEMO', store_config=self.demostore_dict)
+        resp = self.client.post("/media", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        # registry is warm, validation is query-free
+        payload = MediaSchemaUpdateIdentifiers(pid='D20240101T000000', identifiers={'DEMO':'xyz'})
+        media = Media.objects.get(pid='D20240101T000000')
+        with self.assertNumQueries(0):
+            MediaService.clean_identifiers(payload, media)
+
+    def test_search_metadata(self):
+        PID = whoami()
+        payload = [dict(pid=f'{PID}_{i}', pid_type='DEMO', store_config=self.demostore_dict, tags=['CTD'] if i%2 else [],
+                        metadata={'ctd':{'depth':depth}, 'station':station})
+                   for i,(depth,station) in enumerate([(5,'A'),(10,'B'),(30,'A'),(50,'C'),(80,'B')])]
+        resp = self.client.post("/media/create", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        def search(metadata, tags=()):
+            resp = self.client.post("/media/search", json=dict(tags=list(tags), metadata=metadata), headers=self.auth_headers)
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            return sorted(m['pid'] for m in resp.json())
+
+        depth_10_50 = dict(all=[dict(path=['ctd','depth'], op='gte', value=10), dict(path=['ctd','depth'], op='lte', value=50)])
+        station_a_or_c = dict(any=[dict(path=['station'], value='A'), dict(path=['station'], value='C')])
+        for indexed in (False, True):
+            if indexed:
+                for path in ['ctd.depth', 'station']:
+                    resp = self.client.post("/metadata/index", json=dict(path=path), headers=self.auth_headers)
+                    self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            self.assertEqual(search(depth_10_50), [f'{PID}_1', f'{PID}_2', f'{PID}_3'])
+            self.assertEqual(search(dict(all=[depth_10_50, station_a_or_c])), [f'{PID}_2', f'{PID}_3'])
+            self.assertEqual(search(depth_10_50, tags=['CTD']), [f'{PID}_1', f'{PID}_3'])
+            self.assertEqual(search(dict(all=[dict(path=['station'], op='in', value=['B'])])), [f'{PID}_1', f'{PID}_4'])
+            self.assertEqual(search(dict(all=[dict(path=['ctd','depth'], op='exists')])), [f'{PID}_{i}' for i in range(5)])
+
+        # index follows metadata updates
+        resp = self.client.patch('/media/update/metadata', json=[dict(pid=f'{PID}_0', keys=['ctd'], data={'depth':20})],
+                                 headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], [f'{PID}_0'])
+        self.assertEqual(search(depth_10_50), [f'{PID}_0', f'{PID}_1', f'{PID}_2', f'{PID}_3'])
+
+    def test_search_identifiers(self):
+        PID = whoami()
+        payload = [dict(pid=f'{PID}_{i}', pid_type='DEMO', store_config=self.demostore_dict, identifiers={'BIN':binid})
+                   for i,binid in enumerate(['D20240101T000000_IFCB101', 'D20240101T003000_IFCB101', 'D20240102T000000_IFCB102'])]
+        resp = self.client.post("/media/create", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        def search(*identifiers):
+            resp = self.client.post("/media/search", json=dict(tags=[], identifiers=list(identifiers)), headers=self.auth_headers)
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            return sorted(m['pid'] for m in resp.json())
+
+        self.assertEqual(search(dict(value='D20240101T003000_IFCB101')), [f'{PID}_1'])
+        self.assertEqual(search(dict(value='D20240101T003000_IFCB101', type='DEMO')), [])
+        self.assertEqual(search(dict(value=f'{PID}_2', type='DEMO')), [f'{PID}_2'])  # pids are indexed too
+        self.assertEqual(search(dict(value='D20240101', type='BIN', match='prefix')), [f'{PID}_0', f'{PID}_1'])
+        self.assertEqual(search(dict(value='*_IFCB101', match='wildcard')), [f'{PID}_0', f'{PID}_1'])
+        self.assertEqual(search(dict(value='D2024010?T000000*', match='wildcard')), [f'{PID}_0', f'{PID}_2'])
+        self.assertEqual(search(dict(value=f'{PID}_*', match='wildcard'), dict(value='*IFCB102', match='wildcard')), [f'{PID}_2'])
+
+        # index follows identifier and pid updates
+        resp = self.client.put('/media/update/identifiers', json=[dict(pid=f'{PID}_0', identifiers={'BIN':'D20240103T000000_IFCB103'})],
+                               headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], [f'{PID}_0'])
+        self.assertEqual(search(dict(value='*_IFCB101', match='wildcard')), [f'{PID}_1'])
+        self.assertEqual(search(dict(value='D20240103T000000_IFCB103')), [f'{PID}_0'])
+
+    def test_search_text(self):
+        PID = whoami()
+        payload = [dict(pid=f'{PID}_0', pid_type='DEMO', store_config=self.demostore_dict, tags=['plankton'],
+                        metadata={'cruise':'EN706', 'notes':'calm seas at Station Alpha'}),
+                   dict(pid=f'{PID}_1', pid_type='DEMO', store_config=self.demostore_dict,
+                        metadata={'cruise':'EN706', 'stations':['Station Bravo', 'Station Alpha'], 'notes':'Alpha again, Alpha!'}),
+                   dict(pid=f'{PID}_2', pid_type='DEMO', store_config=self.demostore_dict, identifiers={'BIN':'D20240101T000000_IFCB101'},
+                        metadata={'cruise':'AR77', 'depth':10}),]
+        resp = self.client.post("/media/create", json=payload, headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+
+        def search(text, **kwargs):
+            resp = self.client.post("/media/search", json={'tags': [], 'text': text, **kwargs}, headers=self.auth_headers)
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            return [m['pid'] for m in resp.json()]
+
+        self.assertEqual(search('alpha'), [f'{PID}_1', f'{PID}_0'])  # ranked, _1 mentions alpha more
+        self.assertEqual(search('EN706 bravo'), [f'{PID}_1'])
+        self.assertEqual(search('plankton'), [f'{PID}_0'])  # tags
+        self.assertEqual(search('D20240101T000000_IFCB101'), [f'{PID}_2'])  # identifiers
+        self.assertEqual(search('EN706', tags=['plankton']), [f'{PID}_0'])
+        self.assertEqual(search('nowhere'), [])
+        self.assertEqual(search('   '), [])
+
+        # documents follow updates
+        resp = self.client.patch('/media/update/tags', json=[dict(pid=f'{PID}_2', tags=['plankton'])], headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], [f'{PID}_2'])
+        self.assertEqual(sorted(search('plankton')), [f'{PID}_0', f'{PID}_2'])
+        resp = self.client.put('/media/update/metadata', json=[dict(pid=f'{PID}_0', keys=[], data={'notes':'rough seas'})],
+                               headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], [f'{PID}_0'])
+        self.assertEqual(search('alpha'), [f'{PID}_1'])
+
     #todo
     # PUT /media/update/storekeys
     # PUT PATCH DELETE /media/update/metadata
@@ -380,6 +588,101 @@ class MediaApiTest(TestCase):
 
 
 
+    def test_list_search_read_querycount(self):
+        def query_counts():
+            counts = []
+            for func, arg in [(MediaService.list_media, None),
+                              (MediaService.search, MediaSearchSchema(tags=['QC'])),
+                              (MediaService.bulk_read, list(Media.objects.values_list('pid', flat=True)))]:
+                with CaptureQueriesContext(connection) as ctx:
+                    results = func(arg) if arg is not None else func()
+                counts.append( (len(ctx.captured_queries), len(results)) )
+            return counts
+
+        for i in range(2):
+            self.client.post("/media", json=dict(pid=f'{whoami()}_{i}', pid_type='DEMO', tags=['QC', f'x{i}'],
+                             store_config=self.demostore_dict), headers=self.auth_headers)
+        small = query_counts()
+        for i in range(2,12):
+            self.client.post("/media", json=dict(pid=f'{whoami()}_{i}', pid_type='DEMO', tags=['QC', f'x{i}'],
+                             store_config=self.demostore_dict), headers=self.auth_headers)
+        large = query_counts()
+
+        self.assertEqual([n for _,n in small], [2,2,2])
+        self.assertEqual([n for _,n in large], [12,12,12])
+        self.assertEqual([q for q,_ in small], [q for q,_ in large])
+
+    def test_read_cache(self):
+        PID = whoami()
+        self.client.post("/media", json=dict(pid=PID, pid_type='DEMO', tags=['CACHE'], metadata={'v':1},
+                         store_config=self.demostore_dict), headers=self.auth_headers)
+        media_cache.reset_stats()
+
+        def read():
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(f'/media/{PID}', headers=self.auth_headers)
+            self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+            return resp.json(), [q['sql'] for q in ctx.captured_queries if 'mediastore_' in q['sql']]
+        self.assertEqual(read()[0]['metadata'], {'v':1})
+        received, queries = read()
+        self.assertEqual(received['tags'], ['CACHE'])
+        self.assertEqual(queries, [])  # auth queries only
+        self.assertEqual((media_cache.stats()['hits'], media_cache.stats()['misses']), (1, 1))
+
+        # every write path invalidates
+        resp = self.client.put('/media/update/metadata', json=[dict(pid=PID, keys=[], data={'v':2})], headers=self.auth_headers)
+        self.assertEqual(resp.json()['successes'], [PID])
+        self.assertEqual(read()[0]['metadata'], {'v':2})
+        self.client.patch('/media/update/tags', json=[dict(pid=PID, tags=['MORE'])], headers=self.auth_headers)
+        self.assertEqual(sorted(read()[0]['tags']), ['CACHE', 'MORE'])
+        MediaService.update_status(PID, StoreConfig.READY)
+        self.assertEqual(read()[0]['store_status'], StoreConfig.READY)
+        MediaService.delete(PID, del_stored=False)
+        with self.assertRaises(Media.DoesNotExist):
+            self.client.get(f'/media/{PID}', headers=self.auth_headers)
+
+        resp = self.client.get('/cache/stats', headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['hits'], 1)
+
+    def test_dump_pagination(self):
+        PIDS = [f'{whoami()}_{i}' for i in range(5)]
+        for pid in PIDS:
+            self.client.post("/media", json=dict(pid=pid, pid_type='DEMO', tags=['PAGE'],
+                             store_config=self.demostore_dict), headers=self.auth_headers)
+        for url, method, body in [("/media/dump", 'get', None),
+                                  ("/media/search", 'post', dict(MediaSearchSchema(tags=['PAGE']))),
+                                  ("/media/read", 'post', PIDS)]:
+            received, cursor = [], None
+            for _ in range(len(PIDS)):
+                query = f'?limit=2&cursor={cursor}' if cursor else '?limit=2'
+                resp = getattr(self.client, method)(url+query, json=body, headers=self.auth_headers)
+                self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+                self.assertLessEqual(len(resp.json()), 2)
+                received.extend(m['pid'] for m in resp.json())
+                cursor = resp['X-Next-Cursor'] if resp.has_header('X-Next-Cursor') else None
+                if not cursor: break
+            self.assertEqual(received, PIDS, msg=url)
+
+        resp = self.client.get("/media/dump?cursor=notacursor", headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+        for limit in (0, -1):
+            resp = self.client.get(f"/media/dump?limit={limit}", headers=self.auth_headers)
+            self.assertEqual(resp.status_code, 422, msg=resp.content.decode())
+
+    def test_export_ndjson(self):
+        PIDS = [f'{whoami()}_{i}' for i in range(3)]
+        for pid in PIDS:
+            self.client.post("/media", json=dict(pid=pid, pid_type='DEMO', metadata={'pid':pid},
+                             store_config=self.demostore_dict), headers=self.auth_headers)
+        resp = self.client.get("/media/export", headers=self.auth_headers)
+        self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
+        self.assertTrue(resp.streaming)
+        lines = resp.content.decode().splitlines()
+        received = [json.loads(line) for line in lines]
+        self.assertEqual([m['pid'] for m in received], PIDS)
+        self.assertEqual([m['metadata']['pid'] for m in received], PIDS)
+
 
 class MediaVersioningTest(TestCase):
 
@@ -521,3 +824,31 @@ class StoreCRUDTests(TestCase):
         resp = self.client.get(f"/s3cfgs")
         self.assertEqual(resp.status_code, 200, msg=resp.content.decode())
         self.assertEqual(resp.json(), [])
+
+
+class StorePoolTests(TestCase):
+
+    def setUp(self):
+        self.s3cfg = S3Config.objects.create(url='https://my.endpoint.s3', access_key='bingus', secret_key='secretbingus')
+        self.store_config = StoreConfig.objects.create(type=StoreConfig.BUCKETSTORE, bucket='demobucket', s3cfg=self.s3cfg)
+
+    def tearDown(self):
+        store_pool.clear()
+
+    def test_s3_client_reused(self):
+        client1 = self.store_config.get_s3_client()
+        client2 = StoreConfig.objects.get(pk=self.store_config.pk).get_s3_client()
+        self.assertIs(client1, client2)
+
+    def test_s3_client_invalidated_on_update(self):
+        client1 = self.store_config.get_s3_client()
+        S3ConfigService.update(self.s3cfg.pk, S3ConfigSchemaCreate(
+            url=self.s3cfg.url, access_key='bingus', secret_key='newsecretbingus'))
+        client2 = StoreConfig.objects.get(pk=self.store_config.pk).get_s3_client()
+        self.assertIsNot(client1, client2)
+
+    @override_settings(STORE_POOL_IDLE_SECONDS=-1)
+    def test_s3_client_idle_eviction(self):
+        client1 = self.store_config.get_s3_client()
+        client2 = self.store_config.get_s3_client()
+        self.assertIsNot(client1, client2)
@@ -1,14 +1,20 @@
 from typing import List
-from ninja import Router
+from ninja import Router, Query
+from django.http import HttpResponse, StreamingHttpResponse
 
 from schemas.mediastore import MediaSchema, MediaSchemaCreate, MediaSchemaUpdate, \
     MediaSearchSchema, BulkUpdateResponseSchema, MediaErrorSchema, MediaSchemaUpdateTags, MediaSchemaUpdateStorekey, \
     MediaSchemaUpdateIdentifiers, MediaSchemaUpdateMetadata
 from schemas.mediastore import StoreConfigSchema, StoreConfigSchemaCreate, S3ConfigSchemaSansKeys, S3ConfigSchemaCreate, IdentifierTypeSchema
 from schemas.mediastore import LoginInputDTO, TokenOutputDTO, ErrorDTO
-from mediastore.services import MediaService, StoreService, S3ConfigService, IdentifierTypeService
+from mediastore.schemas import MediaSearchQuerySchema, IndexedMetadataKeySchema, MediaCacheStatsSchema, ReadCacheStatsSchema, RamStoreStatsSchema
+from mediastore.cache import media_cache
+from mediastore.readcache import read_cache
+from mediastore.stores import ram_storage
+from mediastore.services import MediaService, StoreService, S3ConfigService, IdentifierTypeService, MetadataIndexService
 
 router = Router()
+async_router = Router()  # for ASGI deployments, mounted under /async
 
 @router.post("/login", response={200: TokenOutputDTO, 401: ErrorDTO}, auth=None)
 def login(request, login: LoginInputDTO):
@@ -25,21 +31,34 @@ def hello(request):
 
 ## MEDIA BULK ##
 
+def paginated(response: HttpResponse, page: List[MediaSchema], limit: int = None, cursor: str = None):
+    # paging is opt-in with limit or cursor. The continuation token is returned in a header
+    if limit is not None or cursor is not None:
+        if next_cursor := MediaService.next_cursor(page, limit):
+            response['X-Next-Cursor'] = next_cursor
+    return page
+
 @router.post('/media/search', response=List[MediaSchema])
-def media_search(request, search_params:MediaSearchSchema):
-    return MediaService.search(search_params)
+def media_search(request, response: HttpResponse, search_params:MediaSearchQuerySchema, limit: int = Query(None, ge=1), cursor: str = None):
+    return paginated(response, MediaService.search(search_params, limit, cursor), limit, cursor)
 
 @router.post('/media/create', response=List[MediaSchema])
 def media_create(request, medias: List[MediaSchemaCreate]):
-    created_media = []
-    for media in medias:
-        created_media.append( MediaService.create(media) )
-    return created_media
+    # all or nothing, any invalid media is a 422
+    created_media, _ = MediaService.bulk_create(medias, partial=False)
+    created_media = MediaService.queryset().filter(pk__in=[m.pk for m in created_media]).order_by('pk')
+    return MediaService.serialize_many(created_media)
+
+@router.post('/media/create/bulk', response=BulkUpdateResponseSchema)
+def media_create_bulk(request, medias: List[MediaSchemaCreate]):
+    # creates the valid media, reports the rest
+    created_media, failures = MediaService.bulk_create(medias)
+    return BulkUpdateResponseSchema(successes=[media.pid for media in created_media], failures=failures)
 
 @router.post('/media/read', response=List[MediaSchema])
-def media_read(request, pids: List[str]):
+def media_read(request, response: HttpResponse, pids: List[str], limit: int = Query(None, ge=1), cursor: str = None):
     # TODO list failed efforts?
-    return MediaService.bulk_read(pids)
+    return paginated(response, MediaService.bulk_read(pids, limit, cursor), limit, cursor)
 
 def bulk_update_response(payload:list, function):
     successes = []
@@ -59,28 +78,28 @@ def media_delete(request, pids: List[str]):
 
 @router.patch('/media/update/tags', response=BulkUpdateResponseSchema)
 def media_update_tags_add(request, payload: List[MediaSchemaUpdateTags]):
-    return bulk_update_response(payload, MediaService.update_tags_add)
+    return MediaService.bulk_update(payload, tags='add')
 @router.put('/media/update/tags', response=BulkUpdateResponseSchema)
 def media_update_tags_put(request, payload: List[MediaSchemaUpdateTags]):
-    return bulk_update_response(payload, MediaService.update_tags_put)
+    return MediaService.bulk_update(payload, tags='put')
 
 @router.put('/media/update/storekeys', response=BulkUpdateResponseSchema)
 def media_update_storekeys(request, payload: List[MediaSchemaUpdateStorekey]):
-    return bulk_update_response(payload, MediaService.update_storekey)
+    return MediaService.bulk_update(payload, MediaService.apply_storekey, ['store_key'])
 
 @router.put('/media/update/identifiers', response=BulkUpdateResponseSchema)
 def media_update_identifiers(request, payload: List[MediaSchemaUpdateIdentifiers]):
-    return bulk_update_response(payload, MediaService.update_identifiers)
+    return MediaService.bulk_update(payload, MediaService.apply_identifiers, ['identifiers'])
 
 @router.put('/media/update/metadata', response=BulkUpdateResponseSchema)
 def media_update_metadata_put(request, payload: List[MediaSchemaUpdateMetadata]):
-    return bulk_update_response(payload, MediaService.update_metadata_put)
+    return MediaService.bulk_update(payload, MediaService.apply_metadata_put, ['metadata'])
 @router.patch('/media/update/metadata', response=BulkUpdateResponseSchema)
 def media_update_metadata_patch(request, payload: List[MediaSchemaUpdateMetadata]):
-    return bulk_update_response(payload, MediaService.update_metadata_patch)
+    return MediaService.bulk_update(payload, MediaService.apply_metadata_patch, ['metadata'])
 @router.delete('/media/update/metadata', response=BulkUpdateResponseSchema)
 def media_update_metadata_delete(request, payload: List[MediaSchemaUpdateMetadata]):
-    return bulk_update_response(payload, MediaService.update_metadata_delete)
+    return MediaService.bulk_update(payload, MediaService.apply_metadata_delete, ['metadata'])
 
 @router.patch('/media/update', response=BulkUpdateResponseSchema)
 def patch_medias(request, pids: List[str], medias: List[MediaSchemaUpdate]):
@@ -90,8 +109,13 @@ def patch_medias(request, pids: List[str], medias: List[MediaSchemaUpdate]):
 ## MEDIA ##
 
 @router.get('/media/dump', response=List[MediaSchema])
-def list_media(request):
-    return MediaService.list_media()
+def list_media(request, response: HttpResponse, limit: int = Query(None, ge=1), cursor: str = None):
+    return paginated(response, MediaService.list_media(limit, cursor), limit, cursor)
+
+@router.get('/media/export')
+def export_media(request):
+    # newline-delimited json of every media, streamed
+    return StreamingHttpResponse(MediaService.export_ndjson(), content_type='application/x-ndjson')
 
 @router.post('/media', response=MediaSchema)
 def media_create_single(request, media: MediaSchemaCreate):
@@ -101,6 +125,11 @@ def media_create_single(request, media: MediaSchemaCreate):
 def media_read_single(request, pid: str):
     return MediaService.read(pid)
 
+@async_router.get('/media/{pid}', response=MediaSchema)
+async def amedia_read_single(request, pid: str):
+    media = await media_cache.aget(pid)
+    return MediaService.serialize(media)
+
 @router.delete('/media/{pid}', response={204: int})
 def media_delete_single(request, pid: str):
     MediaService.delete(pid)
@@ -184,3 +213,30 @@ def update_identifier(request, payload:IdentifierTypeSchema):
 def delete_identifier(request, name:str):
     IdentifierTypeService.delete(name)
     return 204
+
+## Indexed Metadata Keys ##
+@router.get('/metadata/indexes', response=List[IndexedMetadataKeySchema])
+def list_metadata_indexes(request):
+    return MetadataIndexService.list()
+
+@router.post('/metadata/index', response=IndexedMetadataKeySchema)
+def create_metadata_index(request, payload:IndexedMetadataKeySchema):
+    return MetadataIndexService.create(payload)
+
+@router.delete('/metadata/index/{path}', response={204: int})
+def delete_metadata_index(request, path:str):
+    MetadataIndexService.delete(path)
+    return 204
+
+## Caches ##
+@router.get('/cache/stats', response=MediaCacheStatsSchema)
+def media_cache_stats(request):
+    return media_cache.stats()
+
+@router.get('/cache/read/stats', response=ReadCacheStatsSchema)
+def read_cache_stats(request):
+    return read_cache.stats()
+
+@router.get('/cache/ram/stats', response=RamStoreStatsSchema)
+def ram_store_stats(request):
+    return ram_storage.stats()